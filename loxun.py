@@ -355,6 +355,97 @@ Loxun automatically optimized pairs of empty start/end tags. For example:
 Despite the explicit ``startTag("person")`` and matching ``endtag()``, the
 output only contains a simple ``<person ... />`` tag.
 
+Memory usage
+============
+
+Apart from the current start tag, the writer does not hold on to anything
+it has written, so the memory needed stays the same no matter how large
+the document gets. The test suite measures this using ``tracemalloc``.
+
+Features that have to buffer content until the end of a block are the
+exception: `XmlWriter.deferred()` and `XmlWriter.cached()`. To find out
+how much they needed, use `XmlWriter.maxBufferedByteCount`.
+
+Output sinks
+============
+
+Any output with a ``write(data)`` method works, but for some outputs
+calling it for every fragment is wasteful. An `XmlSink` tells the writer
+what the output can do, so the writer picks the fastest way to write to
+it. Loxun includes sinks for:
+
+* file descriptors and sockets, which get the fragments in chunks of about
+  64 KB using a single system call instead of one for each fragment:
+  `FileDescriptorSink` and `SocketSink`
+* a ``bytearray``: `BytearraySink`
+* text streams, which get ``str`` without encoding it first: `TextSink`
+
+For example, to send a document to a client:
+
+    >>> import socket
+    >>> server, client = socket.socketpair()
+    >>> xml = XmlWriter(SocketSink(server), pretty=False)
+    >>> xml.tag("hello")
+    >>> xml.close()
+    >>> client.recv(1024)
+    b'<?xml version="1.0" encoding="utf-8"?><hello/>'
+    >>> server.close()
+    >>> client.close()
+
+Canonical XML
+=============
+
+To compute digests or signatures, you need XML in canonical form as
+described in <http://www.w3.org/TR/xml-c14n>. Instead of parsing and
+canonicalizing the output again, loxun can write it in canonical form
+right away using ``canonical=True``:
+
+    >>> out = io.BytesIO()
+    >>> xml = XmlWriter(out, canonical=True, hashName="sha256")
+    >>> xml.addNamespace("b", "http://b/")
+    >>> xml.addNamespace("a", "http://a/")
+    >>> xml.startTag("a:tag", {"b:x": "1", "a:y": "2\\n", "z": "3"})
+    >>> xml.tag("empty")
+    >>> xml.endTag()
+    >>> xml.close()
+    >>> print(out.getvalue().decode("utf-8"))
+    <a:tag xmlns:a="http://a/" xmlns:b="http://b/" z="3" a:y="2&#xA;" b:x="1"><empty></empty></a:tag>
+
+This differs from the usual output in several ways:
+
+* There is no XML prolog.
+* Namespace declarations come first, followed by the attributes ordered by
+  namespace URI and local name.
+* Empty elements are not optimized to ``<empty />``.
+* Text and attribute values are escaped according to the rules for
+  canonical XML, and CDATA sections are written as escaped text.
+* Pretty printing is disabled and ``newline`` is always a line feed.
+* The encoding must be UTF-8.
+
+Using ``hashName``, the writer computes a hash of the output while
+writing it, see `XmlWriter.outputHash`.
+
+Converting JSON lines and CSV
+=============================
+
+To convert JSON lines or CSV to XML, run loxun as a script::
+
+  $ python -m loxun --root=customers --row=customer customers.jsonl -o customers.xml
+
+Each line or row results in an element named after ``--row`` within the
+root element named after ``--root``. The keys of JSON objects and the
+columns of CSV files result in elements; with ``--attributes``, values that
+are neither objects nor arrays result in attributes instead. Files ending
+in ``.gz``, ``.bz2`` or ``.xz`` are compressed or decompressed accordingly.
+For other options, run ``python -m loxun --help``.
+
+The converter reads one line or row at a time and writes the XML right
+away, so it needs only little memory even for huge files. To convert a
+huge JSON lines file faster, use ``--jobs`` to split it into chunks that
+are converted by several processes at the same time and written in
+their original order. To convert
+rows from within Python, use `writeRows()`.
+
 Contributing
 ------------
 
@@ -386,7 +477,6 @@ of features that might be added at some point:
   `XmlWriter.startTag()` where it could be turned on and off as needed. And
   the property could be named ``literal`` instead of ``pretty`` (with an
   inverse logic).
-* Add a ``DomWriter`` that creates a ``xml.dom.minidom.Document``.
 
 Some features other XML libraries support but I never saw any real use for:
 
@@ -395,6 +485,75 @@ Some features other XML libraries support but I never saw any real use for:
 Version history
 ===============
 
+Version 2.1, unreleased
+
+* Changed `XmlWriter` and its subclasses to use ``__slots__``, which reduces
+  the memory needed for each writer and speeds up the write path. As a
+  consequence, you cannot add arbitrary attributes to writers anymore unless
+  your subclass defines a ``__dict__``.
+* Changed `ChainXmlWriter` to provide its chainable methods directly instead
+  of wrapping them on each attribute access.
+* Added `XmlWriter.reset()` to reuse a writer for another output and
+  `XmlWriterFactory` to cheaply create many writers with the same settings.
+* Added `BytesXmlWriter` to quickly render small documents to ``bytes``.
+* Added `XmlWriter.checkpoint()` and `XmlWriter.fromCheckpoint()` to resume
+  writing large documents after a crash.
+* Added `XmlWriter.bytePosition`, the number of bytes written so far.
+* Added `TreeXmlWriter` and `ChainTreeXmlWriter` to build an ElementTree
+  instead of writing XML.
+* Added option ``canonical`` to write canonical XML and option
+  ``hashName`` to compute a hash of the output while writing it.
+* Added `ChecksumOutput` to compute checksums of the output while writing
+  it.
+* Added `XmlWriter.element()` and `XmlWriter.writeIterparse()` to write
+  ElementTree elements and documents.
+* Added `transform()` and `XmlWriterContentHandler` to filter and rewrite
+  XML documents using SAX.
+* Added support for attributes using the predefined "xml" namespace, for
+  example ``xml:lang``.
+* Added `XmlProfiler` to find out which methods and tags take the most
+  time to write.
+* Added `XmlWriter.deferred()` to write a start tag with attributes that
+  depend on the content of the element.
+* Added `XmlWriter.placeholder()` and `XmlWriter.fill()` to set
+  attribute values in seekable outputs after the start tag has been
+  written.
+* Added `TeeXmlWriter` to write the same document to several outputs
+  with different settings.
+* Added `RecordingXmlWriter` and `XmlWriter.replay()` to quickly write
+  the same section many times.
+* Added a command line converter for JSON lines and CSV, see
+  `Converting JSON lines and CSV`_, optionally using several processes.
+  As a consequence, use
+  ``python -m loxun --doctest`` to run the doctests.
+* Added `XmlSink` and the sinks `FileDescriptorSink`, `SocketSink`,
+  `BytearraySink` and `TextSink` to write to outputs more efficiently,
+  see `Output sinks`_, and `XmlWriter.flush()`.
+* Added option ``concurrent`` and `XmlWriter.fragment()` to let several
+  threads write to the same document.
+* Added `XmlWriter.bufferedByteCount` and
+  `XmlWriter.maxBufferedByteCount` to find out how much content
+  `XmlWriter.deferred()` and `XmlWriter.cached()` buffer.
+* Changed tags without attributes to share an empty dictionary instead of
+  creating one for each of them.
+* Added `XmlWriter.cached()` and option ``fragmentCache`` to write a
+  section only once and copy its bytes from a `FragmentCache` afterwards.
+* Added option ``invalidChars`` to remove, replace or reject characters
+  that must not occur in XML, for example control characters.
+* Improved performance of writing with legacy encodings like ISO-8859-15
+  or CP1252.
+* Improved performance of pretty printed text and comments with many lines.
+* Changed escaping to not depend on ``xml.sax`` anymore, which makes
+  importing loxun a lot faster.
+* Fixed that some broken input resulted in XML that was not well-formed
+  instead of raising an `XmlError`: comments ending with "-" and
+  ``embedInBlanks=False``, namespaces added more than once for the same
+  element, namespaces added right before ``endTag()``, attributes with the
+  same name in the same namespace URI and processing instructions with
+  the target "xml". Also a `startTag()` failing because of an unknown
+  namespace does not mess up the namespaces of later tags anymore.
+* Changed `processingInstruction()` to allow empty text.
+
 Version 2.0, 2014-07-28
 
 * Added support for Python 3.2+ while retaining the option to run with
@@ -508,11 +667,8 @@ Version 0.1, 15-May-2010
 from __future__ import unicode_literals
 
 import collections
-import io
 import os
-import re
 import sys
-import xml.sax.saxutils
 
 __version__ = "2.0"
 
@@ -526,15 +682,294 @@ else:
     unicode_type = str
 
 
+# Attributes of tags without any, shared to avoid creating an empty
+# dictionary for each of them. It must never be changed.
+_NO_ATTRIBUTES = {}
+
+# Operations in the log of a `RecordingXmlWriter`.
+_OP_TAG = 0
+_OP_TEXT = 1
+_OP_COMMENT = 2
+_OP_RAW_BLOCK = 3
+_OP_WRITE = 4
+_OP_NEWLINE = 5
+
+# URI the "xml" prefix is bound to by definition.
+_XML_NAMESPACE_URI = "http://www.w3.org/XML/1998/namespace"
+
+# Actions used to traverse ElementTree elements in `XmlWriter.element()`.
+_ELEMENT_START = 0
+_ELEMENT_END = 1
+_ELEMENT_TAIL = 2
+
+
 class XmlError(Exception):
     """
     Error raised when XML can not be generated.
     """
     pass
 
+def _escaped(text):
+    """
+    Same as ``xml.sax.saxutils.escape(text)`` but without the need to import
+    ``xml.sax``, which takes surprisingly long.
+
+        >>> _escaped("<this> & <that>")
+        '&lt;this&gt; &amp; &lt;that&gt;'
+    """
+    return text.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+
 def _quoted(value):
+    """
+    Same as ``xml.sax.saxutils.quoteattr(value)`` but without the need to
+    import ``xml.sax``.
+
+        >>> print(_quoted("a < b"))
+        "a &lt; b"
+        >>> print(_quoted("say \\"hello\\""))
+        'say "hello"'
+        >>> print(_quoted("say \\"hello\\" and 'bye'"))
+        "say &quot;hello&quot; and 'bye'"
+    """
+    _assertIsUnicode("value", value)
+    result = _escaped(value)
+    if ("\n" in result) or ("\r" in result) or ("\t" in result):
+        result = result.replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+    if "\"" in result:
+        if "'" in result:
+            result = "\"%s\"" % result.replace("\"", "&quot;")
+        else:
+            result = "'%s'" % result
+    else:
+        result = "\"%s\"" % result
+    return result
+
+def _splitLines(text):
+    """
+    Lines of ``text`` split at line feeds, which is the same as iterating
+    over ``io.StringIO(text)`` except that the lines do not end with a line
+    feed.
+
+        >>> _splitLines("a\\nb\\n")
+        ['a', 'b']
+        >>> _splitLines("")
+        []
+    """
+    result = text.split("\n")
+    if not result[-1]:
+        result.pop()
+    return result
+
+def _canonicalEscaped(text):
+    """
+    Same as `_escaped()` but using the rules for text in canonical XML.
+
+        >>> _canonicalEscaped("a < b\\r\\n")
+        'a &lt; b&#xD;\\n'
+    """
+    result = _escaped(text)
+    if "\r" in result:
+        result = result.replace("\r", "&#xD;")
+    return result
+
+def _canonicalQuoted(value):
+    """
+    Same as `_quoted()` but using the rules for attribute values in
+    canonical XML.
+
+        >>> print(_canonicalQuoted("say \\"hello\\" > 'bye'\\n"))
+        "say &quot;hello&quot; > 'bye'&#xA;"
+    """
     _assertIsUnicode("value", value)
-    return xml.sax.saxutils.quoteattr(value)
+    result = value.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;")
+    if ("\t" in result) or ("\n" in result) or ("\r" in result):
+        result = result.replace("\t", "&#x9;").replace("\n", "&#xA;").replace("\r", "&#xD;")
+    return "\"%s\"" % result
+
+def _hashingWrite(write, outputHash):
+    """
+    Function that passes data to ``write`` after using it to update
+    ``outputHash``.
+    """
+    update = outputHash.update
+    def hashingWrite(data):
+        update(data)
+        write(data)
+    return hashingWrite
+
+# Encodings with a codec that already encodes ASCII text as fast as possible.
+_FAST_ENCODINGS = ("ascii", "iso8859-1", "utf-8")
+
+def _asciiShortcutEncoder(encoding, errors):
+    """
+    Function to encode unicode text to ``encoding`` that is faster than
+    ``text.encode(encoding, errors)`` or ``None`` if there is no such
+    function.
+
+    Many legacy encodings like ISO-8859-15 or CP1252 use a generic codec that
+    is several times slower than the ASCII codec. As most fragments written
+    are tags, indentation and ASCII text, it pays off to encode fragments
+    containing only ASCII characters using the ASCII codec if ``encoding``
+    is compatible with ASCII. Other fragments still use the codec of
+    ``encoding``, which with ``errors="xmlcharrefreplace"`` converts runs of
+    unencodable characters to character references in one go.
+
+        >>> _asciiShortcutEncoder("cp1252", "xmlcharrefreplace")("a\u20ac\u65e5")
+        b'a\x80&#26085;'
+        >>> _asciiShortcutEncoder("utf-8", "strict") is None
+        True
+    """
+    import codecs
+
+    isAscii = getattr(unicode_type, "isascii", None)
+    if (isAscii is None) or (codecs.lookup(encoding).name in _FAST_ENCODINGS):
+        return None
+    asciiText = "".join([chr(code) for code in range(128)])
+    asciiData = asciiText.encode("ascii")
+    try:
+        isAsciiCompatible = (asciiText.encode(encoding) == asciiData) and (asciiData.decode(encoding) == asciiText)
+    except UnicodeError:
+        isAsciiCompatible = False
+    if not isAsciiCompatible:
+        return None
+
+    def encode(text):
+        if isAscii(text):
+            result = text.encode("ascii")
+        else:
+            result = text.encode(encoding, errors)
+        return result
+    return encode
+
+# Encodings that can encode any text, so a sink that accepts text can get it
+# without encoding it first.
+_UNICODE_ENCODINGS = ("utf-8", "utf-8-sig", "utf-16", "utf-16-be", "utf-16-le", "utf-32", "utf-32-be", "utf-32-le")
+
+def _textSinkEncoder(encoding, errors):
+    """
+    Function to prepare text for a sink that accepts text so it only
+    contains characters ``encoding`` supports, handling other characters
+    according to ``errors``.
+
+        >>> _textSinkEncoder("ascii", "xmlcharrefreplace")("a\u20ac")
+        'a&#8364;'
+        >>> _textSinkEncoder("utf-8", "strict") is unicode_type
+        True
+    """
+    import codecs
+
+    if codecs.lookup(encoding).name in _UNICODE_ENCODINGS:
+        # Pass text on as is; calling `unicode_type` on it is cheaper than
+        # calling a function that returns it.
+        result = unicode_type
+    else:
+        def result(text):
+            return text.encode(encoding, errors).decode(encoding)
+    return result
+
+# Default number of bytes `XmlWriter.deferred()` buffers in memory.
+_DEFAULT_SPOOL_SIZE = 1024 * 1024
+
+# Number of bytes collected before they are passed on to an `XmlSink` that
+# prefers large chunks.
+_SINK_CHUNK_SIZE = 64 * 1024
+
+# Number of characters of text `XmlWriterContentHandler` collects before
+# writing them.
+_TRANSFORM_TEXT_SIZE = 64 * 1024
+
+# Default number of bytes a `FragmentCache` holds.
+_DEFAULT_FRAGMENT_CACHE_SIZE = 16 * 1024 * 1024
+
+# Possible values for the option ``invalidChars``.
+_INVALID_CHARS_MODES = ("error", "replace", "strip")
+
+def _invalidCharacterSanitizers(invalidChars, version):
+    """
+    Functions ``(sanitizeEscaped, sanitizeUnescaped, sanitizeRaw)`` that
+    handle characters that must not occur in XML ``version`` as described by
+    ``invalidChars``:
+
+    * ``sanitizeEscaped`` is for escaped text and attribute values, where
+      XML 1.1 allows control characters as character references.
+    * ``sanitizeUnescaped`` is for text that still has to be escaped and
+      keeps control characters allowed as character references.
+    * ``sanitizeRaw`` is for text without references like comments.
+
+    The functions only scan text without invalid characters once using a
+    precompiled regular expression and return it unchanged.
+
+        >>> sanitizeEscaped, sanitizeUnescaped, sanitizeRaw = _invalidCharacterSanitizers("strip", "1.1")
+        >>> sanitizeEscaped("a\\x00b\\x1bc")
+        'ab&#x1B;c'
+        >>> sanitizeUnescaped("a\\x00b\\x1bc")
+        'ab\\x1bc'
+        >>> sanitizeRaw("a\\x00b\\x1bc")
+        'abc'
+    """
+    import re
+
+    assert invalidChars in _INVALID_CHARS_MODES, invalidChars
+    invalidRanges = ["\x00-\x08", "\x0b", "\x0c", "\x0e-\x1f", "\ufffe", "\uffff"]
+    if sys.maxunicode > 0xffff:
+        # Surrogates cannot occur in XML, so treat them as invalid. Narrow
+        # builds of Python 2 skip this because they represent characters
+        # outside of the basic multilingual plane as surrogate pairs.
+        invalidRanges.append("\ud800-\udfff")
+    restrictedCharacters = set()
+    if version == "1.1":
+        restrictedCodes = list(range(0x01, 0x09)) + [0x0b, 0x0c] + list(range(0x0e, 0x20)) \
+            + list(range(0x7f, 0x85)) + list(range(0x86, 0xa0))
+        restrictedCharacters.update(["%c" % code for code in restrictedCodes])
+        invalidRanges.extend(["\x7f-\x84", "\x86-\x9f"])
+    invalidRegex = re.compile("[%s]" % "".join(invalidRanges))
+    search = invalidRegex.search
+    sub = invalidRegex.sub
+
+    def replacement(character):
+        if invalidChars == "error":
+            raise XmlError("text must not contain character %r, which is invalid in XML %s" % (character, version))
+        elif invalidChars == "strip":
+            result = ""
+        else:
+            result = "\ufffd"
+        return result
+
+    def escapedReplacement(match):
+        character = match.group()
+        if character in restrictedCharacters:
+            result = "&#x%X;" % ord(character)
+        else:
+            result = replacement(character)
+        return result
+
+    def unescapedReplacement(match):
+        character = match.group()
+        if character in restrictedCharacters:
+            result = character
+        else:
+            result = replacement(character)
+        return result
+
+    def rawReplacement(match):
+        return replacement(match.group())
+
+    def sanitizeEscaped(text):
+        if search(text) is None:
+            return text
+        return sub(escapedReplacement, text)
+
+    def sanitizeUnescaped(text):
+        if search(text) is None:
+            return text
+        return sub(unescapedReplacement, text)
+
+    def sanitizeRaw(text):
+        if search(text) is None:
+            return text
+        return sub(rawReplacement, text)
+
+    return sanitizeEscaped, sanitizeUnescaped, sanitizeRaw
 
 def _validateNotEmpty(name, value):
     """
@@ -601,6 +1036,23 @@ def _splitPossiblyQualifiedName(name, value):
     # TODO: validate that all parts are NCNAMEs.
     return result
 
+def _splitClarkName(name):
+    """
+    A pair ``(uri, name)`` derived from ``name`` in Clark notation as used
+    by ElementTree.
+
+        >>> _splitClarkName("{http://www.w3.org/1999/xhtml}img")
+        ('http://www.w3.org/1999/xhtml', 'img')
+        >>> _splitClarkName("img")
+        (None, 'img')
+    """
+    if name[:1] == "{":
+        uri, name = name[1:].split("}", 1)
+        result = (uri or None, name)
+    else:
+        result = (None, name)
+    return result
+
 def _joinPossiblyQualifiedName(namespace, name):
     _assertIsUnicode("namespace", namespace)
     assert name
@@ -616,6 +1068,26 @@ class XmlWriter(object):
     Writer for large output in XML optionally supporting Unicode and
     namespaces.
     """
+    # Use slots to keep the memory foot print of the many short lived writers
+    # small and make attribute access in the write path fast.
+    __slots__ = (
+        "_bytePosition", "_cachedFragments", "_canonical", "_chunkByteCount", "_chunks", "_commitLock", "_concurrent",
+        "_contentHasBeenWritten", "_deferredTags", "_elementStack", "_encode", "_encoding", "_errors", "_escape",
+        "_fragmentCache", "_fragmentWriters", "_hashName", "_outputHash", "_quote",
+        "_indent", "_invalidChars", "_isOpen", "_maxBufferedByteCount", "_namespaces", "_namespacesToAdd", "_newline",
+        "_output", "_outputEncode", "_outputWrite", "_pendingPlaceholders", "_pretty",
+        "_prolog", "_sanitize",
+        "_sanitizeAttributeValue", "_sourceEncoding", "_startTagToWrite", "_version",
+        "__weakref__",
+    )
+
+    # Slots set by `_configure()` that can be shared between writers.
+    _CONFIGURATION_SLOTS = (
+        "_canonical", "_concurrent", "_encode", "_encoding", "_errors", "_escape", "_fragmentCache", "_hashName",
+        "_indent", "_invalidChars", "_newline", "_pretty", "_prolog", "_quote", "_sanitize",
+        "_sanitizeAttributeValue", "_sourceEncoding", "_version",
+    )
+
     # Marks to start/end CDATA.
     _CDATA_START = "<![CDATA["
     _CDATA_END = "]]>"
@@ -629,22 +1101,23 @@ class XmlWriter(object):
     _CLOSE_AT_START = "start"
     _CLOSE_AT_END = "end"
 
-    # Build regular expressions to validate tag and attribute names.
-    _NAME_START_CHARS = "_a-zA-Z\u00c0-\u00d6\u00d8-\u00f6\00f8-\u02ff\u0370-\u037d\u037f-\u1fff\u200c-\u200d\u2070-\u218f\u2c00-\u2fef\u3001-\ud7ff\uf900-\ufdcf\ufdf0-\ufffd"
+    # Build regular expressions to validate tag and attribute names. To keep
+    # importing loxun fast, they are compiled on first use by `_nameRegExes()`.
+    _NAME_START_CHARS = "_a-zA-Z\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u02ff\u0370-\u037d\u037f-\u1fff\u200c-\u200d\u2070-\u218f\u2c00-\u2fef\u3001-\ud7ff\uf900-\ufdcf\ufdf0-\ufffd"
     _NAME_CHARS = "\\-\\.0-9" + _NAME_START_CHARS + "\\u00b7\\u0300-\\u036f\\u203f-\\u2040"
     _NAME_START_CHAR_PATTERN = "[" + _NAME_START_CHARS + "]"
     _NAME_CHAR_PATTERN = "[" + _NAME_CHARS + "]"
-    _nameStartCharRegEx = re.compile(_NAME_START_CHAR_PATTERN, re.UNICODE)
-    _nameCharRegEx = re.compile(_NAME_START_CHAR_PATTERN, re.UNICODE)
+    _nameRegExesCache = None
 
-    def __init__(self, output, pretty=True, indent="  ", newline=os.linesep, encoding="utf-8", errors="strict", prolog=True, version="1.0", sourceEncoding="ascii"):
+    def __init__(self, output, pretty=True, indent="  ", newline=os.linesep, encoding="utf-8", errors="strict", prolog=True, version="1.0", sourceEncoding="ascii", canonical=False, hashName=None, invalidChars=None, fragmentCache=None, concurrent=False):
         """
         Initialize ``XmlWriter`` writing to ``output``.
 
         The ``output`` can be anything that has a ``write(data)`` method,
         typically a filelike object. The writer accesses the ``output`` as
         stream, so it does not have to support any methods for random
-        access like ``seek()``.
+        access like ``seek()``. To write to file descriptors, sockets or
+        text streams, use one of the `XmlSink` classes, see `Output sinks`_.
 
         In case you write to a file, use ``"wb"`` as ``mode`` for ``open()``
         to prevent messed up newlines.
@@ -675,28 +1148,87 @@ class XmlWriter(object):
 
         Set ``sourceEncoding`` to the name of the encoding that plain 8 bit
         strings passed as parameters use.
+
+        Set ``canonical`` to ``True`` to write canonical XML as described in
+        <http://www.w3.org/TR/xml-c14n>, see `Canonical XML`_ for details.
+
+        Set ``hashName`` to the name of a hash algorithm supported by
+        ``hashlib.new()``, for example ``"sha256"``, to compute a hash of
+        all bytes written while writing them. See also `outputHash`.
+
+        Set ``invalidChars`` to specify what to do with characters that must
+        not occur in XML, for example control characters like ``"\\x00"``
+        from dirty data. Possible values are:
+
+        * ``None``: write them, which results in XML that cannot be parsed;
+          this is the default.
+        * ``"error"``: raise an `XmlError`.
+        * ``"strip"``: remove them.
+        * ``"replace"``: replace them by the Unicode replacement character
+          ``"\\ufffd"``.
+
+        With ``version="1.1"``, control characters other than ``"\\x00"`` are
+        written as character references in text and attribute values, where
+        XML 1.1 allows them.
+
+        Set ``fragmentCache`` to a `FragmentCache` to store sections
+        written using `cached()`.
+
+        Set ``concurrent`` to ``True`` to let several threads write to the
+        document at the same time using `fragment()`.
+        """
+        self._configure(pretty, indent, newline, encoding, errors, prolog, version, sourceEncoding, canonical, hashName, invalidChars, fragmentCache, concurrent)
+        self.reset(output)
+
+    def _configure(self, pretty=True, indent="  ", newline=os.linesep, encoding="utf-8", errors="strict", prolog=True, version="1.0", sourceEncoding="ascii", canonical=False, hashName=None, invalidChars=None, fragmentCache=None, concurrent=False):
+        """
+        Validate the settings and compute everything that does not depend on
+        the actual output, in particular the encoded prolog.
         """
-        assert output is not None
         assert encoding
         assert errors
         assert sourceEncoding
         _validateNotNoneOrEmpty("version", version)
-        self._output = output
+        if canonical:
+            if encoding.lower().replace("_", "-") not in ("utf-8", "utf8"):
+                raise XmlError("encoding for canonical XML must be %r but is %r" % ("utf-8", encoding))
+            pretty = False
+            prolog = False
+            newline = "\n"
+            self._escape = _canonicalEscaped
+            self._quote = _canonicalQuoted
+        else:
+            self._escape = _escaped
+            self._quote = _quoted
+        if invalidChars is None:
+            self._sanitize = None
+            self._sanitizeAttributeValue = None
+        else:
+            assert invalidChars in _INVALID_CHARS_MODES, \
+                "`invalidChars` is %r but must be one of: %s" % (invalidChars, _INVALID_CHARS_MODES)
+            uniVersion = self._unicodedFromString(version)
+            sanitizeEscaped, self._sanitizeAttributeValue, self._sanitize = \
+                _invalidCharacterSanitizers(invalidChars, uniVersion)
+            # Sanitize after escaping so character references remain intact.
+            escape = self._escape
+            self._escape = lambda text: sanitizeEscaped(escape(text))
+            if uniVersion == "1.1":
+                # Attribute values already are sanitized by `startTag()` and
+                # `tag()` except for control characters that need references.
+                quote = self._quote
+                self._quote = lambda value: sanitizeEscaped(quote(value))
+        self._canonical = canonical
+        self._invalidChars = invalidChars
+        self._version = self._unicodedFromString(version)
+        self._concurrent = concurrent
+        self._fragmentCache = fragmentCache
+        self._hashName = hashName
         self._pretty = pretty
         self._sourceEncoding = sourceEncoding
         self._encoding = self._unicodedFromString(encoding)
         self._errors = self._unicodedFromString(errors)
-        self._namespaces = {}
-        self._elementStack = collections.deque()
-        self._namespacesToAdd = collections.deque()
-        self._isOpen = True
-        self._contentHasBeenWritten = False
+        self._encode = _asciiShortcutEncoder(self._encoding, self._errors)
         self._indent = self._unicodedFromString(indent)
-
-        # `None` or a tuple of (indent, qualifiedTagName, attributes).
-        # See also: `_possiblyWriteTag()`.
-        self._startTagToWrite = None
-
         indentWithoutWhiteSpace = self._indent.replace(" ", "").replace("\t", "")
         assert not indentWithoutWhiteSpace, \
             "`indent` must contain only blanks or tabs but also has: %r" % indentWithoutWhiteSpace
@@ -705,10 +1237,138 @@ class XmlWriter(object):
         assert self._newline in _VALID_NEWLINES, \
             "`newline` is %r but must be one of: %s" % (self._newline, _VALID_NEWLINES)
         if prolog:
-            self.processingInstruction("xml", "version=%s encoding=%s" % ( \
+            prologText = "%sxml version=%s encoding=%s%s" % (
+                XmlWriter._PROCESSING_START,
                 _quoted(self._unicodedFromString(version)),
-                _quoted(self._encoding))
+                _quoted(self._encoding),
+                XmlWriter._PROCESSING_END
             )
+            if self._pretty:
+                prologText += self._newline
+            self._prolog = self._encoded(prologText)
+        else:
+            self._prolog = None
+
+    def _configureLike(self, template):
+        """
+        Use the same settings as the already configured writer ``template``.
+        """
+        for name in self._CONFIGURATION_SLOTS:
+            setattr(self, name, getattr(template, name))
+
+    def reset(self, output):
+        """
+        Reset the writer to start a new document on ``output`` using the same
+        settings as before, including writing the XML prolog.
+
+        This is cheaper than creating a new writer because all settings have
+        already been converted and validated. Typically you would reset a
+        writer after it has been closed, but any unfinished document is
+        discarded too.
+
+            >>> import io
+            >>> xml = XmlWriter(io.BytesIO(), pretty=False, prolog=False)
+            >>> xml.tag("a")
+            >>> xml.close()
+            >>> out = io.BytesIO()
+            >>> xml.reset(out)
+            >>> xml.tag("b")
+            >>> xml.close()
+            >>> out.getvalue()
+            b'<b/>'
+        """
+        if output is None:
+            raise XmlError("output must be specified to write with %s" % type(self).__name__)
+        if getattr(self, "_chunks", None):
+            # Pass on the fragments collected for the previous output like
+            # any other output already would have gotten them.
+            self._writeChunks()
+        # `_bindOutput()` changes these for sinks; see `XmlSink`.
+        self._outputEncode = self._encode
+        self._chunks = None
+        self._chunkByteCount = 0
+        self._bindOutput(output)
+        if self._hashName is not None:
+            self._validateOutputTakesBytes("hashName")
+            import hashlib
+            self._outputHash = hashlib.new(self._hashName)
+            self._outputWrite = _hashingWrite(self._outputWrite, self._outputHash)
+        else:
+            self._outputHash = None
+        self._namespaces = {}
+        self._elementStack = collections.deque()
+        self._namespacesToAdd = collections.deque()
+        self._isOpen = True
+        self._contentHasBeenWritten = False
+        self._bytePosition = 0
+        self._deferredTags = []
+        self._cachedFragments = []
+        self._maxBufferedByteCount = 0
+        if self._concurrent:
+            import threading
+            self._commitLock = threading.Lock()
+            # Writers for `fragment()` that each thread can reuse.
+            self._fragmentWriters = threading.local()
+        else:
+            self._commitLock = None
+            self._fragmentWriters = None
+        self._pendingPlaceholders = {}
+
+        # `None` or a tuple of (depth, qualifiedTagName, attributes).
+        # See also: `_possiblyWriteTag()`.
+        self._startTagToWrite = None
+
+        if self._prolog is not None:
+            prolog = self._prolog
+            if getattr(self._output, "acceptsText", False):
+                prolog = prolog.decode(self._encoding)
+            self._outputWrite(prolog)
+            self._bytePosition = len(prolog)
+            self._contentHasBeenWritten = True
+
+    def _bindOutput(self, output):
+        self._output = output
+        if getattr(output, "acceptsText", False):
+            self._outputEncode = _textSinkEncoder(self._encoding, self._errors)
+        if getattr(output, "prefersLargeChunks", False):
+            self._chunks = []
+            self._outputWrite = self._writeToChunks
+        else:
+            # Bind the output's write method once instead of looking it up
+            # for every fragment written.
+            self._outputWrite = output.write
+
+    def _writeToChunks(self, data):
+        self._chunks.append(data)
+        self._chunkByteCount += len(data)
+        if self._chunkByteCount >= _SINK_CHUNK_SIZE:
+            self._writeChunks()
+
+    def _writeChunks(self):
+        """
+        Pass the fragments collected for a sink that prefers large chunks
+        on to its ``writev()``.
+        """
+        chunks = self._chunks
+        if chunks:
+            self._chunks = []
+            self._chunkByteCount = 0
+            self._output.writev(chunks)
+
+    def _validateOutputTakesBytes(self, feature):
+        if getattr(self._output, "acceptsText", False):
+            raise XmlError("%s requires an output that takes bytes but %r accepts text" % (feature, self._output))
+
+    def flush(self):
+        """
+        Write the fragments collected for an `XmlSink` that prefers large
+        chunks to it and flush the ``output``. A start tag that might still
+        be optimized to an empty tag is not written yet.
+        """
+        self._writeChunks()
+        flush = getattr(self._output, "flush", None)
+        if flush is not None:
+            flush()
 
     def __enter__(self):
         return self
@@ -737,13 +1397,77 @@ class XmlWriter(object):
         """The stream where the output goes."""
         return self._output
 
+    @property
+    def isCanonical(self):
+        """Write canonical XML?"""
+        return self._canonical
+
+    @property
+    def outputHash(self):
+        """
+        The ``hashlib`` object that has been fed with all bytes written so
+        far or ``None`` if no ``hashName`` was specified.
+
+            >>> import io
+            >>> xml = XmlWriter(io.BytesIO(), pretty=False, prolog=False, hashName="sha1")
+            >>> xml.tag("a")
+            >>> xml.close()
+            >>> xml.outputHash.hexdigest()
+            'db9aa86632c6f2cc99684a2dd15d2b64828e7622'
+        """
+        return self._outputHash
+
+    @property
+    def bytePosition(self):
+        """
+        The number of bytes written to the ``output`` since the writer was
+        created or reset. A start tag that might still be optimized to an
+        empty tag is not included until it actually has been written. For
+        an output that accepts text, this is the number of characters.
+        """
+        return self._bytePosition
+
+    @property
+    def bufferedByteCount(self):
+        """
+        The number of bytes written within `deferred()` and `cached()`
+        blocks that the writer currently holds in memory or temporary files
+        until the block ends. Otherwise, the writer only holds the few
+        bytes of the current tag.
+        """
+        startPositions = [
+            buffering._bytePosition for buffering in self._deferredTags[:1] + self._cachedFragments[:1]]
+        if startPositions:
+            result = self._bytePosition - min(startPositions)
+        else:
+            result = 0
+        return result
+
+    @property
+    def maxBufferedByteCount(self):
+        """
+        The highest `bufferedByteCount` since the writer was created or
+        reset, which tells how much memory or temporary disk space
+        `deferred()` and `cached()` needed.
+        """
+        return self._maxBufferedByteCount
+
+    def _updateMaxBufferedByteCount(self):
+        # Buffers only grow until their block ends, so it is enough to call
+        # this right before releasing one.
+        self._maxBufferedByteCount = max(self._maxBufferedByteCount, self.bufferedByteCount)
+
     def _scope(self):
         return len(self._elementStack)
 
     def _encoded(self, text):
         assert text is not None
         _assertIsUnicode("text", text)
-        return text.encode(self._encoding, self._errors)
+        if self._encode is None:
+            result = text.encode(self._encoding, self._errors)
+        else:
+            result = self._encode(text)
+        return result
 
     def _unicodedFromString(self, text):
         """
@@ -834,6 +1558,20 @@ class XmlWriter(object):
                     self._raiseStrOrUnicodeBroken("unicode", some, error)
         return result
 
+    @staticmethod
+    def _nameRegExes():
+        """
+        Pair of compiled regular expressions ``(nameStartChar, nameChar)``
+        to validate tag and attribute names.
+        """
+        if XmlWriter._nameRegExesCache is None:
+            import re
+            XmlWriter._nameRegExesCache = (
+                re.compile(XmlWriter._NAME_START_CHAR_PATTERN, re.UNICODE),
+                re.compile(XmlWriter._NAME_CHAR_PATTERN, re.UNICODE),
+            )
+        return XmlWriter._nameRegExesCache
+
     def _isNameStartChar(self, some):
         """
         NameStartChar ::= ":" | [A-Z] | "_" | [a-z] | [#xC0-#xD6] | [#xD8-#xF6]
@@ -865,27 +1603,27 @@ class XmlWriter(object):
             raise XmlError("operation must be performed before writer is closed")
 
     def _validateNamespaceItem(self, itemName, namespace, qualifiedName):
-        if namespace:
-            namespaceFound = False
-            scopeIndex = self._scope()
-            while not namespaceFound and (scopeIndex >= 0):
-                namespacesForScope = self._namespaces.get(scopeIndex)
-                if namespacesForScope:
-                    if namespace in [namespaceToCompareWith for namespaceToCompareWith, _ in namespacesForScope]:
-                        namespaceFound = True
-                scopeIndex -= 1
-            if not namespaceFound:
-                if namespace == "xmlns":
-                    # TODO: raise XmlError("namespace '%s' must be added using `addNamespace()`.")
-                    pass
-                else:
-                    raise XmlError("namespace '%s' for %s '%s' must be added before use" % (namespace, itemName, qualifiedName))
+        # Namespaces still to be added count too because they will be declared
+        # by the tag currently written. The "xml" prefix is bound by
+        # definition.
+        if namespace and (self._namespaceUri(namespace) is None):
+            if namespace == "xmlns":
+                # TODO: raise XmlError("namespace '%s' must be added using `addNamespace()`.")
+                pass
+            else:
+                raise XmlError("namespace '%s' for %s '%s' must be added before use" % (namespace, itemName, qualifiedName))
 
     def _write(self, text):
         assert text is not None
         _assertIsUnicode("text", text)
-        self._output.write(self._encoded(text))
-        if not self._contentHasBeenWritten and text:
+        if text:
+            encode = self._outputEncode
+            if encode is None:
+                data = text.encode(self._encoding, self._errors)
+            else:
+                data = encode(text)
+            self._outputWrite(data)
+            self._bytePosition += len(data)
             self._contentHasBeenWritten = True
 
     def _writeIndent(self):
@@ -902,7 +1640,7 @@ class XmlWriter(object):
     def _writeEscaped(self, text):
         assert text is not None
         _assertIsUnicode("text", text)
-        self._write(xml.sax.saxutils.escape(text))
+        self._write(_escaped(text))
 
     def newline(self):
         self._possiblyFlushTag()
@@ -918,12 +1656,11 @@ class XmlWriter(object):
         _validateNotNoneOrEmpty("uri", uri)
         uniName = self._unicodedFromString(name)
         uniUri = self._unicodedFromString(uri)
-        namespacesForScope = self._namespaces.get(self._scope())
-        namespaceExists = (uniName in self._namespacesToAdd) or (
-            (namespacesForScope != None) and (uniName in namespacesForScope)
-        )
-        if namespaceExists:
-            raise XmlError("namespace %r must added only once for current scope but already is %r" % (uniName, uniUri))
+        namespacesForScope = self._namespaces.get(self._scope(), [])
+        existingNames = [existingName for existingName, _ in self._namespacesToAdd]
+        existingNames.extend([existingName for existingName, _ in namespacesForScope])
+        if uniName in existingNames:
+            raise XmlError("namespace %r must added only once for current scope" % uniName)
         self._namespacesToAdd.append((uniName, uniUri))
 
     def _possiblyWriteTag(self, namespace, name, close, attributes={}):
@@ -934,7 +1671,15 @@ class XmlWriter(object):
         assert close in (XmlWriter._CLOSE_NONE, XmlWriter._CLOSE_AT_START, XmlWriter._CLOSE_AT_END)
         assert attributes is not None
 
-        actualAttributes = {}
+        # Validate all names before changing any namespace scopes so a broken
+        # tag leaves the writer unchanged.
+        self._validateNamespaceItem("tag", namespace, name)
+        convertedAttributes = self._convertedAttributes(attributes)
+
+        if convertedAttributes or self._namespacesToAdd:
+            actualAttributes = {}
+        else:
+            actualAttributes = _NO_ATTRIBUTES
 
         # TODO: Validate that no "xmlns" attributes are specified by hand.
 
@@ -942,7 +1687,10 @@ class XmlWriter(object):
         if close in [XmlWriter._CLOSE_NONE, XmlWriter._CLOSE_AT_END]:
             while self._namespacesToAdd:
                 namespaceName, uri = self._namespacesToAdd.pop()
-                if namespaceName:
+                if self._canonical and (self._namespaceUri(namespaceName) == uri):
+                    # Canonical XML omits superfluous namespace declarations.
+                    pass
+                elif namespaceName:
                     actualAttributes["xmlns:%s" % namespaceName] = uri
                 else:
                     actualAttributes["xmlns"] = uri
@@ -958,28 +1706,20 @@ class XmlWriter(object):
                 namespaceNames = ", ".join([name for name, _ in self._namespacesToAdd])
                 raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
 
-        # Convert attributes to unicode.
-        for qualifiedAttributeName, attributeValue in list(attributes.items()):
-            uniQualifiedAttributeName = self._unicodedFromString(qualifiedAttributeName)
-            attributeNamespace, attributeName = _splitPossiblyQualifiedName("attribute name", uniQualifiedAttributeName)
-            self._validateNamespaceItem("attribute", attributeNamespace, attributeName)
-            actualAttributes[uniQualifiedAttributeName] = self._unicoded(attributeValue)
+        if convertedAttributes:
+            actualAttributes.update(convertedAttributes)
 
-        # Prepare indentation and qualified tag name to be written.
-        if self.isPretty:
-            indent = self._indent * len(self._elementStack)
-        else:
-            indent = ""
-        self._validateNamespaceItem("tag", namespace, name)
+        # Prepare nesting depth and qualified tag name to be written.
+        depth = len(self._elementStack)
         if namespace:
             qualifiedTagName = "%s:%s" % (namespace, name)
         else:
             qualifiedTagName = name
 
         if close == XmlWriter._CLOSE_NONE:
-            self._startTagToWrite = (indent, qualifiedTagName, actualAttributes)
+            self._startTagToWrite = (depth, qualifiedTagName, actualAttributes)
         else:
-            self._actuallyWriteTag(indent, qualifiedTagName, actualAttributes, close)
+            self._actuallyWriteTag(depth, qualifiedTagName, actualAttributes, close)
 
         # Process name spaces to remove
         if close in [XmlWriter._CLOSE_AT_END, XmlWriter._CLOSE_AT_START]:
@@ -987,47 +1727,129 @@ class XmlWriter(object):
             if scopeToRemove in self._namespaces:
                 del self._namespaces[scopeToRemove]
 
-    def _actuallyWriteTag(self, indent, qualifiedTagName, attributes, close):
+    def _convertedAttributes(self, attributes):
+        """
+        List of pairs of unicode names and values for ``attributes`` after
+        validating their namespaces.
+        """
+        result = []
+        namespacedAttributeNames = None
+        for qualifiedAttributeName, attributeValue in attributes.items():
+            uniQualifiedAttributeName = self._unicodedFromString(qualifiedAttributeName)
+            attributeNamespace, attributeName = _splitPossiblyQualifiedName("attribute name", uniQualifiedAttributeName)
+            if attributeNamespace:
+                self._validateNamespaceItem("attribute", attributeNamespace, attributeName)
+                # Different prefixes can refer to the same namespace URI.
+                namespacedAttributeName = (self._namespaceUri(attributeNamespace), attributeName)
+                if namespacedAttributeNames is None:
+                    namespacedAttributeNames = set()
+                elif namespacedAttributeName in namespacedAttributeNames:
+                    raise XmlError("attribute %r must not have the same name and namespace URI as another attribute" % uniQualifiedAttributeName)
+                namespacedAttributeNames.add(namespacedAttributeName)
+            uniAttributeValue = self._unicoded(attributeValue)
+            if self._sanitizeAttributeValue is not None:
+                uniAttributeValue = self._sanitizeAttributeValue(uniAttributeValue)
+            result.append((uniQualifiedAttributeName, uniAttributeValue))
+        return result
+
+    def _actuallyWriteTag(self, depth, qualifiedTagName, attributes, close):
         assert self._startTagToWrite is None
-        assert indent is not None
-        _assertIsUnicode("indent", indent)
+        assert depth >= 0
         assert qualifiedTagName
         _assertIsUnicode("qualifiedTagName", qualifiedTagName)
         assert close
         assert close in (XmlWriter._CLOSE_NONE, XmlWriter._CLOSE_AT_START, XmlWriter._CLOSE_AT_END)
         assert attributes is not None
-        if self._pretty:
-            self._write(indent)
-        self._write("<")
+        # Collect all parts of the tag and write them at once.
+        pretty = self._pretty
+        if pretty:
+            parts = [self._indent * depth]
+        else:
+            parts = []
         if close == XmlWriter._CLOSE_AT_START:
-            self._write("/")
-        self._write(qualifiedTagName)
-        for attributeName in sorted(attributes.keys()):
-            _assertIsUnicode("attribute name", attributeName)
-            value = attributes[attributeName]
-            _assertIsUnicode("value of attribute %r" % attributeName, value)
-            self._write(" %s=%s" % (attributeName, _quoted(value)))
+            parts.append("</")
+        else:
+            parts.append("<")
+        parts.append(qualifiedTagName)
+        if not attributes:
+            pass
+        elif self._pendingPlaceholders:
+            self._appendAttributesAndPlaceholders(parts, self._sortedAttributeNames(attributes), attributes)
+        else:
+            quote = self._quote
+            for attributeName in self._sortedAttributeNames(attributes):
+                _assertIsUnicode("attribute name", attributeName)
+                value = attributes[attributeName]
+                _assertIsUnicode("value of attribute %r" % attributeName, value)
+                parts.append(" %s=%s" % (attributeName, quote(value)))
         if close == XmlWriter._CLOSE_AT_END:
-            if self.isPretty:
-                self._write(" ")
-            self._write("/")
-        self._write(">")
-        if self._pretty:
-            self.newline()
+            if self._canonical:
+                parts.append("></%s>" % qualifiedTagName)
+            elif pretty:
+                parts.append(" />")
+            else:
+                parts.append("/>")
+        else:
+            parts.append(">")
+        if pretty:
+            parts.append(self._newline)
+        self._write("".join(parts))
+
+    def _sortedAttributeNames(self, attributes):
+        if self._canonical:
+            result = sorted(attributes, key=lambda name: self._canonicalAttributeKey(name, attributes))
+        else:
+            result = sorted(attributes)
+        return result
+
+    def _appendAttributesAndPlaceholders(self, parts, attributeNames, attributes):
+        """
+        Same as appending the attributes in `_actuallyWriteTag()` but also
+        reserve space for placeholders and remember where it is located in
+        the output.
+        """
+        quote = self._quote
+        for attributeName in attributeNames:
+            placeholder = self._pendingPlaceholders.get(attributeName)
+            if placeholder is None:
+                parts.append(" %s=%s" % (attributeName, quote(attributes[attributeName])))
+            else:
+                parts.append(" %s=" % attributeName)
+                placeholder._position = self._output.tell() + self._chunkByteCount + len(self._encoded("".join(parts)))
+                parts.append(placeholder._emptyText())
+        self._pendingPlaceholders = {}
+
+    def _canonicalAttributeKey(self, attributeName, attributes):
+        """
+        Key to sort attributes in canonical XML: namespace declarations come
+        first, ordered by name, followed by the other attributes, ordered by
+        namespace URI and local name.
+        """
+        namespace, _, localName = attributeName.rpartition(":")
+        if attributeName == "xmlns":
+            result = (0, "", "")
+        elif namespace == "xmlns":
+            result = (0, "", localName)
+        elif namespace:
+            uri = attributes.get("xmlns:" + namespace) or self._namespaceUri(namespace)
+            result = (1, uri, localName)
+        else:
+            result = (1, "", localName)
+        return result
 
     def _possiblyFlushTag(self):
         """
         If ``self._startTagToWrite`` is set, it contains a tuple
-        ``(indent, qualifiedTagName, attributes)`` describing a start tag that has not
+        ``(depth, qualifiedTagName, attributes)`` describing a start tag that has not
         been written yet. In this case, write the tag now and set
         ``self._startTagToWrite`` to ``None``. This allows to optimize a sequence
         of ``startTag()``/ ``endTag()`` with the same tag to be changed to
         a simple ``tag()``.
         """
         if self._startTagToWrite:
-            indent, qualifiedTagName, attributes = self._startTagToWrite;
+            depth, qualifiedTagName, attributes = self._startTagToWrite
             self._startTagToWrite = None
-            self._actuallyWriteTag(indent, qualifiedTagName, attributes, XmlWriter._CLOSE_NONE)
+            self._actuallyWriteTag(depth, qualifiedTagName, attributes, XmlWriter._CLOSE_NONE)
 
     def startTag(self, qualifiedName, attributes={}):
         """
@@ -1094,6 +1916,9 @@ class XmlWriter(object):
                 ...
             XmlError: tag stack must not be empty
         """
+        if self._namespacesToAdd:
+            namespaceNames = ", ".join([name for name, _ in self._namespacesToAdd])
+            raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
         try:
             (namespace, name) = self._elementStack.pop()
         except IndexError:
@@ -1224,15 +2049,18 @@ class XmlWriter(object):
         """
         self._possiblyFlushTag()
         _validateNotNone("text", text)
-        uniText = self._unicodedFromString(text)
+        self._writeText(self._unicodedFromString(text))
+
+    def _writeText(self, uniText):
         if self._pretty:
-            for uniLine in io.StringIO(uniText):
-                self._writeIndent()
-                uniLine = uniLine.lstrip(" \t").rstrip(" \t\r\n")
-                self._writeEscaped(uniLine)
-                self.newline()
+            # Indent and escape all lines at once instead of line by line.
+            lines = _splitLines(uniText)
+            if lines:
+                indent = self._indent * len(self._elementStack)
+                strippedLines = [line.lstrip(" \t").rstrip(" \t\r") for line in lines]
+                self._write(indent + self._escape((self._newline + indent).join(strippedLines)) + self._newline)
         else:
-            self._writeEscaped(uniText)
+            self._write(self._escape(uniText))
 
 
     def comment(self, text, embedInBlanks=True):
@@ -1276,10 +2104,17 @@ class XmlWriter(object):
         """
         self._possiblyFlushTag()
         uniText = self._unicodedFromString(text)
+        if self._sanitize is not None:
+            uniText = self._sanitize(uniText)
         if not embedInBlanks and not uniText:
             raise XmlError("text for comment must not be empty, or option embedInBlanks=True must be set")
         if "--" in uniText:
             raise XmlError("text for comment must not contain \"--\"")
+        if not embedInBlanks and uniText.endswith("-"):
+            raise XmlError("text for comment must not end with \"-\" unless option embedInBlanks=True is set")
+        self._writeComment(uniText, embedInBlanks)
+
+    def _writeComment(self, uniText, embedInBlanks):
         hasNewline = ("\n" in uniText) or ("\r" in uniText)
         hasStartBlank = uniText and uniText[0].isspace()
         hasEndBlank = (len(uniText) > 1) and uniText[-1].isspace()
@@ -1290,11 +2125,14 @@ class XmlWriter(object):
                 self.newline()
             elif embedInBlanks and not hasStartBlank:
                 self._write(" ")
-            for uniLine in io.StringIO(uniText):
+            lines = _splitLines(uniText)
+            if lines:
                 if self._pretty:
-                    self._writeIndent()
-                self._writeEscaped(uniLine.rstrip("\n\r"))
-                self.newline()
+                    indent = self._indent * len(self._elementStack)
+                else:
+                    indent = ""
+                strippedLines = [line.rstrip("\r") for line in lines]
+                self._write(indent + _escaped((self._newline + indent).join(strippedLines)) + self._newline)
             self._writePrettyIndent()
         else:
             if embedInBlanks and not hasStartBlank:
@@ -1350,14 +2188,23 @@ class XmlWriter(object):
             >>> print out.getvalue().rstrip("\\r\\n")
             <?xsl-stylesheet href="some.xsl" type="text/xml"?>
         """
-        self._possiblyFlushTag()
-        targetName = "target for processing instrution"
-        _validateNotNone(targetName, text)
-        _validateNotEmpty(targetName, text)
+        targetName = "target for processing instruction"
+        _validateNotNoneOrEmpty(targetName, target)
+        _validateNotNone("text for processing instruction", text)
+        uniTarget = self._unicodedFromString(target)
+        if uniTarget.lower() == "xml":
+            raise XmlError("%s must not be %r" % (targetName, uniTarget))
+        self._writeProcessingInstruction(uniTarget, text)
+
+    def _writeProcessingInstruction(self, target, data):
+        """
+        Same as `processingInstruction()` but ``data`` can be empty or
+        ``None``.
+        """
         uniFullText = self._unicodedFromString(target)
-        if text:
-            uniFullText += " "
-            uniFullText += self._unicodedFromString(text)
+        if data:
+            uniFullText += " " + self._unicodedFromString(data)
+        self._possiblyFlushTag()
         self._rawBlock("processing instruction", XmlWriter._PROCESSING_START, XmlWriter._PROCESSING_END, uniFullText)
 
     def _rawBlock(self, name, start, end, text):
@@ -1366,8 +2213,17 @@ class XmlWriter(object):
         _assertIsUnicode("end", end)
         _validateNotNone("text for %s" % name, text)
         uniText = self._unicodedFromString(text)
+        if self._sanitize is not None:
+            uniText = self._sanitize(uniText)
         if end in uniText:
             raise XmlError("text for %s must not contain \"%s\"" % (name, end))
+        self._writeRawBlock(start, uniText, end)
+
+    def _writeRawBlock(self, start, uniText, end):
+        if self._canonical and (start == XmlWriter._CDATA_START):
+            # Canonical XML replaces CDATA sections by their escaped text.
+            self._write(self._escape(uniText))
+            return
         self._writePrettyIndent()
         self._write(start)
         self._write(uniText)
@@ -1403,12 +2259,612 @@ class XmlWriter(object):
         uniText = self._unicodedFromString(text)
         self._write(uniText)
 
-    def close(self):
+    def _namespaceUri(self, name):
         """
-        Close the writer, validate that all started elements have ended and
-        prevent further output.
-
-        Using a writer like
+        The URI of the namespace ``name`` in the current scope or ``None`` if
+        no such namespace has been added.
+        """
+        for namespaceName, uri in self._namespacesToAdd:
+            if namespaceName == name:
+                return uri
+        for scope in range(self._scope(), -1, -1):
+            for namespaceName, uri in self._namespaces.get(scope, ()):
+                if namespaceName == name:
+                    return uri
+        if name == "xml":
+            return _XML_NAMESPACE_URI
+        return None
+
+    def _namespaceNameFor(self, uri):
+        """
+        The name of a namespace in the current scope that refers to ``uri``
+        or ``None`` if no such namespace has been added.
+        """
+        if uri == _XML_NAMESPACE_URI:
+            return "xml"
+        for namespaceName, namespaceUri in self._namespacesToAdd:
+            if namespaceUri == uri:
+                return namespaceName
+        for scope in range(self._scope(), -1, -1):
+            for namespaceName, namespaceUri in self._namespaces.get(scope, ()):
+                # Ignore names that have been redefined in an inner scope.
+                if (namespaceUri == uri) and (self._namespaceUri(namespaceName) == uri):
+                    return namespaceName
+        return None
+
+    def _qualifiedNameFromClark(self, name):
+        """
+        The qualified name for ``name`` in Clark notation. If the URI of the
+        namespace has not been added yet, add it using a name like "ns0".
+        """
+        uri, localName = _splitClarkName(name)
+        if uri is None:
+            result = localName
+        else:
+            namespaceName = self._namespaceNameFor(uri)
+            if namespaceName is None:
+                namespaceIndex = 0
+                namespaceName = "ns0"
+                while self._namespaceUri(namespaceName) is not None:
+                    namespaceIndex += 1
+                    namespaceName = "ns%d" % namespaceIndex
+                self.addNamespace(namespaceName, uri)
+            result = "%s:%s" % (namespaceName, localName)
+        return result
+
+    def _startTagFromClark(self, name, attributes):
+        """
+        Same as `startTag()` but with tag and attribute names in Clark
+        notation.
+        """
+        qualifiedName = self._qualifiedNameFromClark(name)
+        qualifiedAttributes = {}
+        for attributeName, attributeValue in attributes.items():
+            qualifiedAttributes[self._qualifiedNameFromClark(attributeName)] = attributeValue
+        self.startTag(qualifiedName, qualifiedAttributes)
+
+    def _elementText(self, text):
+        """
+        Write ``text`` obtained from an ElementTree element, ignoring
+        formatting white space if pretty printing is enabled.
+        """
+        if text and not (self._pretty and text.isspace()):
+            self.text(text)
+
+    def element(self, element):
+        """
+        Write ``element``, which is a ``xml.etree.ElementTree.Element`` (or
+        behaves like one), including all its children.
+
+            >>> import io
+            >>> from xml.etree import ElementTree
+            >>> out = io.BytesIO()
+            >>> xml = XmlWriter(out, pretty=False, prolog=False)
+            >>> xml.addNamespace("xhtml", "http://www.w3.org/1999/xhtml")
+            >>> xml.startTag("xhtml:html")
+            >>> body = ElementTree.fromstring('<body xmlns="http://www.w3.org/1999/xhtml">Hello <b>world</b>!</body>')
+            >>> xml.element(body)
+            >>> xml.endTag()
+            >>> xml.close()
+            >>> out.getvalue()
+            b'<xhtml:html xmlns:xhtml="http://www.w3.org/1999/xhtml"><xhtml:body>Hello <xhtml:b>world</xhtml:b>!</xhtml:body></xhtml:html>'
+
+        Names in Clark notation like ``{http://www.w3.org/1999/xhtml}body``
+        use the namespaces added before. Namespaces not added yet are added
+        automatically using names like "ns0".
+
+        The ``tail`` of ``element`` itself is not written, only the tails of
+        its children. If pretty printing is enabled, text that consists only
+        of white space is ignored.
+
+        The elements are traversed iteratively, so even deeply nested
+        elements do not exceed the recursion limit.
+        """
+        from xml.etree import ElementTree
+
+        todo = [(_ELEMENT_START, element)]
+        while todo:
+            action, item = todo.pop()
+            if action == _ELEMENT_START:
+                tag = item.tag
+                if (tag is ElementTree.Comment) or (getattr(tag, "__name__", None) == "Comment"):
+                    commentText = item.text or ""
+                    self.comment(commentText, embedInBlanks=not commentText)
+                elif (tag is ElementTree.ProcessingInstruction) or callable(tag):
+                    target = getattr(item, "target", None)
+                    if target is None:
+                        # ElementTree stores target and data in the text.
+                        target, _, data = item.text.partition(" ")
+                    else:
+                        data = item.text
+                    self._writeProcessingInstruction(target, data)
+                else:
+                    self._startTagFromClark(tag, item.attrib)
+                    self._elementText(item.text)
+                    todo.append((_ELEMENT_END, item))
+                    for child in reversed(item):
+                        todo.append((_ELEMENT_TAIL, child))
+                        todo.append((_ELEMENT_START, child))
+            elif action == _ELEMENT_END:
+                self.endTag()
+            else:
+                assert action == _ELEMENT_TAIL
+                self._elementText(item.tail)
+
+    def writeIterparse(self, source):
+        """
+        Write the XML document in ``source``, which is a file name or file
+        object, using ``xml.etree.ElementTree.iterparse()``.
+
+        This allows to include XML documents of any size because already
+        written elements are removed from memory:
+
+            >>> import io
+            >>> source = io.BytesIO(b'<items><item id="1">a</item> <item id="2">b</item></items>')
+            >>> out = io.BytesIO()
+            >>> xml = XmlWriter(out, pretty=False, prolog=False)
+            >>> xml.writeIterparse(source)
+            >>> xml.close()
+            >>> out.getvalue()
+            b'<items><item id="1">a</item> <item id="2">b</item></items>'
+
+        Namespace declarations of the source are preserved. Comments and
+        processing instructions are ignored. Other than that, the same rules
+        as for `element()` apply.
+        """
+        from xml.etree import ElementTree
+
+        # Stack of lists [element, isTextWritten, lastChild] for the open
+        # elements.
+        openElements = []
+        namespacesToAdd = []
+        for event, item in ElementTree.iterparse(source, events=("start", "end", "start-ns")):
+            if event == "start-ns":
+                namespacesToAdd.append(item)
+            elif event == "start":
+                if openElements:
+                    parent = openElements[-1]
+                    if not parent[1]:
+                        self._elementText(parent[0].text)
+                        parent[1] = True
+                    if parent[2] is not None:
+                        self._elementText(parent[2].tail)
+                        # Remove children already written from memory.
+                        del parent[0][:]
+                    parent[2] = item
+                for namespaceName, uri in namespacesToAdd:
+                    if namespaceName and (self._namespaceUri(namespaceName) != uri):
+                        self.addNamespace(namespaceName, uri)
+                namespacesToAdd = []
+                self._startTagFromClark(item.tag, item.attrib)
+                openElements.append([item, False, None])
+            else:
+                assert event == "end"
+                element, isTextWritten, lastChild = openElements.pop()
+                if not isTextWritten:
+                    self._elementText(element.text)
+                if lastChild is not None:
+                    self._elementText(lastChild.tail)
+                del element[:]
+                self.endTag()
+
+    def deferred(self, qualifiedName, attributes={}, spoolSize=_DEFAULT_SPOOL_SIZE):
+        """
+        Start tag like `startTag()` that is written only at the end of a
+        ``with`` block, so its attributes can depend on the content written
+        within the block. The content is buffered in memory, or in a
+        temporary file once it exceeds ``spoolSize`` bytes. At the end of the
+        block, the writer writes the start tag, the buffered content and
+        the end tag.
+
+        For example, to add the number of items to a summary:
+
+            >>> xml = BytesXmlWriter(pretty=False, prolog=False)
+            >>> xml.startTag("orders")
+            >>> with xml.deferred("summary") as summary:
+            ...     for amount in (3, 4):
+            ...         xml.tag("item", {"amount": amount})
+            ...     summary.setAttribute("count", 2)
+            >>> xml.endTag()
+            >>> xml.close()
+            b'<orders><summary count="2"><item amount="3"/><item amount="4"/></summary></orders>'
+
+        The content of the block must only consist of complete elements.
+        Within the block, `bytePosition` does not include the start tag yet
+        and `checkpoint()` is not available.
+        """
+        self._validateOutputTakesBytes("deferred tag")
+        return DeferredTag(self, qualifiedName, attributes, spoolSize)
+
+    def placeholder(self, attributeName, width):
+        """
+        Add an attribute to the start tag written by the previous
+        `startTag()` and reserve space for its value so it can be set later
+        on using `fill()`. The ``width`` is the maximum number of bytes the
+        value may take once it is escaped and encoded.
+
+        This allows to write for example the number of items as attribute
+        of the root element without buffering the whole document. The
+        output has to support ``seek()`` and ``tell()``, for example a
+        file opened with mode ``"wb"``:
+
+            >>> import io
+            >>> out = io.BytesIO()
+            >>> xml = XmlWriter(out, pretty=False, prolog=False)
+            >>> xml.startTag("items")
+            >>> count = xml.placeholder("count", 5)
+            >>> for itemId in range(3):
+            ...     xml.tag("item", {"id": itemId})
+            >>> xml.endTag()
+            >>> xml.fill(count, 3)
+            >>> xml.close()
+            >>> out.getvalue()
+            b'<items count="3"    ><item id="0"/><item id="1"/><item id="2"/></items>'
+
+        Until `fill()` is called, the attribute value is empty. The unused
+        space is filled with blanks after the attribute value, so the XML
+        is well-formed at any time.
+
+        Placeholders cannot be used with canonical XML, ``hashName`` or
+        within `deferred()` and `cached()`.
+        """
+        if self._startTagToWrite is None:
+            raise XmlError("placeholder for attribute %r must be added right after startTag()" % attributeName)
+        if self._deferredTags:
+            raise XmlError("placeholder for attribute %r must not be added within a deferred tag" % attributeName)
+        if self._cachedFragments:
+            raise XmlError("placeholder for attribute %r must not be added within a cached fragment" % attributeName)
+        if self._canonical or (self._outputHash is not None):
+            raise XmlError("placeholder for attribute %r must not be used with canonical XML or an output hash" % attributeName)
+        self._validateOutputTakesBytes("placeholder for attribute %r" % attributeName)
+        supportsSeek = getattr(self._output, "supportsSeek", None)
+        if supportsSeek is None:
+            seekable = getattr(self._output, "seekable", None)
+            supportsSeek = hasattr(self._output, "seek") and hasattr(self._output, "tell") \
+                and ((seekable is None) or seekable())
+        if not supportsSeek:
+            raise XmlError("placeholder for attribute %r requires an output that supports seek() and tell()" % attributeName)
+        assert width >= 0
+        (uniAttributeName, _), = self._convertedAttributes({attributeName: ""})
+        depth, qualifiedTagName, attributes = self._startTagToWrite
+        if uniAttributeName in attributes:
+            raise XmlError("attribute %r for placeholder must not already be set" % uniAttributeName)
+        # Copy the attributes because they might be shared.
+        attributes = dict(attributes)
+        attributes[uniAttributeName] = ""
+        self._startTagToWrite = (depth, qualifiedTagName, attributes)
+        result = Placeholder(self, uniAttributeName, width)
+        self._pendingPlaceholders[uniAttributeName] = result
+        return result
+
+    def fill(self, placeholder, value):
+        """
+        Set the value of the attribute reserved by `placeholder()` to
+        ``value`` by overwriting it in the output. This can be done at any
+        time, even after `close()`, as long as the output is still open.
+        """
+        assert placeholder is not None
+        if placeholder._writer is not self:
+            raise XmlError("placeholder for attribute %r must have been added by this writer" % placeholder.attributeName)
+        uniValue = self._unicoded(value)
+        if self._sanitizeAttributeValue is not None:
+            uniValue = self._sanitizeAttributeValue(uniValue)
+        data = self._encoded(self._quote(uniValue))
+        paddingData = self._encoded(" ")
+        emptyByteCount = len(self._encoded(placeholder._emptyText()))
+        paddingCount, remainder = divmod(emptyByteCount - len(data), len(paddingData))
+        if (paddingCount < 0) or remainder:
+            raise XmlError("value for attribute %r must fit into %d bytes but is: %r" % (
+                placeholder.attributeName, placeholder.width, uniValue))
+        data += paddingData * paddingCount
+        # Make sure the attribute has been written.
+        self._possiblyFlushTag()
+        self._writeChunks()
+        assert placeholder._position is not None
+        output = self._output
+        position = output.tell()
+        output.seek(placeholder._position)
+        output.write(data)
+        output.seek(position)
+
+    def cached(self, key):
+        """
+        Context manager to write a section only once and copy the bytes
+        from the `FragmentCache` set with the option ``fragmentCache``
+        afterwards. The ``with`` statement yields ``True`` if the section
+        is not in the cache yet and has to be written within the block:
+
+            >>> cache = FragmentCache()
+            >>> xml = BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+            >>> xml.startTag("products")
+            >>> for productId in range(3):
+            ...     xml.startTag("product", {"id": productId})
+            ...     with xml.cached("acme") as miss:
+            ...         if miss:
+            ...             xml.tag("manufacturer", {"name": "ACME"})
+            ...     xml.endTag()
+            >>> xml.endTag()
+            >>> xml.close()
+            b'<products><product id="0"><manufacturer name="ACME"/></product><product id="1"><manufacturer name="ACME"/></product><product id="2"><manufacturer name="ACME"/></product></products>'
+            >>> (cache.missCount, cache.hitCount)
+            (1, 2)
+
+        The section must consist of complete elements. The ``key`` has to
+        identify its content; the depth for pretty printing, the settings
+        of the writer and the namespaces in scope are taken into account
+        automatically. To declare a namespace within the section, use
+        `addNamespace()` within the block.
+        """
+        assert key is not None
+        self._validateIsOpen()
+        if self._fragmentCache is None:
+            raise XmlError("option fragmentCache must be set to cache fragment %r" % (key,))
+        self._validateOutputTakesBytes("cached fragment %r" % (key,))
+        if self._namespacesToAdd:
+            namespaceNames = ", ".join([name for name, _ in self._namespacesToAdd])
+            raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+        self._possiblyFlushTag()
+        depth = len(self._elementStack)
+        namespacesInScope = []
+        for scope in range(depth):
+            namespacesInScope.extend(self._namespaces.get(scope, ()))
+        # Use the settings the escape and quote functions depend on instead of
+        # the functions themselves, which differ for each writer with
+        # invalidChars.
+        cacheKey = (
+            key, self._pretty and depth, tuple(namespacesInScope),
+            self._encoding, self._errors, self._pretty and self._indent, self._newline,
+            self._canonical, self._invalidChars, self._version,
+        )
+        return _CachedFragment(self, key, cacheKey)
+
+    def fragment(self):
+        """
+        Context manager that yields a `BytesXmlWriter` to write a fragment
+        of the document and adds it at the end of the ``with`` block with
+        a single write to the ``output``. The fragment writer uses the same
+        settings as this writer and starts at its current depth with the
+        same namespaces.
+
+        This allows several threads to write elements at the same time if
+        the writer has been created with ``concurrent=True``. For
+        example, to let threads add the result of some work:
+
+            >>> import threading
+            >>> xml = BytesXmlWriter(pretty=False, prolog=False, concurrent=True)
+            >>> xml.startTag("results")
+            >>> def addResult(resultId):
+            ...     with xml.fragment() as record:
+            ...         record.tag("result", {"id": resultId})
+            >>> threads = [threading.Thread(target=addResult, args=(resultId,)) for resultId in range(3)]
+            >>> for thread in threads:
+            ...     thread.start()
+            >>> for thread in threads:
+            ...     thread.join()
+            >>> xml.endTag()
+            >>> xml.close().count(b"<result ")
+            3
+
+        Fragments are added in the order their blocks end and must consist
+        of complete elements. While threads write fragments, the writer
+        itself must not be used for anything else; in particular, it
+        must stay at the same depth. Within fragments of a concurrent
+        writer, `cached()` is not available.
+        """
+        self._validateIsOpen()
+        if self._namespacesToAdd:
+            namespaceNames = ", ".join([name for name, _ in self._namespacesToAdd])
+            raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+        self._validateOutputTakesBytes("fragment")
+        return _Fragment(self)
+
+    def _commitFragment(self, depth, data):
+        """
+        Write the encoded ``data`` of a `fragment()` that started at
+        ``depth``.
+        """
+        commitLock = self._commitLock
+        if commitLock is not None:
+            commitLock.acquire()
+        try:
+            self._validateIsOpen()
+            if len(self._elementStack) != depth:
+                raise XmlError("fragment must be added at depth %d but writer is at depth %d" % (depth, len(self._elementStack)))
+            if data:
+                # Only flush the start tag if there is content so an empty
+                # fragment does not prevent writing an empty element.
+                self._possiblyFlushTag()
+                self._outputWrite(data)
+                self._bytePosition += len(data)
+                self._contentHasBeenWritten = True
+        finally:
+            if commitLock is not None:
+                commitLock.release()
+
+    def replay(self, opLog):
+        """
+        Write the section recorded in ``opLog`` by a `RecordingXmlWriter` at
+        the current position, indented according to the current depth and
+        using the settings of this writer. Names and attributes have been
+        validated and converted while recording, so replaying a section is
+        a lot faster than writing it again.
+
+            >>> recorder = RecordingXmlWriter()
+            >>> recorder.startTag("product", {"id": "p1"})
+            >>> recorder.text("Ice cream")
+            >>> recorder.endTag()
+            >>> productLog = recorder.close()
+            >>> xml = BytesXmlWriter(prolog=False, newline="\\n")
+            >>> xml.startTag("products")
+            >>> xml.replay(productLog)
+            >>> xml.replay(productLog)
+            >>> xml.endTag()
+            >>> print(xml.close().decode("utf-8"))
+            <products>
+              <product id="p1">
+                Ice cream
+              </product>
+              <product id="p1">
+                Ice cream
+              </product>
+            </products>
+            <BLANKLINE>
+        """
+        assert opLog is not None
+        self._validateIsOpen()
+        if self._canonical:
+            raise XmlError("recorded sections cannot be replayed as canonical XML")
+        if self._namespacesToAdd:
+            namespaceNames = ", ".join([name for name, _ in self._namespacesToAdd])
+            raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+        self._possiblyFlushTag()
+        elementStack = self._elementStack
+        namespaces = self._namespaces
+        actuallyWriteTag = self._actuallyWriteTag
+        for op in opLog:
+            code = op[0]
+            if code == _OP_TAG:
+                _, qualifiedTagName, attributes, close, namespacesForScope = op
+                if close == XmlWriter._CLOSE_AT_START:
+                    elementStack.pop()
+                scope = len(elementStack)
+                if namespacesForScope:
+                    # Some writers need the namespaces to resolve names.
+                    namespaces[scope] = list(namespacesForScope)
+                actuallyWriteTag(scope, qualifiedTagName, attributes, close)
+                if close == XmlWriter._CLOSE_NONE:
+                    namespace, colon, name = qualifiedTagName.partition(":")
+                    if colon:
+                        elementStack.append((namespace, name))
+                    else:
+                        elementStack.append((None, qualifiedTagName))
+                elif scope in namespaces:
+                    del namespaces[scope]
+            elif code == _OP_TEXT:
+                self._writeText(op[1])
+            elif code == _OP_COMMENT:
+                self._writeComment(op[1], op[2])
+            elif code == _OP_RAW_BLOCK:
+                self._writeRawBlock(op[1], op[2], op[3])
+            elif code == _OP_WRITE:
+                self._write(op[1])
+            else:
+                assert code == _OP_NEWLINE, "code=%r" % (code,)
+                self.newline()
+
+    def checkpoint(self):
+        """
+        Flush the ``output`` and return an `XmlCheckpoint` that allows to
+        resume writing using `fromCheckpoint()`, for example after a long
+        running export crashed.
+
+        As example, write the first part of a document to a file:
+
+            >>> import io, os, tempfile
+            >>> path = os.path.join(tempfile.mkdtemp(), "export.xml")
+            >>> out = io.open(path, "wb")
+            >>> xml = XmlWriter(out, pretty=False)
+            >>> xml.startTag("items")
+            >>> xml.tag("item", {"id": 1})
+            >>> checkpoint = xml.checkpoint()
+
+        Now keep writing until something goes wrong:
+
+            >>> xml.tag("item", {"id": 2})
+            >>> xml.text("broken beyond rep")
+            >>> out.close()
+
+        To resume, reopen the file and continue writing with a writer created
+        from the checkpoint. It discards everything written after the
+        checkpoint was taken:
+
+            >>> out = io.open(path, "r+b")
+            >>> xml = XmlWriter.fromCheckpoint(out, checkpoint, pretty=False)
+            >>> xml.tag("item", {"id": 2})
+            >>> xml.endTag("items")
+            >>> xml.close()
+            >>> out.close()
+            >>> io.open(path, "rb").read()
+            b'<?xml version="1.0" encoding="utf-8"?><items><item id="1"/><item id="2"/></items>'
+
+        The checkpoint only consists of tuples, strings and numbers, so it
+        can be stored using ``pickle`` or ``json``.
+        """
+        self._validateIsOpen()
+        if self._deferredTags:
+            raise XmlError("checkpoint must not be set within a deferred tag")
+        if self._pendingPlaceholders:
+            raise XmlError("checkpoint must not be set before the tag with placeholders has been written")
+        self._validateOutputTakesBytes("checkpoint")
+        self._writeChunks()
+        flush = getattr(self._output, "flush", None)
+        if flush is not None:
+            flush()
+        namespaces = []
+        for scopeOrName, value in self._namespaces.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            namespaces.append((scopeOrName, value))
+        startTagToWrite = self._startTagToWrite
+        if startTagToWrite is not None:
+            depth, qualifiedTagName, attributes = startTagToWrite
+            startTagToWrite = (depth, qualifiedTagName, tuple(sorted(attributes.items())))
+        return XmlCheckpoint(
+            self._bytePosition,
+            tuple(self._elementStack),
+            tuple(namespaces),
+            tuple(self._namespacesToAdd),
+            startTagToWrite
+        )
+
+    @classmethod
+    def fromCheckpoint(cls, output, checkpoint, truncate=True, **settings):
+        """
+        Writer that continues writing to ``output`` at the state stored in
+        ``checkpoint``, which has been obtained using `checkpoint()`.
+
+        The ``settings`` are the keyword arguments of the constructor and
+        should be the same as for the writer that created the checkpoint. No
+        XML prolog is written.
+
+        If ``truncate`` is ``True``, ``output`` must be a seekable file
+        opened for update. It is truncated to the position the checkpoint
+        was taken. This position is only correct if the original writer
+        started writing at the beginning of the file. Otherwise set
+        ``truncate`` to ``False`` and position the ``output`` yourself.
+        """
+        assert output is not None
+        assert checkpoint is not None
+        # Normalize the checkpoint because JSON turns tuples into lists.
+        checkpoint = XmlCheckpoint(*checkpoint)
+        settings["prolog"] = False
+        result = cls.__new__(cls)
+        result._configure(**settings)
+        if truncate:
+            output.seek(checkpoint.offset)
+            output.truncate()
+        result.reset(output)
+        result._bytePosition = checkpoint.offset
+        result._contentHasBeenWritten = (checkpoint.offset > 0)
+        for namespace, name in checkpoint.elementStack:
+            result._elementStack.append((namespace, name))
+        for scopeOrName, value in checkpoint.namespaces:
+            if isinstance(scopeOrName, int):
+                value = [(name, uri) for name, uri in value]
+            result._namespaces[scopeOrName] = value
+        for name, uri in checkpoint.namespacesToAdd:
+            result._namespacesToAdd.append((name, uri))
+        if checkpoint.startTagToWrite is not None:
+            depth, qualifiedTagName, attributes = checkpoint.startTagToWrite
+            result._startTagToWrite = (depth, qualifiedTagName, dict(attributes))
+        return result
+
+    def close(self):
+        """
+        Close the writer, validate that all started elements have ended and
+        prevent further output.
+
+        Using a writer like
 
             >>> import io
             >>> out = io.BytesIO()
@@ -1434,6 +2890,8 @@ class XmlWriter(object):
             remainingElements += "</%s>" % self._elementName(name, namespace)
         if remainingElements:
             raise XmlError("missing end tags must be added: %s" % remainingElements)
+        self._isOpen = False
+        self._writeChunks()
 
 
 class ChainXmlWriter(XmlWriter):
@@ -1462,26 +2920,2141 @@ class ChainXmlWriter(XmlWriter):
         </xhtml:html>
     """
 
+    # No additional attributes needed; keep instances slot based.
+    __slots__ = ()
+
     chainableMethods = ('addNamespace', 'cdata', 'comment', 'endTag',
                         'endTags', 'processingInstruction', 'startTag', 'tag',
                         'text',)
 
-    def _chainDecorator(self, func):
-        def _wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            return self
-        return _wrapper
+class XmlWriterContentHandler(object):
+    """
+    SAX content handler that writes the document it receives to an
+    `XmlWriter`, optionally changing or removing elements on the way.
+
+    This allows to filter and rewrite XML documents of any size while only
+    keeping the current element and text in memory. The easiest way to use
+    it is `transform()`, which parses a document with namespace processing
+    enabled.
+
+    ``callbacks`` is a dictionary with element names as keys and functions
+    ``callback(name, attributes)`` as values. With namespace processing
+    enabled, names use Clark notation, for example
+    ``{http://www.w3.org/1999/xhtml}img``, otherwise they are the qualified
+    names as found in the document. The callback stored for the key
+    ``None`` is used for all elements without a specific callback.
+
+    A callback returns a tuple ``(name, attributes)`` with the name and
+    attributes to actually write, or ``None`` to remove the element
+    including its content.
+
+    If the writer pretty prints, text that consists only of white space is
+    ignored.
+
+    Long text is written in parts once about 64 K characters have been
+    collected. If the writer pretty prints, only complete lines are
+    written, so the memory needed also depends on the longest line.
+    """
+    def __init__(self, writer, callbacks=None):
+        assert writer is not None
+        self._writer = writer
+        self._callbacks = callbacks or {}
+        self._defaultCallback = self._callbacks.get(None)
+        self._textParts = []
+        self._textLength = 0
+        self._maxTextLength = _TRANSFORM_TEXT_SIZE
+        # Has the start of the current text already been written?
+        self._hasWrittenText = False
+        self._namespacesToAdd = []
+        # Number of elements open inside of an element that is removed.
+        self._removeDepth = 0
+
+    @property
+    def writer(self):
+        """The `XmlWriter` the document is written to."""
+        return self._writer
+
+    def _flushText(self):
+        if self._textParts or self._hasWrittenText:
+            text = "".join(self._textParts)
+            if self._hasWrittenText:
+                # The rest belongs to text already written, so write it even
+                # if it is white space.
+                self._writer.text(text)
+            else:
+                self._writer._elementText(text)
+            self._textParts = []
+            self._textLength = 0
+            self._maxTextLength = _TRANSFORM_TEXT_SIZE
+            self._hasWrittenText = False
+
+    def _writeTextCollectedSoFar(self):
+        """
+        Write the text collected so far except for an incomplete last line
+        if the writer pretty prints, where each line is stripped and
+        indented as a whole.
+        """
+        text = "".join(self._textParts)
+        writer = self._writer
+        if not writer._pretty:
+            end = len(text)
+        elif self._hasWrittenText or not text.isspace():
+            end = text.rfind("\n") + 1
+        else:
+            # Keep white space, which is ignored if no other text follows.
+            end = 0
+        if end:
+            writer.text(text[:end])
+            self._hasWrittenText = True
+            text = text[end:]
+        self._textParts = [text]
+        self._textLength = len(text)
+        # Prevent joining a long line again and again.
+        self._maxTextLength = max(_TRANSFORM_TEXT_SIZE, 2 * self._textLength)
+
+    def _startElement(self, name, attributes):
+        self._flushText()
+        if self._removeDepth:
+            self._removeDepth += 1
+        else:
+            callback = self._callbacks.get(name, self._defaultCallback)
+            if callback is not None:
+                nameAndAttributes = callback(name, attributes)
+                if nameAndAttributes is None:
+                    self._removeDepth = 1
+                    self._namespacesToAdd = []
+                    return
+                name, attributes = nameAndAttributes
+            writer = self._writer
+            for namespaceName, uri in self._namespacesToAdd:
+                if namespaceName and (writer._namespaceUri(namespaceName) != uri):
+                    writer.addNamespace(namespaceName, uri)
+            self._namespacesToAdd = []
+            writer._startTagFromClark(name, attributes)
+
+    def _endElement(self):
+        self._flushText()
+        if self._removeDepth:
+            self._removeDepth -= 1
+        else:
+            self._writer.endTag()
+
+    def setDocumentLocator(self, locator):
+        pass
+
+    def startDocument(self):
+        pass
+
+    def endDocument(self):
+        self._flushText()
+
+    def startPrefixMapping(self, prefix, uri):
+        if not self._removeDepth:
+            self._namespacesToAdd.append((prefix, uri))
+
+    def endPrefixMapping(self, prefix):
+        pass
+
+    def startElement(self, name, attrs):
+        attributes = {}
+        for attributeName, attributeValue in attrs.items():
+            if attributeName.startswith("xmlns:"):
+                self.startPrefixMapping(attributeName[6:], attributeValue)
+            else:
+                attributes[attributeName] = attributeValue
+        self._startElement(name, attributes)
+
+    def endElement(self, name):
+        self._endElement()
+
+    def startElementNS(self, name, qname, attrs):
+        uri, localName = name
+        if uri:
+            clarkName = "{%s}%s" % (uri, localName)
+        else:
+            clarkName = localName
+        attributes = {}
+        for (attributeUri, attributeLocalName), attributeValue in attrs.items():
+            if attributeUri:
+                attributes["{%s}%s" % (attributeUri, attributeLocalName)] = attributeValue
+            else:
+                attributes[attributeLocalName] = attributeValue
+        self._startElement(clarkName, attributes)
+
+    def endElementNS(self, name, qname):
+        self._endElement()
+
+    def characters(self, content):
+        if not self._removeDepth:
+            self._textParts.append(content)
+            self._textLength += len(content)
+            if self._textLength >= self._maxTextLength:
+                self._writeTextCollectedSoFar()
+
+    def ignorableWhitespace(self, whitespace):
+        self.characters(whitespace)
+
+    def processingInstruction(self, target, data):
+        self._flushText()
+        if not self._removeDepth:
+            self._writer._writeProcessingInstruction(target, data)
+
+    def skippedEntity(self, name):
+        pass
+
+    # Methods of the SAX lexical handler.
+    def comment(self, content):
+        self._flushText()
+        if not self._removeDepth:
+            self._writer.comment(content, embedInBlanks=not content)
+
+    def startDTD(self, name, publicId, systemId):
+        pass
+
+    def endDTD(self):
+        pass
+
+    def startCDATA(self):
+        pass
+
+    def endCDATA(self):
+        pass
+
+
+def transform(source, writer, callbacks=None):
+    """
+    Parse the XML document in ``source`` and write it to ``writer``
+    using the ``callbacks`` of `XmlWriterContentHandler` to change or remove
+    elements. The ``source`` can be anything ``xml.sax.parse()`` accepts,
+    for example a file name or a binary file.
+
+    Here is an example that removes all ``<secret>`` elements and adds an
+    attribute to ``<item>``:
+
+        >>> import io
+        >>> source = io.BytesIO(b'<items><item>a</item><secret>b</secret></items>')
+        >>> def markItem(name, attributes):
+        ...     attributes["checked"] = "yes"
+        ...     return (name, attributes)
+        >>> callbacks = {"item": markItem, "secret": lambda name, attributes: None}
+        >>> xml = BytesXmlWriter(pretty=False, prolog=False)
+        >>> transform(source, xml, callbacks)
+        >>> xml.close()
+        b'<items><item checked="yes">a</item></items>'
+    """
+    import xml.sax
+    import xml.sax.handler
+
+    handler = XmlWriterContentHandler(writer, callbacks)
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setContentHandler(handler)
+    parser.setProperty(xml.sax.handler.property_lexical_handler, handler)
+    parser.parse(source)
+
+
+class _Crc32(object):
+    """
+    Accumulator for ``zlib.crc32()`` with the ``update()`` and
+    ``hexdigest()`` methods of a ``hashlib`` object, so it can be used with
+    `_hashingWrite()`.
+    """
+    __slots__ = ("_crc32Function", "_value")
+
+    def __init__(self):
+        import zlib
+        self._crc32Function = zlib.crc32
+        self._value = 0
+
+    def update(self, data):
+        self._value = self._crc32Function(data, self._value)
+
+    @property
+    def value(self):
+        return self._value & 0xffffffff
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+class ChecksumOutput(object):
+    """
+    Output wrapper that computes checksums and counts the bytes of all data
+    written while passing it on to ``output``.
+
+    This allows to compute checksums for integrity manifests without reading
+    the output again once it is complete:
+
+        >>> import io
+        >>> out = ChecksumOutput(io.BytesIO(), hashNames=["md5", "sha256"])
+        >>> xml = XmlWriter(out, pretty=False)
+        >>> xml.tag("a")
+        >>> xml.close()
+        >>> sorted(out.close().items()) #doctest: +ELLIPSIS
+        [('crc32', '...'), ('md5', '...'), ('sha256', '...')]
+        >>> out.byteCount
+        42
+
+    The ``hashNames`` can be any names supported by ``hashlib.new()``. Set
+    ``crc32`` to ``False`` to skip computing a CRC-32 using ``zlib``.
+    """
+    __slots__ = ("_byteCount", "_crc32", "_hashes", "_output", "_outputWrite")
+
+    def __init__(self, output, hashNames=("sha256",), crc32=True):
+        assert output is not None
+        assert hashNames is not None
+        import hashlib
+        self._output = output
+        # Use the same hashing as the option ``hashName`` of `XmlWriter`.
+        outputWrite = output.write
+        self._hashes = {}
+        for hashName in hashNames:
+            outputHash = hashlib.new(hashName)
+            self._hashes[hashName] = outputHash
+            outputWrite = _hashingWrite(outputWrite, outputHash)
+        if crc32:
+            self._crc32 = _Crc32()
+            outputWrite = _hashingWrite(outputWrite, self._crc32)
+        else:
+            self._crc32 = None
+        self._outputWrite = outputWrite
+        self._byteCount = 0
+
+    def write(self, data):
+        self._byteCount += len(data)
+        self._outputWrite(data)
+
+    def flush(self):
+        flush = getattr(self._output, "flush", None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        """
+        Close the ``output`` and return the final `hexdigests()`. The
+        checksums and byte count remain available.
+        """
+        close = getattr(self._output, "close", None)
+        if close is not None:
+            close()
+        return self.hexdigests()
+
+    @property
+    def output(self):
+        """The output data is passed on to."""
+        return self._output
+
+    @property
+    def byteCount(self):
+        """The number of bytes written so far."""
+        return self._byteCount
+
+    @property
+    def crc32(self):
+        """The CRC-32 of the data written so far or ``None``."""
+        if self._crc32 is None:
+            result = None
+        else:
+            result = self._crc32.value
+        return result
+
+    @property
+    def hashes(self):
+        """Dictionary of hash names and their ``hashlib`` objects."""
+        return self._hashes
+
+    def hexdigests(self):
+        """
+        Dictionary of hash names and the hex digests of the data written so
+        far, including ``"crc32"`` unless disabled.
+        """
+        result = {}
+        for hashName, outputHash in self._hashes.items():
+            result[hashName] = outputHash.hexdigest()
+        if self._crc32 is not None:
+            result["crc32"] = self._crc32.hexdigest()
+        return result
+
+
+class XmlSink(object):
+    """
+    Base class for outputs that tell `XmlWriter` how to write to them most
+    efficiently. A sink has the following methods:
+
+    * ``write(data)`` to write all of ``data``, which each sink has to
+      provide.
+    * ``writev(datas)`` to write a sequence of ``data`` in one go, by
+      default calling ``write()`` for each of them.
+    * ``flush()`` and ``close()``, which by default do nothing.
+
+    and the following capabilities:
+
+    * ``acceptsText``: ``data`` is ``str`` (``unicode`` with Python 2)
+      instead of ``bytes``, so the writer skips encoding if ``encoding`` is
+      UTF-8, UTF-16 or UTF-32. For other encodings, the text is encoded and
+      decoded again so ``errors`` applies. Features that depend on the
+      bytes written, like ``hashName``, `XmlWriter.deferred()`,
+      `XmlWriter.placeholder()`, `XmlWriter.cached()`,
+      `XmlWriter.fragment()` and `XmlWriter.checkpoint()`, are not
+      available.
+    * ``supportsSeek``: the sink has ``seek()`` and ``tell()`` like a file,
+      so `XmlWriter.placeholder()` can be used.
+    * ``prefersLargeChunks``: each call is expensive, for example a system
+      call, so the writer collects fragments and passes them on to
+      ``writev()`` in chunks of about 64 KB. Use `XmlWriter.flush()` to
+      write the fragments collected so far, for example before waiting
+      for a reply on a socket; `XmlWriter.close()` writes the rest.
+
+    Other outputs can be used as sink too by adding these methods and
+    capabilities; they do not have to derive from ``XmlSink``.
+    """
+    __slots__ = ()
+
+    acceptsText = False
+    supportsSeek = False
+    prefersLargeChunks = False
+
+    def writev(self, datas):
+        write = self.write
+        for data in datas:
+            write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _maxIoVectorCount():
+    """
+    The maximum number of buffers ``os.writev()`` and ``socket.sendmsg()``
+    accept at once.
+    """
+    try:
+        result = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        result = -1
+    if result <= 0:
+        # The minimum POSIX requires.
+        result = 16
+    return result
+
+
+class FileDescriptorSink(XmlSink):
+    """
+    Sink that writes to the file descriptor ``fd`` using ``os.write()``
+    and ``os.writev()`` without any buffering of its own, for example a
+    pipe or a file opened using ``os.open()``:
+
+        >>> import io, os, tempfile
+        >>> fd, path = tempfile.mkstemp()
+        >>> xml = XmlWriter(FileDescriptorSink(fd), pretty=False, prolog=False)
+        >>> xml.tag("a")
+        >>> xml.close()
+        >>> xml.output.close()
+        >>> io.open(path, "rb").read()
+        b'<a/>'
+        >>> os.remove(path)
+
+    If ``fd`` refers to a file, the sink supports ``seek()``, ``tell()``
+    and ``truncate()``, so it can be used with `XmlWriter.placeholder()`
+    and `XmlWriter.fromCheckpoint()`. `close()` closes ``fd``.
+    """
+    __slots__ = ("_fd", "_maxIoVectorCount", "_supportsSeek")
+
+    prefersLargeChunks = True
 
-    def __getattribute__(self, name):
+    def __init__(self, fd):
+        assert fd is not None
+        self._fd = fd
+        self._maxIoVectorCount = _maxIoVectorCount()
+        try:
+            os.lseek(fd, 0, os.SEEK_CUR)
+            self._supportsSeek = True
+        except OSError:
+            self._supportsSeek = False
+
+    @property
+    def supportsSeek(self):
+        return self._supportsSeek
+
+    def fileno(self):
+        return self._fd
+
+    def write(self, data):
+        fd = self._fd
+        writtenByteCount = os.write(fd, data)
+        if writtenByteCount < len(data):
+            remainingData = memoryview(data)
+            while writtenByteCount < len(remainingData):
+                remainingData = remainingData[writtenByteCount:]
+                writtenByteCount = os.write(fd, remainingData)
+
+    def writev(self, datas):
+        writev = getattr(os, "writev", None)
+        if writev is None:
+            self.write(b"".join(datas))
+        else:
+            maxIoVectorCount = self._maxIoVectorCount
+            for start in range(0, len(datas), maxIoVectorCount):
+                someDatas = datas[start:start + maxIoVectorCount]
+                writtenByteCount = writev(self._fd, someDatas)
+                if writtenByteCount < sum([len(data) for data in someDatas]):
+                    self.write(b"".join(someDatas)[writtenByteCount:])
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return os.lseek(self._fd, offset, whence)
+
+    def seekable(self):
+        return self._supportsSeek
+
+    def tell(self):
+        return os.lseek(self._fd, 0, os.SEEK_CUR)
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self.tell()
+        os.ftruncate(self._fd, size)
+        return size
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SocketSink(XmlSink):
+    """
+    Sink that sends to the connected blocking ``socket`` using
+    ``sendall()`` and ``sendmsg()``, so large documents can be streamed to
+    a client without converting them to a file object using
+    ``socket.makefile()``. `close()` closes the ``socket``.
+    """
+    __slots__ = ("_maxIoVectorCount", "_socket")
+
+    prefersLargeChunks = True
+
+    def __init__(self, socket):
+        assert socket is not None
+        self._socket = socket
+        self._maxIoVectorCount = _maxIoVectorCount()
+
+    @property
+    def socket(self):
+        """The socket data is sent to."""
+        return self._socket
+
+    def write(self, data):
+        self._socket.sendall(data)
+
+    def writev(self, datas):
+        sendmsg = getattr(self._socket, "sendmsg", None)
+        if sendmsg is None:
+            self._socket.sendall(b"".join(datas))
+        else:
+            maxIoVectorCount = self._maxIoVectorCount
+            for start in range(0, len(datas), maxIoVectorCount):
+                someDatas = datas[start:start + maxIoVectorCount]
+                sentByteCount = sendmsg(someDatas)
+                if sentByteCount < sum([len(data) for data in someDatas]):
+                    self._socket.sendall(b"".join(someDatas)[sentByteCount:])
+
+    def close(self):
+        self._socket.close()
+
+
+class BytearraySink(XmlSink):
+    """
+    Sink that appends to the ``bytearray`` ``buffer``, or a new one if
+    ``buffer`` is ``None``:
+
+        >>> out = BytearraySink()
+        >>> xml = XmlWriter(out, pretty=False, prolog=False)
+        >>> xml.tag("a")
+        >>> xml.close()
+        >>> out.buffer
+        bytearray(b'<a/>')
+
+    In particular, several documents can be appended to the same
+    ``buffer``, which can be passed to anything that accepts a buffer
+    without copying it.
+    """
+    # Use the slot `write` to store `bytearray.extend` so the writer calls it
+    # directly instead of a method calling it.
+    __slots__ = ("_buffer", "write")
+
+    def __init__(self, buffer=None):
+        if buffer is None:
+            buffer = bytearray()
+        self._buffer = buffer
+        self.write = buffer.extend
+
+    @property
+    def buffer(self):
+        """The ``bytearray`` data is appended to."""
+        return self._buffer
+
+    def writev(self, datas):
+        extend = self._buffer.extend
+        for data in datas:
+            extend(data)
+
+    def getvalue(self):
+        """
+        The data written so far as ``bytes``.
+        """
+        return bytes(self._buffer)
+
+
+class TextSink(XmlSink):
+    """
+    Sink that writes ``str`` (``unicode`` with Python 2) to the text
+    stream ``stream`` without encoding it first, for example an
+    ``io.StringIO`` or a file opened in text mode, which encodes the text
+    itself:
+
+        >>> import io
+        >>> out = TextSink(io.StringIO())
+        >>> xml = XmlWriter(out, pretty=False)
+        >>> xml.tag("a", {"price": "\\u20ac 1"})
+        >>> xml.close()
+        >>> print(out.stream.getvalue())
+        <?xml version="1.0" encoding="utf-8"?><a price="\u20ac 1"/>
+
+    The writer's ``encoding`` should match the encoding of ``stream``;
+    characters it cannot encode are handled according to ``errors``. `close()` closes the ``stream``.
+    """
+    __slots__ = ("_stream", "write")
+
+    acceptsText = True
+
+    def __init__(self, stream):
+        assert stream is not None
+        self._stream = stream
+        # Let the writer call the stream's write method directly.
+        self.write = stream.write
+
+    @property
+    def stream(self):
+        """The text stream data is written to."""
+        return self._stream
+
+    def writev(self, texts):
+        self._stream.write("".join(texts))
+
+    def flush(self):
+        flush = getattr(self._stream, "flush", None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        self._stream.close()
+
+
+class DeferredTag(object):
+    """
+    Start tag written at the end of a ``with`` block, see
+    `XmlWriter.deferred()`.
+    """
+    __slots__ = (
+        "_attributes", "_bytePosition", "_depth", "_outputWrite", "_qualifiedName", "_spool", "_spoolSize",
+        "_startTag", "_writer",
+    )
+
+    # Number of bytes to copy from the spool at once.
+    _COPY_SIZE = 64 * 1024
+
+    def __init__(self, writer, qualifiedName, attributes, spoolSize):
+        assert writer is not None
+        assert attributes is not None
+        assert spoolSize >= 0
+        self._writer = writer
+        self._qualifiedName = qualifiedName
+        self._attributes = dict(attributes)
+        self._spoolSize = spoolSize
+        self._spool = None
+
+    def setAttribute(self, name, value):
+        """
+        Set attribute ``name`` of the start tag to ``value``. Attributes set
+        this way are validated when the block ends.
+        """
+        _validateNotNoneOrEmpty("name", name)
+        if self._spool is None:
+            raise XmlError("attribute %r must be set within the with block" % name)
+        self._attributes[name] = value
+
+    def __enter__(self):
+        import tempfile
+
+        if self._spool is not None:
+            raise XmlError("deferred tag must be used only once")
+        writer = self._writer
+        # Let startTag() validate the name and attributes and compute the tag
+        # but take it over before it is written.
+        writer.startTag(self._qualifiedName, self._attributes)
+        self._startTag = writer._startTagToWrite
+        writer._startTagToWrite = None
+        self._attributes = {}
+        self._depth = len(writer._elementStack)
+        self._bytePosition = writer._bytePosition
+        self._spool = tempfile.SpooledTemporaryFile(max_size=self._spoolSize)
+        self._outputWrite = writer._outputWrite
+        writer._outputWrite = self._spool.write
+        writer._deferredTags.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        writer = self._writer
+        try:
+            try:
+                if exc_type is None:
+                    if len(writer._elementStack) != self._depth:
+                        raise XmlError("content of deferred tag <%s> must consist of complete elements" % self._startTag[1])
+                    writer._possiblyFlushTag()
+                    depth, qualifiedTagName, attributes = self._startTag
+                    if self._attributes:
+                        attributes = dict(attributes)
+                        attributes.update(writer._convertedAttributes(self._attributes))
+            finally:
+                writer._updateMaxBufferedByteCount()
+                writer._outputWrite = self._outputWrite
+                assert writer._deferredTags[-1] is self
+                writer._deferredTags.pop()
+            if exc_type is None:
+                self._writeTo(writer, depth, qualifiedTagName, attributes)
+        finally:
+            self._spool.close()
+
+    def _writeTo(self, writer, depth, qualifiedTagName, attributes):
+        contentByteCount = writer._bytePosition - self._bytePosition
+        writer._bytePosition = self._bytePosition
+        if contentByteCount:
+            writer._actuallyWriteTag(depth, qualifiedTagName, attributes, XmlWriter._CLOSE_NONE)
+            spool = self._spool
+            spool.seek(0)
+            data = spool.read(DeferredTag._COPY_SIZE)
+            while data:
+                writer._outputWrite(data)
+                data = spool.read(DeferredTag._COPY_SIZE)
+            writer._bytePosition += contentByteCount
+        else:
+            # Let endTag() turn the start tag into an empty element.
+            writer._startTagToWrite = (depth, qualifiedTagName, attributes)
+        writer.endTag()
 
-        if name in ChainXmlWriter.chainableMethods:
-            originalMethod = getattr(super(ChainXmlWriter, self), name)
-            return self._chainDecorator(originalMethod)
 
-        return super(ChainXmlWriter, self).__getattribute__(name)
+class Placeholder(object):
+    """
+    Attribute value that can be set after the start tag has been written,
+    see `XmlWriter.placeholder()`.
+    """
+    __slots__ = ("_attributeName", "_position", "_width", "_writer")
+
+    def __init__(self, writer, attributeName, width):
+        self._writer = writer
+        self._attributeName = attributeName
+        self._width = width
+        self._position = None
+
+    @property
+    def attributeName(self):
+        """The name of the attribute."""
+        return self._attributeName
+
+    @property
+    def width(self):
+        """The maximum number of bytes the escaped and encoded value can take."""
+        return self._width
+
+    @property
+    def position(self):
+        """
+        The offset in the output where the quoted attribute value starts
+        or ``None`` if the start tag has not been written yet.
+        """
+        return self._position
+
+    def _emptyText(self):
+        """
+        Text of an empty value including quotes followed by enough blanks to
+        replace it by a value with ``width`` bytes later on.
+        """
+        return '""' + " " * self._width
+
+
+class FragmentCache(object):
+    """
+    Cache for the encoded bytes of sections written using
+    `XmlWriter.cached()`. Once the cache holds more than ``maxByteCount``
+    bytes, the least recently used sections are removed.
+
+    Writers can share a cache, even if their settings differ.
+    """
+    __slots__ = ("_byteCount", "_fragments", "_hitCount", "_maxByteCount", "_missCount")
+
+    def __init__(self, maxByteCount=_DEFAULT_FRAGMENT_CACHE_SIZE):
+        assert maxByteCount >= 0
+        self._maxByteCount = maxByteCount
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all sections and reset the statistics.
+        """
+        self._fragments = collections.OrderedDict()
+        self._byteCount = 0
+        self._hitCount = 0
+        self._missCount = 0
+
+    def __len__(self):
+        return len(self._fragments)
+
+    @property
+    def maxByteCount(self):
+        """Maximum number of bytes to hold."""
+        return self._maxByteCount
+
+    @property
+    def byteCount(self):
+        """Number of bytes currently held."""
+        return self._byteCount
+
+    @property
+    def hitCount(self):
+        """Number of sections found in the cache."""
+        return self._hitCount
+
+    @property
+    def missCount(self):
+        """Number of sections not found in the cache."""
+        return self._missCount
+
+    def _get(self, cacheKey):
+        data = self._fragments.get(cacheKey)
+        if data is None:
+            self._missCount += 1
+        else:
+            self._hitCount += 1
+            # Mark the section as most recently used.
+            self._fragments[cacheKey] = self._fragments.pop(cacheKey)
+        return data
+
+    def _put(self, cacheKey, data):
+        if len(data) <= self._maxByteCount:
+            oldData = self._fragments.pop(cacheKey, None)
+            if oldData is not None:
+                self._byteCount -= len(oldData)
+            self._fragments[cacheKey] = data
+            self._byteCount += len(data)
+            while self._byteCount > self._maxByteCount:
+                _, removedData = self._fragments.popitem(last=False)
+                self._byteCount -= len(removedData)
+
+
+class _CachedFragment(object):
+    """
+    Context manager returned by `XmlWriter.cached()`.
+    """
+    __slots__ = ("_bytePosition", "_cacheKey", "_data", "_depth", "_key", "_outputWrite", "_writer")
+
+    def __init__(self, writer, key, cacheKey):
+        self._writer = writer
+        self._key = key
+        self._cacheKey = cacheKey
+        self._depth = len(writer._elementStack)
+        self._data = None
+        self._outputWrite = None
+
+    def __enter__(self):
+        writer = self._writer
+        cachedData = writer._fragmentCache._get(self._cacheKey)
+        if cachedData is not None:
+            writer._outputWrite(cachedData)
+            writer._bytePosition += len(cachedData)
+            writer._contentHasBeenWritten = True
+            return False
+        # Write the section and collect its bytes at the same time.
+        self._bytePosition = writer._bytePosition
+        self._data = []
+        collect = self._data.append
+        outputWrite = writer._outputWrite
+        self._outputWrite = outputWrite
+
+        def collectingWrite(data):
+            collect(data)
+            return outputWrite(data)
+
+        writer._outputWrite = collectingWrite
+        writer._cachedFragments.append(self)
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._data is not None:
+            writer = self._writer
+            try:
+                if exc_type is None:
+                    if len(writer._elementStack) != self._depth:
+                        raise XmlError("cached fragment %r must consist of complete elements" % (self._key,))
+                    if writer._namespacesToAdd:
+                        namespaceNames = ", ".join([name for name, _ in writer._namespacesToAdd])
+                        raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+            finally:
+                writer._updateMaxBufferedByteCount()
+                writer._outputWrite = self._outputWrite
+                assert writer._cachedFragments[-1] is self
+                writer._cachedFragments.pop()
+            if exc_type is None:
+                writer._fragmentCache._put(self._cacheKey, b"".join(self._data))
+
+
+class _Fragment(object):
+    """
+    Context manager returned by `XmlWriter.fragment()`.
+    """
+    __slots__ = ("_depth", "_fragmentWriter", "_writer")
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._depth = None
+        self._fragmentWriter = None
+
+    def __enter__(self):
+        writer = self._writer
+        fragmentWriters = writer._fragmentWriters
+        fragmentWriter = None
+        if fragmentWriters is not None:
+            # Take the writer of the current thread so nested fragments
+            # get a new one.
+            fragmentWriter = getattr(fragmentWriters, "writer", None)
+            fragmentWriters.writer = None
+        if fragmentWriter is None:
+            fragmentWriter = BytesXmlWriter.__new__(BytesXmlWriter)
+            fragmentWriter._configureLike(writer)
+            fragmentWriter._prolog = None
+            fragmentWriter._hashName = None
+            fragmentWriter._concurrent = False
+            if writer._concurrent:
+                fragmentWriter._fragmentCache = None
+        fragmentWriter.reset()
+        # Start at the same depth and with the same namespaces.
+        elementStack = tuple(writer._elementStack)
+        self._depth = len(elementStack)
+        fragmentWriter._elementStack.extend(elementStack)
+        for scope in range(self._depth):
+            namespacesForScope = writer._namespaces.get(scope)
+            if namespacesForScope:
+                fragmentWriter._namespaces[scope] = list(namespacesForScope)
+        self._fragmentWriter = fragmentWriter
+        return fragmentWriter
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fragmentWriter = self._fragmentWriter
+        try:
+            if exc_type is None:
+                fragmentWriter._possiblyFlushTag()
+                if len(fragmentWriter._elementStack) != self._depth:
+                    raise XmlError("fragment must consist of complete elements")
+                if fragmentWriter._namespacesToAdd:
+                    namespaceNames = ", ".join([name for name, _ in fragmentWriter._namespacesToAdd])
+                    raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+                self._writer._commitFragment(self._depth, fragmentWriter.getvalue())
+        finally:
+            fragmentWriters = self._writer._fragmentWriters
+            if fragmentWriters is not None:
+                # Discard the content and give the writer back for reuse.
+                fragmentWriter.reset()
+                fragmentWriters.writer = fragmentWriter
+
+
+class XmlCheckpoint(collections.namedtuple("XmlCheckpoint", ["offset", "elementStack", "namespaces", "namespacesToAdd", "startTagToWrite"])):
+    """
+    State of an `XmlWriter` as obtained by `XmlWriter.checkpoint()`:
+
+    * ``offset``: the number of bytes written so far.
+    * ``elementStack``: the ``(namespace, name)`` of all open elements.
+    * ``namespaces``: the namespaces of all scopes.
+    * ``namespacesToAdd``: the ``(name, uri)`` of the namespaces added for
+      the next tag.
+    * ``startTagToWrite``: ``None`` or ``(depth, qualifiedTagName,
+      attributes)`` of a start tag that has not been written yet.
+    """
+    __slots__ = ()
+
+
+class BytesXmlWriter(XmlWriter):
+    """
+    Writer that collects the XML in memory and returns it as ``bytes`` when
+    closed.
+
+    This is faster than writing to an ``io.BytesIO`` because the encoded
+    fragments are simply appended to a list and joined once in the end:
+
+        >>> xml = BytesXmlWriter(pretty=False, prolog=False)
+        >>> xml.startTag("a")
+        >>> xml.text("Hello world!")
+        >>> xml.endTag()
+        >>> xml.close()
+        b'<a>Hello world!</a>'
+    """
+    __slots__ = ()
+
+    def __init__(self, **settings):
+        """
+        Initialize ``BytesXmlWriter`` using the same ``settings`` as
+        `XmlWriter` except that there is no ``output``.
+        """
+        super(BytesXmlWriter, self).__init__([], **settings)
+
+    def _bindOutput(self, output):
+        self._output = output
+        self._outputWrite = output.append
+
+    def reset(self, output=None):
+        """
+        Reset the writer to start a new document, discarding the XML
+        collected so far. The optional ``output`` is a list the encoded
+        fragments are appended to.
+        """
+        if output is None:
+            output = []
+        super(BytesXmlWriter, self).reset(output)
+
+    def getvalue(self):
+        """
+        The XML written so far as ``bytes``.
+        """
+        return b"".join(self._output)
+
+    def close(self):
+        """
+        Close the writer like `XmlWriter.close()` and return the XML written
+        as ``bytes``.
+        """
+        super(BytesXmlWriter, self).close()
+        return self.getvalue()
+
+
+class TreeXmlWriter(XmlWriter):
+    """
+    Writer that builds an ElementTree in memory instead of writing XML to an
+    output, with the same validation and namespace handling as `XmlWriter`.
+
+    This is useful for small documents that have to be processed further
+    because there is no need to serialize and parse them again:
+
+        >>> xml = TreeXmlWriter()
+        >>> xml.addNamespace("xhtml", "http://www.w3.org/1999/xhtml")
+        >>> xml.startTag("xhtml:html")
+        >>> xml.startTag("xhtml:body", {"id": "top"})
+        >>> xml.text("Hello world!")
+        >>> xml.endTag()
+        >>> xml.endTag()
+        >>> root = xml.close()
+        >>> root.find("{http://www.w3.org/1999/xhtml}body").text
+        'Hello world!'
+
+    Names of elements and attributes in the tree use Clark notation, so the
+    tree does not include any ``xmlns`` attributes.
+
+    By default, the tree is built using a
+    ``xml.etree.ElementTree.TreeBuilder``. To use another tree builder, for
+    example the one of lxml, pass it as ``treeBuilder``.
+
+    The tree has exactly one root element. Text, comments and processing
+    instructions outside of it cannot be represented and result in an
+    `XmlError`, except for white space, which is ignored. `raw()` is not
+    supported either.
+    """
+    __slots__ = ("_hasRoot", "_treeDepth")
+
+    def __init__(self, treeBuilder=None, sourceEncoding="ascii"):
+        self._configure(sourceEncoding)
+        self.reset(treeBuilder)
+
+    def _configure(self, sourceEncoding="ascii"):
+        super(TreeXmlWriter, self)._configure(pretty=False, prolog=False, sourceEncoding=sourceEncoding)
+
+    def _bindOutput(self, output):
+        self._output = output
+        self._outputWrite = None
+
+    def reset(self, treeBuilder=None):
+        """
+        Reset the writer to start a new tree, optionally using ``treeBuilder``.
+        """
+        if treeBuilder is None:
+            from xml.etree import ElementTree
+            try:
+                treeBuilder = ElementTree.TreeBuilder(insert_comments=True, insert_pis=True)
+            except TypeError:
+                # Python 3.7 and older cannot add comments and processing
+                # instructions to the tree.
+                treeBuilder = ElementTree.TreeBuilder()
+        super(TreeXmlWriter, self).reset(treeBuilder)
+        self._hasRoot = False
+        self._treeDepth = 0
+
+    @property
+    def treeBuilder(self):
+        """The tree builder used to build the tree."""
+        return self._output
+
+    def _validateIsInRoot(self, name):
+        if not self._treeDepth:
+            raise XmlError("%s must be inside of the root element" % name)
+
+    def _clarkName(self, qualifiedName):
+        namespace, name = _splitPossiblyQualifiedName("name", qualifiedName)
+        if namespace:
+            result = "{%s}%s" % (self._namespaceUri(namespace), name)
+        else:
+            result = name
+        return result
+
+    def _actuallyWriteTag(self, depth, qualifiedTagName, attributes, close):
+        assert self._startTagToWrite is None
+        clarkTagName = self._clarkName(qualifiedTagName)
+        if close == XmlWriter._CLOSE_AT_START:
+            self._output.end(clarkTagName)
+            self._treeDepth -= 1
+        else:
+            if not self._treeDepth:
+                if self._hasRoot:
+                    raise XmlError("tree must have only one root element but also got: %s" % qualifiedTagName)
+                self._hasRoot = True
+            clarkAttributes = {}
+            for attributeName, attributeValue in attributes.items():
+                if (attributeName != "xmlns") and not attributeName.startswith("xmlns:"):
+                    clarkAttributes[self._clarkName(attributeName)] = attributeValue
+            self._output.start(clarkTagName, clarkAttributes)
+            if close == XmlWriter._CLOSE_AT_END:
+                self._output.end(clarkTagName)
+            else:
+                self._treeDepth += 1
+
+    def _write(self, text):
+        assert text is not None
+        if text and not text.isspace():
+            self._validateIsInRoot("text")
+        if self._treeDepth:
+            self._output.data(text)
+
+    def _writeText(self, uniText):
+        self._write(uniText)
+
+    def _writeComment(self, uniText, embedInBlanks):
+        self._validateIsInRoot("comment")
+        if embedInBlanks:
+            if not (uniText and uniText[0].isspace()):
+                uniText = " " + uniText
+            if not ((len(uniText) > 1) and uniText[-1].isspace()):
+                uniText += " "
+        addComment = getattr(self._output, "comment", None)
+        if addComment is not None:
+            addComment(uniText)
+
+    def _writeRawBlock(self, start, uniText, end):
+        if start == XmlWriter._CDATA_START:
+            self._writeText(uniText)
+        else:
+            assert start == XmlWriter._PROCESSING_START
+            self._validateIsInRoot("processing instruction")
+            target, _, data = uniText.partition(" ")
+            addProcessingInstruction = getattr(self._output, "pi", None)
+            if addProcessingInstruction is not None:
+                addProcessingInstruction(target, data)
+
+    def raw(self, text):
+        """
+        Not supported because raw text cannot be added to a tree.
+        """
+        raise XmlError("raw text cannot be added to a tree")
+
+    def deferred(self, qualifiedName, attributes={}, spoolSize=_DEFAULT_SPOOL_SIZE):
+        """
+        Not supported because elements are added to the tree right away.
+        """
+        raise XmlError("deferred tags cannot be added to a tree")
+
+    def placeholder(self, attributeName, width):
+        """
+        Not supported because a tree is not written to a seekable output.
+        """
+        raise XmlError("placeholders cannot be added to a tree")
+
+    def cached(self, key):
+        """
+        Not supported because a tree has no bytes to cache.
+        """
+        raise XmlError("fragments cannot be cached for a tree")
+
+    def fragment(self):
+        """
+        Not supported because elements are added to the tree right away.
+        """
+        raise XmlError("fragments cannot be added to a tree")
+
+    def close(self):
+        """
+        Close the writer like `XmlWriter.close()` and return the root
+        element of the tree.
+        """
+        super(TreeXmlWriter, self).close()
+        if not self._hasRoot:
+            raise XmlError("tree must have a root element")
+        return self._output.close()
+
+
+class ChainTreeXmlWriter(ChainXmlWriter, TreeXmlWriter):
+    """
+    `TreeXmlWriter` that allows to chain methods like `ChainXmlWriter`.
+
+        >>> root = ChainTreeXmlWriter().startTag("a").tag("b").endTag().close()
+        >>> [child.tag for child in root]
+        ['b']
+    """
+    __slots__ = ()
+
+
+class TeeXmlWriter(XmlWriter):
+    """
+    Writer that writes the same document to several outputs, each with its
+    own settings. Names, namespaces and attributes are validated and
+    converted only once for all outputs, so writing to two outputs takes a
+    lot less than twice the time of writing them one after another.
+
+    For example, to write pretty printed UTF-8 for humans and compact
+    ISO-8859-1 for other programs:
+
+        >>> import io
+        >>> prettyOut = io.BytesIO()
+        >>> compactOut = io.BytesIO()
+        >>> xml = TeeXmlWriter([
+        ...     (prettyOut, {"newline": "\\n"}),
+        ...     (compactOut, {"pretty": False, "encoding": "iso-8859-1", "errors": "xmlcharrefreplace"}),
+        ... ])
+        >>> xml.startTag("prices")
+        >>> xml.tag("price", {"currency": "\\u20ac"})
+        >>> xml.endTag()
+        >>> xml.close()
+        >>> print(prettyOut.getvalue().decode("utf-8"))
+        <?xml version="1.0" encoding="utf-8"?>
+        <prices>
+          <price currency="\u20ac" />
+        </prices>
+        <BLANKLINE>
+        >>> compactOut.getvalue()
+        b'<?xml version="1.0" encoding="iso-8859-1"?><prices><price currency="&#8364;"/></prices>'
+
+    The settings can be anything `XmlWriter()` accepts except
+    ``sourceEncoding``, ``invalidChars`` and ``canonical``. The first two
+    apply to all outputs and have to be passed to the `TeeXmlWriter` itself;
+    attribute values are sanitized using the rules of XML 1.0. Canonical
+    XML is not supported.
+
+    To access properties like `bytePosition` or `outputHash` for a certain
+    output, use `writers`. Features that depend on the position in a single
+    output, like `deferred()`, `placeholder()` and `checkpoint()`, are not
+    available.
+    """
+    __slots__ = ("_writers",)
+
+    def __init__(self, outputsAndSettings, sourceEncoding="ascii", invalidChars=None):
+        outputs = []
+        self._writers = []
+        for output, settings in outputsAndSettings:
+            for name in ("canonical", "invalidChars", "sourceEncoding"):
+                if name in settings:
+                    raise XmlError("setting %r must be passed to TeeXmlWriter instead of an output" % name)
+            writer = XmlWriter.__new__(XmlWriter)
+            writer._configure(sourceEncoding=sourceEncoding, invalidChars=invalidChars, **settings)
+            self._writers.append(writer)
+            outputs.append(output)
+        self._configure(pretty=False, prolog=False, sourceEncoding=sourceEncoding, invalidChars=invalidChars)
+        self.reset(outputs)
+
+    def _bindOutput(self, outputs):
+        outputs = tuple(outputs)
+        if len(outputs) != len(self._writers):
+            raise XmlError("number of outputs must be %d but is %d" % (len(self._writers), len(outputs)))
+        for writer, output in zip(self._writers, outputs):
+            writer.reset(output)
+        self._output = outputs
+        self._outputWrite = None
+
+    def reset(self, outputs):
+        """
+        Reset the writer to start a new document on ``outputs``, which must
+        be as many as there were outputs before.
+        """
+        super(TeeXmlWriter, self).reset(outputs)
+        # Let all writers share the element stack for their indentation.
+        for writer in self._writers:
+            writer._elementStack = self._elementStack
+
+    @property
+    def writers(self):
+        """The `XmlWriter` for each output."""
+        return tuple(self._writers)
+
+    def _actuallyWriteTag(self, depth, qualifiedTagName, attributes, close):
+        assert self._startTagToWrite is None
+        for writer in self._writers:
+            writer._actuallyWriteTag(depth, qualifiedTagName, attributes, close)
+
+    def _write(self, text):
+        for writer in self._writers:
+            writer._write(text)
+
+    def _writeText(self, uniText):
+        for writer in self._writers:
+            writer._writeText(uniText)
+
+    def _writeComment(self, uniText, embedInBlanks):
+        for writer in self._writers:
+            writer._writeComment(uniText, embedInBlanks)
+
+    def _writeRawBlock(self, start, uniText, end):
+        for writer in self._writers:
+            writer._writeRawBlock(start, uniText, end)
+
+    def newline(self):
+        self._possiblyFlushTag()
+        for writer in self._writers:
+            writer.newline()
+
+    def deferred(self, qualifiedName, attributes={}, spoolSize=_DEFAULT_SPOOL_SIZE):
+        """
+        Not supported because outputs need different start tags.
+        """
+        raise XmlError("deferred tags cannot be written to several outputs")
+
+    def placeholder(self, attributeName, width):
+        """
+        Not supported because the positions differ between outputs.
+        """
+        raise XmlError("placeholders cannot be written to several outputs")
+
+    def cached(self, key):
+        """
+        Not supported because the bytes differ between outputs.
+        """
+        raise XmlError("fragments cannot be cached for several outputs")
+
+    def fragment(self):
+        """
+        Not supported because the bytes differ between outputs.
+        """
+        raise XmlError("fragments cannot be written to several outputs")
+
+    def checkpoint(self):
+        """
+        Not supported because the positions differ between outputs.
+        """
+        raise XmlError("checkpoint cannot be set for several outputs")
+
+    def flush(self):
+        """
+        Flush the writers for all outputs using `XmlWriter.flush()`.
+        """
+        for writer in self._writers:
+            writer.flush()
+
+    def close(self):
+        """
+        Close the writer and the writers for all outputs.
+        """
+        super(TeeXmlWriter, self).close()
+        for writer in self._writers:
+            writer.close()
+
+
+class RecordingXmlWriter(XmlWriter):
+    """
+    Writer that records a section of XML as a log of operations instead of
+    writing it, so it can be written again and again using
+    `XmlWriter.replay()`. This is useful for sections that are part of many
+    documents or occur many times in the same document, for example
+    a product description.
+
+    The log returned by `close()` consists only of tuples, strings and
+    dictionaries, so it can be stored using ``marshal`` or ``pickle``:
+
+        >>> import marshal
+        >>> recorder = RecordingXmlWriter()
+        >>> recorder.tag("hr")
+        >>> hrLog = marshal.loads(marshal.dumps(recorder.close()))
+        >>> xml = BytesXmlWriter(prolog=False, pretty=False)
+        >>> xml.replay(hrLog)
+        >>> xml.close()
+        b'<hr/>'
+
+    The section can consist of any number of elements, but each of them
+    must have been ended. Namespaces used in the section must be added
+    within it. Names, namespaces and ``invalidChars`` are handled while
+    recording; the settings to render the XML, for example
+    ``pretty`` and ``encoding``, are those of the writer replaying it.
+    """
+    __slots__ = ()
+
+    def __init__(self, sourceEncoding="ascii", invalidChars=None):
+        self._configure(pretty=False, prolog=False, sourceEncoding=sourceEncoding, invalidChars=invalidChars)
+        self.reset()
+
+    def _bindOutput(self, output):
+        self._output = output
+        self._outputWrite = None
+
+    def reset(self, output=None):
+        """
+        Reset the writer to record another section, discarding the
+        operations recorded so far. The optional ``output`` is a list the
+        operations are appended to.
+        """
+        if output is None:
+            output = []
+        super(RecordingXmlWriter, self).reset(output)
+
+    def _actuallyWriteTag(self, depth, qualifiedTagName, attributes, close):
+        assert self._startTagToWrite is None
+        namespacesForScope = None
+        if close != XmlWriter._CLOSE_AT_START:
+            # Remember the namespaces added by this tag.
+            namespacesForScope = self._namespaces.get(depth)
+            if namespacesForScope:
+                namespacesForScope = tuple(namespacesForScope)
+        self._output.append((_OP_TAG, qualifiedTagName, attributes, close, namespacesForScope))
+
+    def _write(self, text):
+        if text:
+            self._output.append((_OP_WRITE, text))
+
+    def _writeText(self, uniText):
+        if uniText:
+            self._output.append((_OP_TEXT, uniText))
+
+    def _writeComment(self, uniText, embedInBlanks):
+        self._output.append((_OP_COMMENT, uniText, embedInBlanks))
+
+    def _writeRawBlock(self, start, uniText, end):
+        self._output.append((_OP_RAW_BLOCK, start, uniText, end))
+
+    def newline(self):
+        self._possiblyFlushTag()
+        self._output.append((_OP_NEWLINE,))
+
+    def deferred(self, qualifiedName, attributes={}, spoolSize=_DEFAULT_SPOOL_SIZE):
+        """
+        Not supported because there is no output to collect the content in.
+        """
+        raise XmlError("deferred tags cannot be recorded")
+
+    def placeholder(self, attributeName, width):
+        """
+        Not supported because there is no output to seek.
+        """
+        raise XmlError("placeholders cannot be recorded")
+
+    def cached(self, key):
+        """
+        Not supported because there are no bytes to cache.
+        """
+        raise XmlError("fragments cannot be cached while recording")
+
+    def fragment(self):
+        """
+        Not supported because there are no bytes to add.
+        """
+        raise XmlError("fragments cannot be recorded")
+
+    def checkpoint(self):
+        """
+        Not supported because there is no output to resume.
+        """
+        raise XmlError("checkpoint cannot be set while recording")
+
+    def close(self):
+        """
+        Close the writer like `XmlWriter.close()` and return the recorded
+        operations as a tuple.
+        """
+        if self._namespacesToAdd:
+            namespaceNames = ", ".join([name for name, _ in self._namespacesToAdd])
+            raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+        super(RecordingXmlWriter, self).close()
+        return tuple(self._output)
+
+
+class XmlWriterFactory(object):
+    """
+    Factory to create many writers with the same settings.
+
+    The settings are converted and validated only once and the XML prolog is
+    encoded in advance, which makes creating a writer much cheaper:
+
+        >>> import io
+        >>> factory = XmlWriterFactory(pretty=False, encoding="iso-8859-1")
+        >>> out = io.BytesIO()
+        >>> xml = factory.create(out)
+        >>> xml.tag("a")
+        >>> xml.close()
+        >>> out.getvalue()
+        b'<?xml version="1.0" encoding="iso-8859-1"?><a/>'
+
+    Use ``writerClass`` to create writers of a different type, for example
+    `ChainXmlWriter`.
+    """
+    __slots__ = ("_template", "_writerClass")
+
+    def __init__(self, writerClass=None, **settings):
+        if writerClass is None:
+            writerClass = XmlWriter
+        self._writerClass = writerClass
+        self._template = writerClass.__new__(writerClass)
+        self._template._configure(**settings)
+
+    def create(self, output=None):
+        """
+        A new writer for ``output`` using the settings of the factory.
+        Writers that do not need an ``output``, for example `BytesXmlWriter`,
+        can omit it; for other writers, this raises an `XmlError`.
+        """
+        result = self._writerClass.__new__(self._writerClass)
+        result._configureLike(self._template)
+        result.reset(output)
+        return result
+
+
+class XmlProfileStats(collections.namedtuple("XmlProfileStats", ["count", "time", "byteCount"])):
+    """
+    Statistics collected by `XmlProfiler`: the number of calls, the
+    cumulative time in seconds and the number of bytes written.
+    """
+    __slots__ = ()
+
+
+class XmlProfiler(object):
+    """
+    Profiler that attributes the time spent writing XML to the public
+    methods of a writer and the tag names used.
+
+    Use it as context manager to profile a writer within a block:
+
+        >>> import io
+        >>> xml = XmlWriter(io.BytesIO())
+        >>> with XmlProfiler(xml) as profiler:
+        ...     xml.startTag("a")
+        ...     for _ in range(3):
+        ...         xml.tag("b", {"x": "1"})
+        ...     xml.endTag()
+        >>> profiler.methodStats["tag"].count
+        3
+        >>> profiler.tagStats["b"].count
+        3
+        >>> print(profiler.report().splitlines()[0])
+        method                                  calls     seconds        bytes
+
+    While profiling, the class of the writer is replaced by a subclass that
+    measures each call, and the original class is restored at the end of the
+    block. Consequently writers that are not profiled have no overhead at all.
+
+    Only the outermost calls are measured, so for example the calls to
+    `endTag()` performed by `endTags()` count for ``endTags``. Because start
+    tags are written only once it is clear whether they are empty, their
+    bytes count for the call after `startTag()`.
+
+    To profile several blocks, call `start()` and `stop()` or use the profiler
+    as context manager again; the statistics are accumulated.
+    """
+    METHOD_NAMES = (
+        "addNamespace", "cdata", "close", "comment", "element", "endTag", "endTags", "newline",
+        "processingInstruction", "raw", "replay", "startTag", "tag", "text", "writeIterparse",
+    )
+
+    def __init__(self, writer, timer=None):
+        assert writer is not None
+        if timer is None:
+            import time
+            timer = getattr(time, "perf_counter", time.time)
+        self._writer = writer
+        self._timer = timer
+        self._originalClass = None
+        self._profiledClasses = {}
+        self._isInCall = False
+        # Map method and tag names to [count, time, byteCount].
+        self._methodStats = {}
+        self._tagStats = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def isProfiling(self):
+        """``True`` between `start()` and `stop()`."""
+        return self._originalClass is not None
+
+    def start(self):
+        """
+        Start profiling the writer.
+        """
+        if self.isProfiling:
+            raise XmlError("profiler must be stopped before it can be started again")
+        self._originalClass = self._writer.__class__
+        profiledClass = self._profiledClasses.get(self._originalClass)
+        if profiledClass is None:
+            profiledClass = self._createProfiledClass(self._originalClass)
+            self._profiledClasses[self._originalClass] = profiledClass
+        self._writer.__class__ = profiledClass
+
+    def stop(self):
+        """
+        Stop profiling the writer.
+        """
+        if not self.isProfiling:
+            raise XmlError("profiler must be started before it can be stopped")
+        self._writer.__class__ = self._originalClass
+        self._originalClass = None
+
+    def _createProfiledClass(self, writerClass):
+        # An empty ``__slots__`` keeps the memory layout so ``__class__`` can
+        # be changed.
+        classAttributes = {"__slots__": ()}
+        for methodName in XmlProfiler.METHOD_NAMES:
+            method = getattr(writerClass, methodName, None)
+            if method is not None:
+                classAttributes[methodName] = self._profiledMethod(methodName, method)
+        return type(str("Profiled" + writerClass.__name__), (writerClass,), classAttributes)
+
+    def _profiledMethod(self, methodName, method):
+        profiler = self
+        timer = self._timer
+        isStartTag = methodName in ("startTag", "tag")
+        isEndTag = (methodName == "endTag")
+
+        def profiledMethod(writer, *arguments, **keywords):
+            if profiler._isInCall:
+                return method(writer, *arguments, **keywords)
+            tagName = None
+            if isStartTag:
+                if arguments:
+                    tagName = arguments[0]
+                else:
+                    tagName = keywords.get("qualifiedName")
+                tagName = writer._unicodedFromString(tagName)
+            elif isEndTag and writer._elementStack:
+                tagName = _joinPossiblyQualifiedName(*writer._elementStack[-1])
+            profiler._isInCall = True
+            bytePositionBefore = writer._bytePosition
+            startTime = timer()
+            try:
+                return method(writer, *arguments, **keywords)
+            finally:
+                duration = timer() - startTime
+                profiler._isInCall = False
+                byteCount = writer._bytePosition - bytePositionBefore
+                profiler._add(profiler._methodStats, methodName, duration, byteCount)
+                if tagName:
+                    profiler._add(profiler._tagStats, tagName, duration, byteCount)
+        profiledMethod.__name__ = str(methodName)
+        profiledMethod.__doc__ = method.__doc__
+        return profiledMethod
+
+    def _add(self, statsMap, name, duration, byteCount):
+        stats = statsMap.get(name)
+        if stats is None:
+            statsMap[name] = [1, duration, byteCount]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] += byteCount
+
+    @property
+    def methodStats(self):
+        """
+        Dictionary mapping the names of the methods called to their
+        `XmlProfileStats`.
+        """
+        return dict([(name, XmlProfileStats(*stats)) for name, stats in self._methodStats.items()])
+
+    @property
+    def tagStats(self):
+        """
+        Dictionary mapping the qualified tag names used with `startTag()`,
+        `tag()` and `endTag()` to their `XmlProfileStats`.
+        """
+        return dict([(name, XmlProfileStats(*stats)) for name, stats in self._tagStats.items()])
+
+    def reset(self):
+        """
+        Discard all statistics collected so far.
+        """
+        self._methodStats.clear()
+        self._tagStats.clear()
+
+    def report(self):
+        """
+        Human readable report of the statistics with the most expensive
+        methods and tags first.
+        """
+        lines = []
+        for title, statsMap in (("method", self._methodStats), ("tag", self._tagStats)):
+            if statsMap:
+                if lines:
+                    lines.append("")
+                lines.append("%-35s %9s %11s %12s" % (title, "calls", "seconds", "bytes"))
+                for name, (count, duration, byteCount) in sorted(
+                        statsMap.items(), key=lambda item: (-item[1][1], item[0])):
+                    lines.append("%-35s %9d %11.6f %12d" % (name, count, duration, byteCount))
+        return "\n".join(lines)
+
+
+def _chainable(name):
+    """
+    Method of `ChainXmlWriter` that calls the original method ``name`` and
+    returns the writer so further calls can be chained.
+    """
+    def chainedMethod(self, *args, **kwargs):
+        getattr(super(ChainXmlWriter, self), name)(*args, **kwargs)
+        return self
+    chainedMethod.__name__ = str(name)
+    # Do not copy the original docstring because its examples would run
+    # as doctests of `ChainXmlWriter` too.
+    chainedMethod.__doc__ = "Same as `XmlWriter.%s()` but returns self." % name
+    return chainedMethod
+
+# Add the chainable methods to the class once instead of wrapping them on
+# every attribute access.
+for _methodName in ChainXmlWriter.chainableMethods:
+    setattr(ChainXmlWriter, _methodName, _chainable(_methodName))
+del _methodName
+
+
+# Number of bytes the command line converter reads and writes at once.
+_CONVERTER_BUFFER_SIZE = 1024 * 1024
+
+# Number of bytes of the input each process converts at once when the
+# command line converter uses several processes.
+_CONVERTER_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Compressions supported by the command line converter and the suffix of
+# files that use them.
+_CONVERTER_COMPRESSIONS = collections.OrderedDict([("gzip", ".gz"), ("bz2", ".bz2"), ("xz", ".xz")])
+
+
+def _xmlNameFor(key):
+    """
+    ``key`` changed to a valid XML name without namespace by replacing
+    characters that must not occur in it by underscores (_). Names starting
+    with "xml" in any case are reserved, for example ``xmlns`` would
+    declare a namespace, so they get an underscore as prefix too.
+
+        >>> _xmlNameFor("first name")
+        'first_name'
+        >>> _xmlNameFor("2nd:try")
+        '_2nd_try'
+        >>> _xmlNameFor("xmlns")
+        '_xmlns'
+    """
+    nameStartCharRegEx, nameCharRegEx = XmlWriter._nameRegExes()
+    result = "".join([char if nameCharRegEx.match(char) else "_" for char in "%s" % key])
+    if not (result and nameStartCharRegEx.match(result[0])) or (result[:3].lower() == "xml"):
+        result = "_" + result
+    return result
+
+
+def _rowText(value):
+    if isinstance(value, bool):
+        # Use the JSON notation instead of the Python one.
+        result = "true" if value else "false"
+    else:
+        result = unicode_type(value)
+    return result
+
+
+# Marks the end of an element on the stack of `_writeRowValue()`.
+_END_OF_ROW_ELEMENT = object()
+
+
+def _writeRowValue(xml, name, value, attributes, names):
+    # The names already are valid, so use the same primitives as
+    # `XmlWriter.replay()` instead of validating them again and again.
+    elementStack = xml._elementStack
+    # Instead of recursion, use a stack of pairs (name, value) still to be
+    # written so deeply nested values cannot exceed the recursion limit.
+    valuesToWrite = [(name, value)]
+    while valuesToWrite:
+        name, value = valuesToWrite.pop()
+        depth = len(elementStack)
+        if value is _END_OF_ROW_ELEMENT:
+            elementStack.pop()
+            xml._actuallyWriteTag(depth - 1, name, _NO_ATTRIBUTES, XmlWriter._CLOSE_AT_START)
+        elif isinstance(value, dict):
+            attributeValues = {}
+            # Keys of the attributes written so far.
+            attributeKeys = {}
+            children = []
+            for key, childValue in value.items():
+                childName = names.get(key)
+                if childName is None:
+                    childName = _xmlNameFor(key)
+                    names[key] = childName
+                if isinstance(childValue, list) and not childValue:
+                    # Empty lists result in no elements at all.
+                    pass
+                elif attributes and not isinstance(childValue, (dict, list)):
+                    if childValue is not None:
+                        if childName in attributeValues:
+                            raise XmlError("keys %r and %r must not both result in attribute %r" % (
+                                attributeKeys[childName], key, childName))
+                        attributeValue = _rowText(childValue)
+                        if xml._sanitizeAttributeValue is not None:
+                            attributeValue = xml._sanitizeAttributeValue(attributeValue)
+                        attributeValues[childName] = attributeValue
+                        attributeKeys[childName] = key
+                else:
+                    children.append((childName, childValue))
+            if children:
+                xml._actuallyWriteTag(depth, name, attributeValues, XmlWriter._CLOSE_NONE)
+                elementStack.append((None, name))
+                valuesToWrite.append((name, _END_OF_ROW_ELEMENT))
+                valuesToWrite.extend(reversed(children))
+            else:
+                xml._actuallyWriteTag(depth, name, attributeValues, XmlWriter._CLOSE_AT_END)
+        elif isinstance(value, list):
+            valuesToWrite.extend([(name, item) for item in reversed(value)])
+        elif value is None:
+            xml._actuallyWriteTag(depth, name, _NO_ATTRIBUTES, XmlWriter._CLOSE_AT_END)
+        else:
+            xml._actuallyWriteTag(depth, name, _NO_ATTRIBUTES, XmlWriter._CLOSE_NONE)
+            elementStack.append((None, name))
+            xml._writeText(_rowText(value))
+            elementStack.pop()
+            xml._actuallyWriteTag(depth, name, _NO_ATTRIBUTES, XmlWriter._CLOSE_AT_START)
+
+
+def writeRows(xml, rows, rowName="row", attributes=False):
+    """
+    Write each of ``rows`` as element ``rowName`` using the `XmlWriter`
+    ``xml`` and return the number of rows written. Rows typically are
+    dictionaries as returned by ``json.loads()`` or ``csv.DictReader``.
+
+        >>> xml = BytesXmlWriter(pretty=False, prolog=False)
+        >>> xml.startTag("rows")
+        >>> writeRows(xml, [{"id": 1, "name": "Ann", "tags": ["a", "b"]}, {"id": 2, "first name": None}])
+        2
+        >>> xml.endTag()
+        >>> xml.close()
+        b'<rows><row><id>1</id><name>Ann</name><tags>a</tags><tags>b</tags></row><row><id>2</id><first_name/></row></rows>'
+
+    Keys are changed to valid XML names that do not start with "xml", so
+    they cannot declare namespaces. Dictionaries result in elements
+    with an element for each of their items, lists result in an element
+    for each of their items, ``None`` results in an empty element and
+    anything else results in an element with text.
+
+    Set ``attributes`` to ``True`` to write items with values that are
+    neither dictionaries nor lists as attributes; items with ``None`` as
+    value are omitted then:
+
+        >>> xml = BytesXmlWriter(pretty=False, prolog=False)
+        >>> writeRows(xml, [{"id": 1, "name": None, "ok": True, "address": {"city": "Graz"}}], attributes=True)
+        1
+        >>> xml.close()
+        b'<row id="1" ok="true"><address city="Graz"/></row>'
+
+    Keys that result in the same attribute name, for example ``"a b"``
+    and ``"a_b"``, raise an `XmlError`.
+    """
+    assert xml is not None
+    assert rows is not None
+    assert rowName
+    xml._validateIsOpen()
+    if xml._namespacesToAdd:
+        namespaceNames = ", ".join([name for name, _ in xml._namespacesToAdd])
+        raise XmlError("namespaces must be added before startTag() or tag(): %s" % namespaceNames)
+    uniRowName = xml._unicodedFromString(rowName)
+    if _xmlNameFor(uniRowName) != uniRowName:
+        raise XmlError("row name must be a valid XML name but is: %r" % uniRowName)
+    xml._possiblyFlushTag()
+    # Cache the names because the same keys occur in most rows.
+    names = {}
+    result = 0
+    for row in rows:
+        _writeRowValue(xml, uniRowName, row, attributes, names)
+        result += 1
+    return result
+
+
+def _jsonRows(inputFile):
+    import json
+
+    for lineNumber, line in enumerate(inputFile, 1):
+        if line.strip():
+            if isinstance(line, bytes_type) and (bytes_type is not str):
+                line = line.decode("utf-8")
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                raise ValueError("line %d: %s" % (lineNumber, error))
+
+
+def _csvRows(inputFile, encoding, delimiter):
+    import csv
+    import io
+
+    textFile = io.TextIOWrapper(inputFile, encoding=encoding, newline="")
+    # Collect values of rows with more fields than the header in "_extra".
+    return csv.DictReader(textFile, delimiter=delimiter, restkey="_extra")
+
+
+def _lineAlignedRanges(path, chunkSize):
+    """
+    Pairs ``(start, end)`` of byte ranges of about ``chunkSize`` bytes that
+    cover the file ``path`` and end after a newline or at the end of file.
+    """
+    import io
+
+    assert chunkSize > 0
+    with io.open(path, "rb") as inputFile:
+        size = os.fstat(inputFile.fileno()).st_size
+        start = 0
+        while start < size:
+            inputFile.seek(min(start + chunkSize, size))
+            # Include the rest of the line the chunk ends in.
+            inputFile.readline()
+            end = inputFile.tell()
+            yield (start, end)
+            start = end
+
+
+def _convertedJsonLinesChunk(task):
+    """
+    XML for the rows in a byte range of a JSON lines file, rendered as if
+    they were within the root element. This runs in the worker processes
+    of the command line converter, so ``task`` holds all parameters.
+    """
+    import io
+
+    path, start, end, rootName, rowName, attributes, writerSettings = task
+    with io.open(path, "rb") as inputFile:
+        inputFile.seek(start)
+        data = inputFile.read(end - start)
+    # Split only at line feeds like reading the file line by line does;
+    # `splitlines()` would also split at carriage returns, which JSON
+    # allows as white space.
+    lines = data.split(b"\n")
+    if not lines[-1]:
+        lines.pop()
+    xml = BytesXmlWriter(prolog=False, **writerSettings)
+    xml._elementStack.append((None, rootName))
+    try:
+        writeRows(xml, _jsonRows(lines), rowName, attributes)
+    except ValueError as error:
+        raise ValueError("byte %d, %s" % (start, error))
+    xml._elementStack.pop()
+    return xml.close()
+
+
+def _writeJsonLinesInParallel(xml, path, rootName, rowName, attributes, writerSettings, jobs, chunkSize):
+    """
+    Write the rows of the JSON lines file ``path`` like `writeRows()`
+    but convert chunks of it in ``jobs`` processes. The writer ``xml``
+    must use ``writerSettings`` and be at the depth within ``rootName``.
+    """
+    import multiprocessing
+
+    assert jobs >= 1
+    xml._possiblyFlushTag()
+    # Limit the number of chunks converted in advance to keep the memory
+    # needed constant.
+    maxPendingChunkCount = 2 * jobs
+    pendingChunks = collections.deque()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for start, end in _lineAlignedRanges(path, chunkSize):
+            if len(pendingChunks) >= maxPendingChunkCount:
+                _writeConvertedChunk(xml, pendingChunks.popleft().get())
+            task = (path, start, end, rootName, rowName, attributes, writerSettings)
+            pendingChunks.append(pool.apply_async(_convertedJsonLinesChunk, (task,)))
+        while pendingChunks:
+            _writeConvertedChunk(xml, pendingChunks.popleft().get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _writeConvertedChunk(xml, data):
+    xml._outputWrite(data)
+    xml._bytePosition += len(data)
+    xml._contentHasBeenWritten = True
+
+
+def _converterCompressionFor(path):
+    for compression, suffix in _CONVERTER_COMPRESSIONS.items():
+        if path.lower().endswith(suffix):
+            return compression
+    return None
+
+
+def _openConverterFile(path, mode, compression, filesToClose):
+    """
+    File for ``path`` opened with ``mode`` ("rb" or "wb"), possibly using
+    ``compression``. Files that have to be closed afterwards are appended
+    to ``filesToClose``; standard input and output are not closed.
+    """
+    import io
+
+    if path == "-":
+        standardFile = sys.stdin if mode == "rb" else sys.stdout
+        # Python 3 wraps the binary streams in text streams.
+        result = getattr(standardFile, "buffer", standardFile)
+    else:
+        result = io.open(path, mode, buffering=_CONVERTER_BUFFER_SIZE)
+        filesToClose.append(result)
+    if compression == "gzip":
+        import gzip
+        result = gzip.GzipFile(fileobj=result, mode=mode, compresslevel=6)
+    elif compression == "bz2":
+        import bz2
+        result = bz2.BZ2File(result, mode)
+    elif compression == "xz":
+        import lzma
+        result = lzma.LZMAFile(result, mode)
+    else:
+        assert compression is None, "compression=%r" % compression
+    if compression is not None:
+        filesToClose.append(result)
+        if mode == "wb":
+            # Let the compressor process large chunks instead of the many
+            # small fragments the writer produces.
+            result = io.BufferedWriter(result, _CONVERTER_BUFFER_SIZE)
+            filesToClose.append(result)
+    return result
+
+
+def _createConverterParser():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m loxun",
+        description="Convert JSON lines or CSV to XML with an element for each line or row.")
+    parser.add_argument("--version", action="version", version="loxun %s" % __version__)
+    parser.add_argument(
+        "input", nargs="?", default="-",
+        help="file to convert; files ending in %s are decompressed; default: standard input" % ", ".join(_CONVERTER_COMPRESSIONS.values()))
+    parser.add_argument("-o", "--output", default="-", help="XML file to write; default: standard output")
+    parser.add_argument(
+        "-f", "--format", choices=("ndjson", "csv"),
+        help="format of the input; default: csv for files ending in .csv, otherwise ndjson")
+    parser.add_argument("--root", default="rows", help="name of the root element; default: %(default)s")
+    parser.add_argument("--row", default="row", help="name of the element for each row; default: %(default)s")
+    parser.add_argument(
+        "-a", "--attributes", action="store_true",
+        help="write values that are neither objects nor arrays as attributes instead of elements")
+    parser.add_argument("-c", "--compact", action="store_true", help="write XML without pretty printing")
+    parser.add_argument(
+        "-z", "--compress", choices=tuple(_CONVERTER_COMPRESSIONS.keys()),
+        help="compress the output; default: depending on the suffix of OUTPUT")
+    parser.add_argument("--encoding", default="utf-8", help="encoding of the XML; default: %(default)s")
+    parser.add_argument("--csv-encoding", default="utf-8", help="encoding of CSV input; default: %(default)s")
+    parser.add_argument("--csv-delimiter", default=",", help="delimiter of CSV input; default: %(default)s")
+    parser.add_argument(
+        "--invalid-chars", choices=_INVALID_CHARS_MODES,
+        help="what to do with characters that must not occur in XML; default: write them")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of processes to convert a JSON lines file with; default: %(default)s")
+    parser.add_argument(
+        "--chunk-size", type=int, default=_CONVERTER_CHUNK_SIZE,
+        help="number of bytes each process converts at once with --jobs; default: %(default)s")
+    parser.add_argument("--doctest", action="store_true", help="run the doctests of loxun and exit")
+    return parser
+
+
+def main(arguments=None):
+    """
+    Convert JSON lines or CSV to XML as described in
+    `Converting JSON lines and CSV`_ using the command line ``arguments``,
+    by default ``sys.argv[1:]``, and return the exit code.
+    """
+    parser = _createConverterParser()
+    options = parser.parse_args(arguments)
+    for optionName, name in (("--root", options.root), ("--row", options.row)):
+        if _xmlNameFor(name) != name:
+            parser.error("%s must be a valid XML name but is: %r" % (optionName, name))
+    if options.doctest:
+        import doctest
+        print("loxun %s: running doctest" % __version__)
+        return 1 if doctest.testmod().failed else 0
+
+    inputCompression = _converterCompressionFor(options.input)
+    inputFormat = options.format
+    if inputFormat is None:
+        inputName = options.input
+        if inputCompression is not None:
+            inputName = inputName[:-len(_CONVERTER_COMPRESSIONS[inputCompression])]
+        inputFormat = "csv" if inputName.lower().endswith(".csv") else "ndjson"
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1 but is: %d" % options.jobs)
+    if options.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1 but is: %d" % options.chunk_size)
+    isParallel = options.jobs > 1
+    if isParallel and ((options.input == "-") or (inputCompression is not None) or (inputFormat != "ndjson")):
+        # CSV values can contain newlines, so rows cannot be split at them.
+        parser.error("--jobs requires an uncompressed JSON lines file as input")
+    outputCompression = options.compress
+    if outputCompression is None:
+        outputCompression = _converterCompressionFor(options.output)
+    writerSettings = {
+        "pretty": not options.compact,
+        "encoding": options.encoding,
+        "errors": "xmlcharrefreplace",
+        "invalidChars": options.invalid_chars,
+    }
+    result = 1
+    filesToClose = []
+    try:
+        if isParallel:
+            # Fail early if the input cannot be read.
+            os.stat(options.input)
+        else:
+            inputFile = _openConverterFile(options.input, "rb", inputCompression, filesToClose)
+            if inputFormat == "csv":
+                rows = _csvRows(inputFile, options.csv_encoding, options.csv_delimiter)
+            else:
+                rows = _jsonRows(inputFile)
+        outputFile = _openConverterFile(options.output, "wb", outputCompression, filesToClose)
+        xml = XmlWriter(outputFile, **writerSettings)
+        xml.startTag(options.root)
+        if isParallel:
+            _writeJsonLinesInParallel(
+                xml, options.input, options.root, options.row, options.attributes, writerSettings,
+                options.jobs, options.chunk_size)
+        else:
+            writeRows(xml, rows, options.row, options.attributes)
+        xml.endTag()
+        xml.close()
+        outputFile.flush()
+        result = 0
+    except (EnvironmentError, LookupError, ValueError, XmlError) as error:
+        sys.stderr.write("loxun: error: %s: %s\n" % (options.input, error))
+    finally:
+        # Close the files in reverse order, compressors before their files.
+        for fileToClose in reversed(filesToClose):
+            try:
+                fileToClose.close()
+            except EnvironmentError as error:
+                if not result:
+                    sys.stderr.write("loxun: error: %s: %s\n" % (options.output, error))
+                    result = 1
+    return result
+
 
 if __name__ == "__main__":
-    import doctest
-    print("loxun %s: running doctest" % __version__)
-    doctest.testmod()
+    sys.exit(main())
 
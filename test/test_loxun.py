@@ -24,8 +24,11 @@ from __future__ import unicode_literals
 import doctest
 import logging
 import io
+import os
 import random
+import subprocess
 import sys
+import time
 import unittest
 
 import loxun
@@ -47,6 +50,8 @@ def _getXmlText(writer):
     result = [line.rstrip(b"\r\n") for line in writer.output]
     return result
 
+_log = logging.getLogger("test_loxun")
+
 _randy = random.Random()
 
 def _randomName():
@@ -55,6 +60,19 @@ def _randomName():
         result += chr(_randy.randint(ord("a"), ord("z")))
     return result
 
+# Timings vary a lot on busy machines, so performance tests only log them
+# unless the environment variable LOXUN_BENCHMARK is set. In that case they
+# fail if the supposedly faster way to write something is clearly slower than
+# the plain way.
+_IS_BENCHMARK = bool(os.environ.get("LOXUN_BENCHMARK"))
+_MAX_SLOWDOWN = 1.5
+
+def _assertNotSlower(testCase, description, duration, baselineDescription, baselineDuration):
+    _log.info("%s took %.3fs, %s took %.3fs", description, duration, baselineDescription, baselineDuration)
+    if _IS_BENCHMARK:
+        testCase.assertTrue(duration <= _MAX_SLOWDOWN * baselineDuration, "%s took %.3fs but %s only %.3fs" % (
+            description, duration, baselineDescription, baselineDuration))
+
 class XmlWriterTest(unittest.TestCase):
     def _assertXmlTextEqual(self, writer, actual):
         assert writer
@@ -164,6 +182,63 @@ class XmlWriterTest(unittest.TestCase):
         xml.close()
         self._assertXmlTextEqual(xml, [])
 
+    def testLegacyEncodingWithCharacterReferences(self):
+        text = "plain, \u20ac 1 \u00e4\u00f6, \u65e5\u672c\u8a9e & \u03b1\u03b2"
+        for encoding in ["ascii", "iso-8859-1", "iso-8859-15", "cp1252", "koi8-r", "cp500"]:
+            out = io.BytesIO()
+            xml = loxun.XmlWriter(out, pretty=False, prolog=False, encoding=encoding, errors="xmlcharrefreplace")
+            xml.tag("a", {"b": text})
+            xml.text(text)
+            xml.close()
+            expected = "<a b=\"%s\"/>%s" % (text.replace("&", "&amp;"), text.replace("&", "&amp;"))
+            self.assertEqual(out.getvalue(), expected.encode(encoding, "xmlcharrefreplace"), encoding)
+
+    def testBrokenCommentEndingWithDash(self):
+        xml = _createXmlStringIoWriter(pretty=False)
+        self.assertRaises(loxun.XmlError, xml.comment, "a-", embedInBlanks=False)
+        xml.comment("a-")
+        xml.close()
+        self._assertXmlTextEqual(xml, [b"<!-- a- -->"])
+
+    def testProcessingInstruction(self):
+        xml = _createXmlStringIoWriter(pretty=False)
+        xml.processingInstruction("pi", "")
+        self.assertRaises(loxun.XmlError, xml.processingInstruction, "", "data")
+        self.assertRaises(loxun.XmlError, xml.processingInstruction, "XML", "data")
+        xml.close()
+        self._assertXmlTextEqual(xml, [b"<?pi?>"])
+
+    def testNamespaceAddedTwiceFails(self):
+        xml = _createXmlStringIoWriter()
+        xml.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, xml.addNamespace, "x", "http://yyy/")
+
+    def testNamespaceBeforeEndTagFails(self):
+        xml = _createXmlStringIoWriter(pretty=False)
+        xml.startTag("a")
+        xml.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, xml.endTag)
+        xml.tag("x:b")
+        xml.endTag()
+        xml.close()
+        self._assertXmlTextEqual(xml, [b'<a><x:b xmlns:x="http://xxx/"/></a>'])
+
+    def testBrokenStartTagKeepsNamespaces(self):
+        xml = _createXmlStringIoWriter(pretty=False)
+        xml.startTag("a")
+        xml.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, xml.startTag, "y:b")
+        xml.tag("x:b")
+        xml.endTag()
+        xml.close()
+        self._assertXmlTextEqual(xml, [b'<a><x:b xmlns:x="http://xxx/"/></a>'])
+
+    def testAttributesInSameNamespaceFail(self):
+        xml = _createXmlStringIoWriter()
+        xml.addNamespace("x", "http://xxx/")
+        xml.addNamespace("y", "http://xxx/")
+        self.assertRaises(loxun.XmlError, xml.tag, "a", {"x:b": "1", "y:b": "2"})
+
     def testNamespacedTag(self):
         xml = _createXmlStringIoWriter()
         xml.addNamespace("x", "http://xxx/");
@@ -224,6 +299,134 @@ class XmlWriterTest(unittest.TestCase):
             # Ignore expected error.
             self.assertEqual(str(error), "test")
 
+    def testHasSlots(self):
+        for writerClass in (loxun.XmlWriter, loxun.ChainXmlWriter):
+            xml = writerClass(io.BytesIO())
+            self.assertFalse(hasattr(xml, "__dict__"))
+            self.assertRaises(AttributeError, setattr, xml, "someAttribute", 1)
+
+    def testChainXmlWriter(self):
+        out = io.BytesIO()
+        xml = loxun.ChainXmlWriter(out, prolog=False, pretty=False)
+        self.assertTrue(xml.startTag("a").text("x").tag("b").endTag("a") is xml)
+        xml.close()
+        self.assertEqual(out.getvalue(), b"<a>x<b/></a>")
+
+    def testReset(self):
+        xml = loxun.XmlWriter(io.BytesIO(), pretty=False)
+        xml.startTag("a")
+        out = io.BytesIO()
+        xml.reset(out)
+        xml.tag("b")
+        xml.close()
+        self.assertEqual(out.getvalue(), b"<?xml version=\"1.0\" encoding=\"utf-8\"?><b/>")
+
+    def testFactory(self):
+        factory = loxun.XmlWriterFactory(writerClass=loxun.ChainXmlWriter, indent="\t", newline="\n")
+        for _ in range(2):
+            out = io.BytesIO()
+            factory.create(out).startTag("a").tag("b").endTag().close()
+            self.assertEqual(out.getvalue(), b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<a>\n\t<b />\n</a>\n")
+
+    def testBytesXmlWriter(self):
+        xml = loxun.BytesXmlWriter(newline="\n")
+        xml.startTag("a")
+        xml.text("\u20ac")
+        xml.endTag()
+        self.assertEqual(xml.close(), b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n<a>\n  \xe2\x82\xac\n</a>\n")
+        xml.reset()
+        self.assertEqual(xml.getvalue(), b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
+
+    def testFactoryWithoutOutputFails(self):
+        self.assertRaises(loxun.XmlError, loxun.XmlWriterFactory(pretty=False).create)
+        self.assertRaises(loxun.XmlError, loxun.XmlWriter(io.BytesIO()).reset, None)
+
+    def testBytesXmlWriterFromFactory(self):
+        factory = loxun.XmlWriterFactory(writerClass=loxun.BytesXmlWriter, pretty=False, prolog=False)
+        xml = factory.create()
+        xml.tag("a")
+        self.assertEqual(xml.close(), b"<a/>")
+
+    def testBytePosition(self):
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, pretty=False)
+        self.assertEqual(xml.bytePosition, len(out.getvalue()))
+        xml.startTag("a")
+        xml.text("\u20ac")
+        xml.endTag()
+        self.assertEqual(xml.bytePosition, len(out.getvalue()))
+
+    def _writeCheckpointDocument(self, out, settings, crashAfterCheckpoint):
+        xml = loxun.XmlWriter(out, **settings)
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:root")
+        xml.tag("x:a", {"id": 1})
+        xml.addNamespace("y", "http://yyy/")
+        xml.startTag("y:b", {"x:id": 2})
+        checkpoint = xml.checkpoint() if crashAfterCheckpoint else None
+        if crashAfterCheckpoint:
+            xml.text("lost")
+            return checkpoint
+        xml.endTag("y:b")
+        xml.endTag("x:root")
+        xml.close()
+        return None
+
+    def testCheckpoint(self):
+        import json
+        import pickle
+        settings = {"newline": "\n"}
+        expectedOut = io.BytesIO()
+        self._writeCheckpointDocument(expectedOut, settings, False)
+        for serialize, deserialize in ((json.dumps, json.loads), (pickle.dumps, pickle.loads)):
+            out = io.BytesIO()
+            checkpoint = self._writeCheckpointDocument(out, settings, True)
+            checkpoint = deserialize(serialize(checkpoint))
+            xml = loxun.XmlWriter.fromCheckpoint(out, checkpoint, **settings)
+            self.assertEqual(xml.bytePosition, len(out.getvalue()))
+            xml.endTag("y:b")
+            xml.endTag("x:root")
+            xml.close()
+            self.assertEqual(out.getvalue(), expectedOut.getvalue())
+
+    def testCheckpointAfterCloseFails(self):
+        xml = _createXmlStringIoWriter()
+        xml.close()
+        self.assertRaises(loxun.XmlError, xml.checkpoint)
+
+    def _expectedPrettyText(self, text, indent, newline):
+        # Reference implementation of pretty printed text as it used to be
+        # written line by line.
+        result = ""
+        for line in io.StringIO(text):
+            result += indent + line.lstrip(" \t").rstrip(" \t\r\n").replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;") + newline
+        return result
+
+    def testPrettyTextWithManyLines(self):
+        randy = random.Random(42)
+        for _ in range(200):
+            text = "".join(randy.choice(" \t\r\nab<&") for _ in range(randy.randint(0, 30)))
+            out = io.BytesIO()
+            xml = loxun.XmlWriter(out, prolog=False, indent="\t", newline="\r\n")
+            xml.startTag("a")
+            xml.text("")
+            startTag = out.getvalue()
+            xml.text(text)
+            expected = self._expectedPrettyText(text, "\t", "\r\n")
+            self.assertEqual(out.getvalue()[len(startTag):], expected.encode("utf-8"), "text=%r" % text)
+
+    def testPrettyTextWithLargeText(self):
+        text = "\n".join(["  line %d with <markup> & stuff  " % lineNumber for lineNumber in range(100000)])
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, prolog=False, newline="\n")
+        xml.startTag("a")
+        xml.text(text)
+        xml.endTag()
+        xml.close()
+        lines = out.getvalue().split(b"\n")
+        self.assertEqual(len(lines), 100003)
+        self.assertEqual(lines[1], b"  line 0 with &lt;markup&gt; &amp; stuff")
+
     def testPerformance(self):
         out = io.BytesIO()
         with loxun.XmlWriter(out) as xml:
@@ -233,6 +436,1987 @@ class XmlWriterTest(unittest.TestCase):
                 attributes[_randomName()] = ""
             xml.tag(tagName, attributes)
 
+class ElementTreeTest(unittest.TestCase):
+    def _canonicalized(self, xmlBytes):
+        from xml.etree import ElementTree
+        return ElementTree.tostring(ElementTree.fromstring(xmlBytes))
+
+    @unittest.skipIf(sys.version_info < (3, 8), "comments and processing instructions require Python 3.8+")
+    def testElement(self):
+        from xml.etree import ElementTree
+        parser = ElementTree.XMLParser(target=ElementTree.TreeBuilder(insert_comments=True, insert_pis=True))
+        root = ElementTree.fromstring(
+            '<a xmlns="http://aaa/" xmlns:b="http://bbb/" b:x="1" xml:lang="de">'
+            'text<!--comment--><b:c>c &lt; d</b:c>tail<?pi data?><d/>end</a>', parser=parser)
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, pretty=False, prolog=False)
+        xml.addNamespace("bb", "http://bbb/")
+        xml.startTag("bb:root")
+        xml.element(root)
+        xml.endTag()
+        xml.close()
+        self.assertEqual(out.getvalue(),
+            b'<bb:root xmlns:bb="http://bbb/"><ns0:a bb:x="1" xml:lang="de" xmlns:ns0="http://aaa/">'
+            b'text<!--comment--><bb:c>c &lt; d</bb:c>tail<?pi data?><ns0:d/>end</ns0:a></bb:root>')
+
+    def testElementIgnoresWhiteSpaceWhenPretty(self):
+        from xml.etree import ElementTree
+        root = ElementTree.fromstring("<a>\n  <b>x</b>\n</a>")
+        xml = loxun.BytesXmlWriter(prolog=False, newline="\n")
+        xml.element(root)
+        self.assertEqual(xml.close(), b"<a>\n  <b>\n    x\n  </b>\n</a>\n")
+
+    def testElementWithDeepNesting(self):
+        from xml.etree import ElementTree
+        depth = 5 * sys.getrecursionlimit()
+        root = ElementTree.Element("e")
+        element = root
+        for _ in range(depth):
+            element = ElementTree.SubElement(element, "e")
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        xml.element(root)
+        self.assertEqual(xml.close(), b"<e>" * depth + b"<e/>" + b"</e>" * depth)
+
+    def testWriteIterparse(self):
+        source = (
+            b'<?xml version="1.0"?><x:items xmlns:x="http://xxx/" xmlns="http://default/">'
+            + b"".join([b'<x:item x:id="%d">a<b>&amp;</b>c</x:item>\n' % itemId for itemId in range(1000)])
+            + b"</x:items>")
+        xml = loxun.BytesXmlWriter(pretty=False)
+        xml.writeIterparse(io.BytesIO(source))
+        result = xml.close()
+        self.assertTrue(result.startswith(b'<?xml version="1.0" encoding="utf-8"?><x:items xmlns:x="http://xxx/">'))
+        self.assertEqual(self._canonicalized(result), self._canonicalized(source))
+
+
+class TreeXmlWriterTest(unittest.TestCase):
+    def testTree(self):
+        from xml.etree import ElementTree
+        xml = loxun.TreeXmlWriter()
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:root", {"x:id": 1, "plain": "a"})
+        xml.text("a < b")
+        xml.tag("x:empty")
+        xml.newline()
+        xml.comment("comment")
+        xml.cdata("<&>")
+        xml.processingInstruction("pi", "data")
+        xml.endTag("x:root")
+        root = xml.close()
+        self.assertEqual(root.tag, "{http://xxx/}root")
+        self.assertEqual(root.attrib, {"{http://xxx/}id": "1", "plain": "a"})
+        self.assertEqual(root.text, "a < b")
+        self.assertEqual([child.tag for child in root][0], "{http://xxx/}empty")
+        self.assertEqual(root[0].tail, "\n")
+        if sys.version_info >= (3, 8):
+            self.assertEqual(ElementTree.tostring(root[1]), b"<!-- comment -->&lt;&amp;&gt;")
+            self.assertEqual(root[2].text, "pi data")
+
+    def testTreeWithMultipleRootsFails(self):
+        xml = loxun.TreeXmlWriter()
+        xml.tag("a")
+        self.assertRaises(loxun.XmlError, xml.tag, "b")
+
+    def testTreeWithTextOutsideOfRootFails(self):
+        xml = loxun.TreeXmlWriter()
+        xml.text("  ")
+        self.assertRaises(loxun.XmlError, xml.text, "x")
+        self.assertRaises(loxun.XmlError, xml.comment, "x")
+        self.assertRaises(loxun.XmlError, xml.raw, "<a/>")
+        self.assertRaises(loxun.XmlError, xml.close)
+
+    def testChainTree(self):
+        root = loxun.ChainTreeXmlWriter().startTag("a").text("x").tag("b").endTag("a").close()
+        self.assertEqual(root.text, "x")
+        self.assertEqual(root[0].tag, "b")
+
+    def testTreeWithElement(self):
+        from xml.etree import ElementTree
+        source = ElementTree.fromstring('<a xmlns="http://aaa/"><b c="d">e</b>f</a>')
+        xml = loxun.TreeXmlWriter()
+        xml.element(source)
+        self.assertEqual(ElementTree.tostring(xml.close()), ElementTree.tostring(source))
+
+
+class _NullOutput(object):
+    """
+    Output that discards everything, so only the memory used by the writer
+    itself is measured.
+    """
+    def write(self, data):
+        pass
+
+
+class TransformTest(unittest.TestCase):
+    # Bytes the peak memory may differ between runs, for example because the
+    # parser gets text in parts of different sizes.
+    _MEMORY_SLACK = 64 * 1024
+
+    _SOURCE = (
+        b'<?xml version="1.0"?>'
+        b'<x:items xmlns:x="http://xxx/" xmlns:y="http://yyy/">'
+        b'<!--items--><?pi data?>'
+        b'<x:item y:id="1">a &amp; b</x:item><x:secret><x:item>c</x:item></x:secret>'
+        b'<item>d</item></x:items>')
+
+    def testTransform(self):
+        def renamedItem(name, attributes):
+            attributes["{http://yyy/}checked"] = "yes"
+            return ("{http://zzz/}entry", attributes)
+        callbacks = {
+            "{http://xxx/}item": renamedItem,
+            "{http://xxx/}secret": lambda name, attributes: None,
+        }
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        loxun.transform(io.BytesIO(TransformTest._SOURCE), xml, callbacks)
+        self.assertEqual(xml.close(),
+            b'<x:items xmlns:x="http://xxx/" xmlns:y="http://yyy/"><!--items--><?pi data?>'
+            b'<ns0:entry xmlns:ns0="http://zzz/" y:checked="yes" y:id="1">a &amp; b</ns0:entry>'
+            b'<item>d</item></x:items>')
+
+    def testTransformWithDefaultCallback(self):
+        names = []
+        def collectName(name, attributes):
+            names.append(name)
+            return (name, attributes)
+        xml = loxun.BytesXmlWriter()
+        loxun.transform(io.BytesIO(TransformTest._SOURCE), xml, {None: collectName})
+        xml.close()
+        self.assertEqual(names, ["{http://xxx/}items", "{http://xxx/}item", "{http://xxx/}secret", "{http://xxx/}item", "item"])
+
+    def testContentHandlerWithoutNamespaces(self):
+        import xml.sax
+        writer = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        handler = loxun.XmlWriterContentHandler(writer, {"x:secret": lambda name, attributes: None})
+        xml.sax.parseString(TransformTest._SOURCE, handler)
+        self.assertEqual(writer.close(),
+            b'<x:items xmlns:x="http://xxx/" xmlns:y="http://yyy/"><?pi data?>'
+            b'<x:item y:id="1">a &amp; b</x:item><item>d</item></x:items>')
+
+    def testPerformance(self):
+        import time
+        from xml.etree import ElementTree
+        source = (
+            b"<items>"
+            + b"".join([b'<item id="%d"><name>item %d</name><secret>x</secret></item>' % (itemId, itemId) for itemId in range(20000)])
+            + b"</items>")
+
+        startTime = time.time()
+        xml = loxun.BytesXmlWriter(pretty=False)
+        loxun.transform(io.BytesIO(source), xml, {"secret": lambda name, attributes: None})
+        transformed = xml.close()
+        transformTime = time.time() - startTime
+
+        startTime = time.time()
+        root = ElementTree.fromstring(source)
+        for item in root:
+            item.remove(item.find("secret"))
+        roundTripped = ElementTree.tostring(root)
+        roundTripTime = time.time() - startTime
+
+        self.assertEqual(ElementTree.tostring(ElementTree.fromstring(transformed)), roundTripped)
+        _log.info("transform took %.3fs, ElementTree round trip took %.3fs", transformTime, roundTripTime)
+
+        if sys.version_info >= (3, 4):
+            import tracemalloc
+
+            def peakMemory(function):
+                tracemalloc.start()
+                try:
+                    function()
+                    _, result = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                return result
+
+            def roundTrip():
+                root = ElementTree.fromstring(source)
+                for item in root:
+                    item.remove(item.find("secret"))
+                ElementTree.tostring(root)
+
+            transformPeak = peakMemory(lambda: loxun.transform(
+                io.BytesIO(source), loxun.XmlWriter(_NullOutput(), pretty=False), {"secret": lambda name, attributes: None}))
+            roundTripPeak = peakMemory(roundTrip)
+            _log.info("transform needed %d bytes, ElementTree round trip needed %d bytes", transformPeak, roundTripPeak)
+            # Streaming keeps only the current element in memory.
+            self.assertTrue(transformPeak < roundTripPeak // 4, "peak memory: %d >= %d / 4" % (transformPeak, roundTripPeak))
+
+    def _longTextSource(self, lineCount):
+        lines = ["  line %d with <markup> & stuff  " % lineNumber for lineNumber in range(lineCount)]
+        text = "\n".join(lines)
+        source = "<a><b>%s</b><c>%s</c></a>" % (loxun._escaped(text), "\n " * lineCount)
+        return text, source.encode("utf-8")
+
+    def testLongTextIsSameAsWriting(self):
+        text, source = self._longTextSource(20000)
+        for settings in ({"newline": "\n"}, {"pretty": False}):
+            xml = loxun.BytesXmlWriter(**settings)
+            loxun.transform(io.BytesIO(source), xml)
+            expectedXml = loxun.BytesXmlWriter(**settings)
+            expectedXml.startTag("a")
+            expectedXml.startTag("b")
+            expectedXml.text(text)
+            expectedXml.endTag()
+            expectedXml.startTag("c")
+            if not settings.get("pretty", True):
+                expectedXml.text("\n " * 20000)
+            expectedXml.endTag()
+            expectedXml.endTag()
+            self.assertEqual(xml.close(), expectedXml.close())
+
+    @unittest.skipIf(sys.version_info < (3, 4), "tracemalloc requires Python 3.4+")
+    def testPeakMemoryWithLongTextIsConstant(self):
+        import tracemalloc
+        peaks = []
+        for lineCount in (10000, 40000):
+            _, source = self._longTextSource(lineCount)
+            xml = loxun.XmlWriter(_NullOutput())
+            tracemalloc.start()
+            try:
+                loxun.transform(io.BytesIO(source), xml)
+                _, peakMemory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            peaks.append(peakMemory)
+        smallPeak, largePeak = peaks
+        _log.info("peak memory to transform text with 10000 and 40000 lines: %d and %d bytes", smallPeak, largePeak)
+        self.assertTrue(largePeak <= smallPeak + TransformTest._MEMORY_SLACK, "peak memory: %d > %d" % (largePeak, smallPeak))
+
+
+class CanonicalXmlTest(unittest.TestCase):
+    def _writeDocument(self, xml):
+        xml.addNamespace("b", "http://b/")
+        xml.addNamespace("a", "http://z/")
+        xml.startTag("b:root", {"z": "1", "a:y": "tab\there", "b:x": "\"<&>'\r\n", "a": "a"})
+        xml.processingInstruction("pi", "data")
+        xml.text("some <text> & more\r\n")
+        xml.addNamespace("b", "http://b/")
+        xml.startTag("b:empty")
+        xml.endTag()
+        xml.cdata("<cdata>&\r")
+        xml.comment("comment")
+        xml.endTag()
+
+    @unittest.skipIf(sys.version_info < (3, 8), "ElementTree.canonicalize() requires Python 3.8+")
+    def testCanonical(self):
+        from xml.etree import ElementTree
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, canonical=True)
+        self._writeDocument(xml)
+        xml.close()
+        actual = out.getvalue()
+        self.assertTrue(b"<b:empty></b:empty>" in actual)
+        expected = ElementTree.canonicalize(actual.decode("utf-8"), with_comments=True).encode("utf-8")
+        self.assertEqual(actual, expected)
+
+    def testCanonicalEncodingMustBeUtf8(self):
+        self.assertRaises(loxun.XmlError, loxun.XmlWriter, io.BytesIO(), canonical=True, encoding="iso-8859-1")
+
+    def testHash(self):
+        import hashlib
+        for canonical in (False, True):
+            out = io.BytesIO()
+            xml = loxun.XmlWriter(out, canonical=canonical, hashName="sha256")
+            self._writeDocument(xml)
+            xml.close()
+            self.assertEqual(xml.outputHash.hexdigest(), hashlib.sha256(out.getvalue()).hexdigest())
+
+    def testNoHashByDefault(self):
+        self.assertTrue(loxun.XmlWriter(io.BytesIO()).outputHash is None)
+
+
+class ChecksumOutputTest(unittest.TestCase):
+    def _writeDocument(self, xml):
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:items")
+        for itemId in range(100):
+            xml.startTag("item", {"id": itemId})
+            xml.text("\u20ac %d" % itemId)
+            xml.endTag()
+        xml.endTag()
+
+    def testChecksums(self):
+        import hashlib
+        import zlib
+        out = io.BytesIO()
+        checksumOut = loxun.ChecksumOutput(out, hashNames=["sha256", "md5"])
+        xml = loxun.XmlWriter(checksumOut)
+        self._writeDocument(xml)
+        xml.close()
+        hexdigests = checksumOut.close()
+        self.assertTrue(out.closed)
+        # BytesIO.getvalue() is not available once closed, so write again.
+        expectedOut = io.BytesIO()
+        xml = loxun.XmlWriter(expectedOut)
+        self._writeDocument(xml)
+        xml.close()
+        data = expectedOut.getvalue()
+        self.assertEqual(checksumOut.byteCount, len(data))
+        self.assertEqual(checksumOut.crc32, zlib.crc32(data) & 0xffffffff)
+        self.assertEqual(checksumOut.hexdigests(), hexdigests)
+        self.assertEqual(hexdigests, {
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "md5": hashlib.md5(data).hexdigest(),
+            "crc32": "%08x" % (zlib.crc32(data) & 0xffffffff),
+        })
+
+    def testWithoutCrc32(self):
+        checksumOut = loxun.ChecksumOutput(io.BytesIO(), hashNames=[], crc32=False)
+        checksumOut.write(b"abc")
+        self.assertEqual(checksumOut.hexdigests(), {})
+        self.assertTrue(checksumOut.crc32 is None)
+        self.assertEqual(checksumOut.byteCount, 3)
+
+
+class InvalidCharsTest(unittest.TestCase):
+    def _writeDocument(self, xml):
+        xml.startTag("a", {"b": "x\x01y\x00"})
+        xml.text("t\x1b\x85\x7f")
+        xml.comment("c\x01-\x00")
+        xml.cdata("d\x02")
+        xml.endTag()
+        xml.close()
+
+    def _xmlText(self, **settings):
+        out = io.BytesIO()
+        self._writeDocument(loxun.XmlWriter(out, pretty=False, prolog=False, **settings))
+        return out.getvalue().decode("utf-8")
+
+    def testDefaultKeepsInvalidChars(self):
+        self.assertEqual(self._xmlText(), '<a b="x\x01y\x00">t\x1b\x85\x7f<!-- c\x01-\x00 --><![CDATA[d\x02]]></a>')
+
+    def testStrip(self):
+        xmlText = self._xmlText(invalidChars="strip")
+        self.assertEqual(xmlText, '<a b="xy">t\x85\x7f<!-- c- --><![CDATA[d]]></a>')
+        from xml.etree import ElementTree
+        ElementTree.fromstring(xmlText.encode("utf-8"))
+
+    def testReplace(self):
+        self.assertEqual(
+            self._xmlText(invalidChars="replace"),
+            '<a b="x\ufffdy\ufffd">t\ufffd\x85\x7f<!-- c\ufffd-\ufffd --><![CDATA[d\ufffd]]></a>')
+
+    def testStripWithVersion11(self):
+        self.assertEqual(
+            self._xmlText(invalidChars="strip", version="1.1"),
+            '<a b="x&#x1;y">t&#x1B;\x85&#x7F;<!-- c- --><![CDATA[d]]></a>')
+
+    def testError(self):
+        xml = loxun.XmlWriter(io.BytesIO(), invalidChars="error")
+        self.assertRaises(loxun.XmlError, xml.startTag, "a", {"b": "\x00"})
+        xml.startTag("a")
+        self.assertRaises(loxun.XmlError, xml.text, "\x01")
+        self.assertRaises(loxun.XmlError, xml.comment, "\x01")
+        self.assertRaises(loxun.XmlError, xml.cdata, "\x01")
+        self.assertRaises(loxun.XmlError, xml.processingInstruction, "pi", "\x01")
+        xml.text("\t\n\r")
+        xml.endTag()
+        xml.close()
+
+    def testStripCannotBreakComments(self):
+        xml = loxun.XmlWriter(io.BytesIO(), invalidChars="strip")
+        self.assertRaises(loxun.XmlError, xml.comment, "-\x00-")
+
+    def testFactory(self):
+        factory = loxun.XmlWriterFactory(loxun.BytesXmlWriter, pretty=False, prolog=False, invalidChars="strip")
+        xml = factory.create()
+        xml.tag("a", {"b": "\x00"})
+        self.assertEqual(xml.close(), b'<a b=""/>')
+
+
+class DeferredTest(unittest.TestCase):
+    def testDeferred(self):
+        xml = loxun.BytesXmlWriter(prolog=False, newline="\n")
+        xml.startTag("orders")
+        with xml.deferred("summary", {"kind": "daily"}) as summary:
+            xml.tag("item", {"amount": 3})
+            xml.text("some text")
+            summary.setAttribute("count", 1)
+        xml.endTag()
+        self.assertEqual(xml.close(), (
+            b'<orders>\n'
+            b'  <summary count="1" kind="daily">\n'
+            b'    <item amount="3" />\n'
+            b'    some text\n'
+            b'  </summary>\n'
+            b'</orders>\n'))
+
+    def testEmptyDeferred(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        with xml.deferred("a") as deferred:
+            deferred.setAttribute("b", "c")
+        self.assertEqual(xml.close(), b'<a b="c"/>')
+
+    def testNestedDeferredWithNamespaces(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        xml.addNamespace("x", "http://xxx/")
+        with xml.deferred("x:a") as outer:
+            with xml.deferred("b") as inner:
+                xml.tag("x:c")
+                inner.setAttribute("x:count", 1)
+            outer.setAttribute("x:count", 2)
+        self.assertEqual(xml.close(), b'<x:a x:count="2" xmlns:x="http://xxx/"><b x:count="1"><x:c/></b></x:a>')
+
+    def testDeferredSpillsToTemporaryFile(self):
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, pretty=False, hashName="sha1")
+        with xml.deferred("items", spoolSize=100) as items:
+            for itemId in range(1000):
+                xml.tag("item", {"id": itemId})
+            self.assertTrue(items._spool._rolled)
+            items.setAttribute("count", 1000)
+        xml.close()
+        expected = b'<?xml version="1.0" encoding="utf-8"?><items count="1000">' \
+            + b"".join([b'<item id="%d"/>' % itemId for itemId in range(1000)]) + b"</items>"
+        self.assertEqual(out.getvalue(), expected)
+        self.assertEqual(xml.bytePosition, len(expected))
+        import hashlib
+        self.assertEqual(xml.outputHash.hexdigest(), hashlib.sha1(expected).hexdigest())
+
+    def testDeferredWithIncompleteContentFails(self):
+        xml = loxun.BytesXmlWriter()
+        deferred = xml.deferred("a")
+        deferred.__enter__()
+        xml.startTag("b")
+        self.assertRaises(loxun.XmlError, deferred.__exit__, None, None, None)
+
+    def testDeferredWithBrokenAttributeFails(self):
+        xml = loxun.BytesXmlWriter()
+        try:
+            with xml.deferred("a") as deferred:
+                deferred.setAttribute("x:b", "c")
+            self.fail("undeclared namespace must be detected")
+        except loxun.XmlError:
+            pass
+
+    def testDeferredKeepsException(self):
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, pretty=False, prolog=False)
+        try:
+            with xml.deferred("a"):
+                xml.tag("b")
+                raise ValueError("test")
+        except ValueError:
+            pass
+        self.assertEqual(out.getvalue(), b"")
+        self.assertEqual(xml._outputWrite, out.write)
+
+    def testCheckpointWithinDeferredFails(self):
+        xml = loxun.BytesXmlWriter()
+        with xml.deferred("a"):
+            self.assertRaises(loxun.XmlError, xml.checkpoint)
+
+    def testTreeDeferredFails(self):
+        self.assertRaises(loxun.XmlError, loxun.TreeXmlWriter().deferred, "a")
+
+
+class PlaceholderTest(unittest.TestCase):
+    def testPlaceholderInFile(self):
+        import tempfile
+        from xml.etree import ElementTree
+        with tempfile.TemporaryFile() as out:
+            xml = loxun.XmlWriter(out)
+            xml.startTag("items", {"kind": "test"})
+            count = xml.placeholder("count", 10)
+            total = xml.placeholder("total", 10)
+            amounts = [3, 4, 5]
+            for amount in amounts:
+                xml.tag("item", {"amount": amount})
+            xml.endTag()
+            xml.close()
+            out.seek(0)
+            self.assertEqual(ElementTree.parse(out).getroot().attrib, {"kind": "test", "count": "", "total": ""})
+            out.seek(0, io.SEEK_END)
+            xml.fill(count, len(amounts))
+            xml.fill(total, sum(amounts))
+            self.assertEqual(out.tell(), xml.bytePosition)
+            out.seek(0)
+            self.assertEqual(ElementTree.parse(out).getroot().attrib, {"kind": "test", "count": "3", "total": "12"})
+
+    def testPlaceholderInEmptyElement(self):
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, prolog=False)
+        xml.startTag("items")
+        # The escaped value "a&amp;b" needs 7 bytes.
+        count = xml.placeholder("count", 7)
+        self.assertTrue(count.position is None)
+        xml.endTag()
+        xml.fill(count, "a&b")
+        self.assertEqual(count.position, 13)
+        self.assertEqual(out.getvalue(), b'<items count="a&amp;b" />' + os.linesep.encode("ascii"))
+
+    def testFillBeforeWritten(self):
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, pretty=False, prolog=False)
+        xml.startTag("items")
+        count = xml.placeholder("count", 3)
+        xml.fill(count, 0)
+        xml.tag("item")
+        xml.endTag()
+        self.assertEqual(out.getvalue(), b'<items count="0"  ><item/></items>')
+
+    def testTooLargeValueFails(self):
+        xml = loxun.XmlWriter(io.BytesIO())
+        xml.startTag("items")
+        count = xml.placeholder("count", 3)
+        self.assertRaises(loxun.XmlError, xml.fill, count, 1000)
+        self.assertRaises(loxun.XmlError, xml.fill, count, "\u20ac\u20ac")
+
+    def testPlaceholderWithoutStartTagFails(self):
+        xml = loxun.XmlWriter(io.BytesIO())
+        xml.startTag("items")
+        xml.tag("item")
+        self.assertRaises(loxun.XmlError, xml.placeholder, "count", 3)
+
+    def testPlaceholderWithExistingAttributeFails(self):
+        xml = loxun.XmlWriter(io.BytesIO())
+        xml.startTag("items", {"count": "1"})
+        self.assertRaises(loxun.XmlError, xml.placeholder, "count", 3)
+
+    def testPlaceholderWithUnseekableOutputFails(self):
+        class _UnseekableOutput(object):
+            def write(self, data):
+                pass
+        xml = loxun.XmlWriter(_UnseekableOutput())
+        xml.startTag("items")
+        self.assertRaises(loxun.XmlError, xml.placeholder, "count", 3)
+
+    def testPlaceholderWithHashFails(self):
+        xml = loxun.XmlWriter(io.BytesIO(), hashName="md5")
+        xml.startTag("items")
+        self.assertRaises(loxun.XmlError, xml.placeholder, "count", 3)
+
+    def testPlaceholderWithinDeferredFails(self):
+        xml = loxun.XmlWriter(io.BytesIO())
+        with xml.deferred("items"):
+            xml.startTag("item")
+            self.assertRaises(loxun.XmlError, xml.placeholder, "count", 3)
+            xml.endTag()
+
+
+class TeeXmlWriterTest(unittest.TestCase):
+    _SETTINGS = [
+        {"newline": "\n"},
+        {"pretty": False, "encoding": "iso-8859-1", "errors": "xmlcharrefreplace"},
+        {"indent": "\t", "newline": "\r\n", "prolog": False, "hashName": "md5"},
+    ]
+
+    def _writeDocument(self, xml, itemCount=3):
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:items", {"x:kind": "test"})
+        xml.comment("some\ncomment")
+        for itemId in range(itemCount):
+            xml.startTag("item", {"id": itemId, "price": "\u20ac %d" % itemId})
+            xml.text("a < b\nc")
+            xml.endTag()
+            xml.tag("empty")
+            xml.startTag("alsoEmpty")
+            xml.endTag()
+        xml.cdata("<data>")
+        xml.processingInstruction("pi", "data")
+        xml.newline()
+        xml.endTag()
+        xml.close()
+
+    def _expectedOutputs(self, itemCount=3):
+        result = []
+        for settings in TeeXmlWriterTest._SETTINGS:
+            out = io.BytesIO()
+            self._writeDocument(loxun.XmlWriter(out, **settings), itemCount)
+            result.append(out.getvalue())
+        return result
+
+    def testTee(self):
+        outputs = [io.BytesIO() for _ in TeeXmlWriterTest._SETTINGS]
+        xml = loxun.TeeXmlWriter(zip(outputs, TeeXmlWriterTest._SETTINGS))
+        self._writeDocument(xml)
+        self.assertEqual([out.getvalue() for out in outputs], self._expectedOutputs())
+        self.assertEqual([writer.bytePosition for writer in xml.writers], [len(out.getvalue()) for out in outputs])
+        import hashlib
+        self.assertEqual(xml.writers[2].outputHash.hexdigest(), hashlib.md5(outputs[2].getvalue()).hexdigest())
+
+    def testReset(self):
+        xml = loxun.TeeXmlWriter([(io.BytesIO(), settings) for settings in TeeXmlWriterTest._SETTINGS])
+        xml.tag("unused")
+        outputs = [io.BytesIO() for _ in TeeXmlWriterTest._SETTINGS]
+        xml.reset(outputs)
+        self._writeDocument(xml)
+        self.assertEqual([out.getvalue() for out in outputs], self._expectedOutputs())
+        self.assertRaises(loxun.XmlError, xml.reset, outputs[:1])
+
+    def testSourceEncodingForOutputFails(self):
+        self.assertRaises(loxun.XmlError, loxun.TeeXmlWriter, [(io.BytesIO(), {"sourceEncoding": "ascii"})])
+
+    def testUnsupportedMethodsFail(self):
+        xml = loxun.TeeXmlWriter([(io.BytesIO(), {})])
+        xml.startTag("a")
+        self.assertRaises(loxun.XmlError, xml.placeholder, "b", 3)
+        self.assertRaises(loxun.XmlError, xml.deferred, "b")
+        self.assertRaises(loxun.XmlError, xml.checkpoint)
+
+    def testPerformance(self):
+        import time
+        itemCount = 3000
+        startTime = time.time()
+        self._expectedOutputs(itemCount)
+        separateTime = time.time() - startTime
+
+        startTime = time.time()
+        xml = loxun.TeeXmlWriter([(io.BytesIO(), settings) for settings in TeeXmlWriterTest._SETTINGS])
+        self._writeDocument(xml, itemCount)
+        teeTime = time.time() - startTime
+        _assertNotSlower(
+            self, "writing %d outputs using a tee" % len(TeeXmlWriterTest._SETTINGS), teeTime,
+            "writing them separately", separateTime)
+
+
+class RecordingTest(unittest.TestCase):
+    _SETTINGS = [
+        {"newline": "\n"},
+        {"pretty": False, "encoding": "iso-8859-1", "errors": "xmlcharrefreplace"},
+        {"indent": "\t", "newline": "\r\n", "prolog": False},
+    ]
+
+    def _writeItem(self, xml, itemId):
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:item", {"id": itemId, "x:price": "\u20ac %d" % itemId})
+        xml.text("a < b\nc")
+        xml.comment("some\ncomment")
+        xml.tag("empty")
+        xml.startTag("alsoEmpty")
+        xml.endTag()
+        xml.cdata("<data>")
+        xml.processingInstruction("pi", "data")
+        xml.newline()
+        xml.raw("<raw/>")
+        xml.endTag()
+
+    def _writeDocument(self, xml, itemLogs=None, itemCount=3):
+        xml.startTag("items")
+        xml.startTag("group")
+        for itemId in range(itemCount):
+            if itemLogs is None:
+                self._writeItem(xml, itemId)
+            else:
+                xml.replay(itemLogs[itemId % len(itemLogs)])
+        xml.endTag()
+        xml.endTag()
+        return xml.close()
+
+    def _itemLog(self, itemId):
+        recorder = loxun.RecordingXmlWriter()
+        self._writeItem(recorder, itemId)
+        return recorder.close()
+
+    def testReplayIsSameAsWriting(self):
+        itemLogs = [self._itemLog(itemId) for itemId in range(3)]
+        for settings in RecordingTest._SETTINGS:
+            expected = self._writeDocument(loxun.BytesXmlWriter(**settings))
+            actual = self._writeDocument(loxun.BytesXmlWriter(**settings), itemLogs)
+            self.assertEqual(actual, expected)
+
+    def testReplayInTreeAndTee(self):
+        from xml.etree import ElementTree
+        recorder = loxun.RecordingXmlWriter()
+        recorder.addNamespace("x", "http://xxx/")
+        recorder.startTag("x:item", {"x:price": "1"})
+        recorder.text("a < b")
+        recorder.tag("x:empty")
+        recorder.endTag()
+        itemLog = recorder.close()
+        xml = loxun.TreeXmlWriter()
+        xml.startTag("items")
+        xml.replay(itemLog)
+        xml.replay(itemLog)
+        xml.endTag()
+        self.assertEqual(
+            ElementTree.tostring(xml.close()),
+            b'<items xmlns:ns0="http://xxx/"><ns0:item ns0:price="1">a &lt; b<ns0:empty /></ns0:item>'
+            b'<ns0:item ns0:price="1">a &lt; b<ns0:empty /></ns0:item></items>')
+
+        itemLogs = [self._itemLog(itemId) for itemId in range(3)]
+        outputs = [io.BytesIO() for _ in RecordingTest._SETTINGS]
+        self._writeDocument(loxun.TeeXmlWriter(zip(outputs, RecordingTest._SETTINGS)), itemLogs)
+        expected = [self._writeDocument(loxun.BytesXmlWriter(**settings)) for settings in RecordingTest._SETTINGS]
+        self.assertEqual([output.getvalue() for output in outputs], expected)
+
+    def testCanMarshalLog(self):
+        import marshal
+        itemLog = self._itemLog(0)
+        self.assertEqual(marshal.loads(marshal.dumps(itemLog)), itemLog)
+
+    def testEmptyLog(self):
+        recorder = loxun.RecordingXmlWriter()
+        self.assertEqual(recorder.close(), ())
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        xml.tag("a")
+        xml.replay(())
+        self.assertEqual(xml.close(), b"<a/>")
+
+    def testBrokenRecordingFails(self):
+        recorder = loxun.RecordingXmlWriter()
+        recorder.startTag("a")
+        self.assertRaises(loxun.XmlError, recorder.close)
+        recorder = loxun.RecordingXmlWriter()
+        recorder.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, recorder.close)
+        recorder = loxun.RecordingXmlWriter()
+        self.assertRaises(loxun.XmlError, recorder.tag, "x:a")
+        recorder.startTag("a")
+        self.assertRaises(loxun.XmlError, recorder.deferred, "b")
+        self.assertRaises(loxun.XmlError, recorder.placeholder, "b", 3)
+        self.assertRaises(loxun.XmlError, recorder.checkpoint)
+
+    def testReplayWithPendingNamespaceFails(self):
+        xml = loxun.BytesXmlWriter()
+        xml.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, xml.replay, ())
+
+    def testReplayCanonicalFails(self):
+        xml = loxun.XmlWriter(io.BytesIO(), canonical=True)
+        self.assertRaises(loxun.XmlError, xml.replay, ())
+
+    def testPerformance(self):
+        itemCount = 3000
+        settings = RecordingTest._SETTINGS[0]
+        startTime = time.time()
+        self._writeDocument(loxun.BytesXmlWriter(**settings), itemCount=itemCount)
+        writeTime = time.time() - startTime
+
+        startTime = time.time()
+        itemLogs = [self._itemLog(itemId) for itemId in range(10)]
+        self._writeDocument(loxun.BytesXmlWriter(**settings), itemLogs, itemCount)
+        replayTime = time.time() - startTime
+        _assertNotSlower(self, "writing %d items using replay" % itemCount, replayTime, "writing them directly", writeTime)
+
+
+class CachedTest(unittest.TestCase):
+    def _writeManufacturer(self, xml):
+        xml.startTag("manufacturer", {"name": "ACME"})
+        xml.text("Makers of\nfine things")
+        xml.tag("country", {"code": "us"})
+        xml.endTag()
+
+    def _writeDocument(self, xml, useCache=True):
+        xml.startTag("catalog")
+        for productId in range(4):
+            xml.startTag("product", {"id": productId})
+            if useCache:
+                with xml.cached("acme") as miss:
+                    if miss:
+                        self._writeManufacturer(xml)
+            else:
+                self._writeManufacturer(xml)
+            xml.endTag()
+        # Same section at a different depth.
+        if useCache:
+            with xml.cached("acme") as miss:
+                if miss:
+                    self._writeManufacturer(xml)
+        else:
+            self._writeManufacturer(xml)
+        xml.endTag()
+        return xml.close()
+
+    def testCachedIsSameAsWriting(self):
+        for settings in ({"newline": "\n"}, {"pretty": False}, {"indent": "\t", "hashName": "md5"}):
+            cache = loxun.FragmentCache()
+            xml = loxun.BytesXmlWriter(fragmentCache=cache, **settings)
+            actual = self._writeDocument(xml)
+            expected = self._writeDocument(loxun.BytesXmlWriter(**settings), useCache=False)
+            self.assertEqual(actual, expected)
+            if settings.get("pretty", True):
+                self.assertEqual((cache.missCount, cache.hitCount, len(cache)), (2, 3, 2))
+            else:
+                self.assertEqual((cache.missCount, cache.hitCount, len(cache)), (1, 4, 1))
+            self.assertEqual(xml.bytePosition, len(expected))
+            if "hashName" in settings:
+                import hashlib
+                self.assertEqual(xml.outputHash.hexdigest(), hashlib.md5(expected).hexdigest())
+
+    def testCacheSharedByDifferentSettings(self):
+        cache = loxun.FragmentCache()
+        expected = self._writeDocument(loxun.BytesXmlWriter(pretty=False), useCache=False)
+        self._writeDocument(loxun.BytesXmlWriter(encoding="iso-8859-1", fragmentCache=cache))
+        factory = loxun.XmlWriterFactory(loxun.BytesXmlWriter, pretty=False, fragmentCache=cache)
+        self.assertEqual(self._writeDocument(factory.create()), expected)
+        missCount = cache.missCount
+        self.assertEqual(self._writeDocument(factory.create()), expected)
+        self.assertEqual(cache.missCount, missCount)
+
+    def testCacheSharedByWritersWithInvalidChars(self):
+        cache = loxun.FragmentCache()
+        expected = self._writeDocument(loxun.BytesXmlWriter(invalidChars="strip"), useCache=False)
+        for _ in range(2):
+            xml = loxun.BytesXmlWriter(fragmentCache=cache, invalidChars="strip")
+            self.assertEqual(self._writeDocument(xml), expected)
+        self.assertEqual((cache.missCount, cache.hitCount), (2, 8))
+        self._writeDocument(loxun.BytesXmlWriter(fragmentCache=cache, invalidChars="replace"))
+        self.assertEqual(cache.missCount, 4)
+
+    def _writeNamespacedFragment(self, xml, uri):
+        xml.addNamespace("x", uri)
+        xml.startTag("x:root")
+        with xml.cached("item") as miss:
+            if miss:
+                xml.tag("x:item")
+        xml.endTag()
+
+    def testNamespacesInScopeAreRespected(self):
+        cache = loxun.FragmentCache()
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+        xml.startTag("root")
+        self._writeNamespacedFragment(xml, "http://one/")
+        self._writeNamespacedFragment(xml, "http://two/")
+        self._writeNamespacedFragment(xml, "http://one/")
+        xml.endTag()
+        xml.close()
+        self.assertEqual((cache.missCount, cache.hitCount), (2, 1))
+
+    def testNamespaceWithinFragment(self):
+        cache = loxun.FragmentCache()
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+        xml.startTag("root")
+        for _ in range(2):
+            with xml.cached("item") as miss:
+                if miss:
+                    xml.addNamespace("x", "http://xxx/")
+                    xml.tag("x:item")
+        xml.tag("plain")
+        self.assertRaises(loxun.XmlError, xml.tag, "x:item")
+        xml.endTag()
+        self.assertEqual(xml.close(), b'<root><x:item xmlns:x="http://xxx/"/><x:item xmlns:x="http://xxx/"/><plain/></root>')
+
+    def testLeastRecentlyUsedIsRemoved(self):
+        cache = loxun.FragmentCache(maxByteCount=20)
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+        xml.startTag("root")
+        for key in ("a", "b", "a", "c", "b", "a"):
+            with xml.cached(key) as miss:
+                if miss:
+                    xml.tag(key * 4)
+        with xml.cached("large") as miss:
+            xml.tag("large" * 10)
+        xml.endTag()
+        xml.close()
+        # Each fragment takes 7 bytes, so the cache can hold 2 of them.
+        self.assertEqual((cache.missCount, cache.hitCount), (6, 1))
+        self.assertEqual((len(cache), cache.byteCount), (2, 14))
+        cache.clear()
+        self.assertEqual((len(cache), cache.byteCount, cache.missCount), (0, 0, 0))
+
+    def testBrokenFragmentIsNotCached(self):
+        cache = loxun.FragmentCache()
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+        xml.startTag("root")
+        fragment = xml.cached("a")
+        fragment.__enter__()
+        xml.startTag("a")
+        self.assertRaises(loxun.XmlError, fragment.__exit__, None, None, None)
+        xml.endTag()
+        try:
+            with xml.cached("b"):
+                xml.tag("b")
+                raise ValueError("test")
+        except ValueError:
+            pass
+        fragment = xml.cached("c")
+        fragment.__enter__()
+        xml.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, fragment.__exit__, None, None, None)
+        xml.tag("x:c")
+        self.assertEqual(len(cache), 0)
+        with xml.cached("d"):
+            xml.startTag("d")
+            self.assertRaises(loxun.XmlError, xml.placeholder, "count", 3)
+            xml.endTag()
+        self.assertEqual(len(cache), 1)
+
+    def testCachedWithDeferred(self):
+        cache = loxun.FragmentCache()
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+        xml.startTag("root")
+        for _ in range(2):
+            with xml.deferred("outer") as outer:
+                with xml.cached("inner") as miss:
+                    if miss:
+                        with xml.deferred("inner") as inner:
+                            xml.tag("a")
+                            inner.setAttribute("count", 1)
+                outer.setAttribute("count", 1)
+        xml.endTag()
+        self.assertEqual(xml.close(), b'<root>' + b'<outer count="1"><inner count="1"><a/></inner></outer>' * 2 + b'</root>')
+        self.assertEqual(cache.hitCount, 1)
+
+    def testUnsupportedWritersFail(self):
+        self.assertRaises(loxun.XmlError, loxun.BytesXmlWriter().cached, "a")
+        self.assertRaises(loxun.XmlError, loxun.TreeXmlWriter().cached, "a")
+        self.assertRaises(loxun.XmlError, loxun.TeeXmlWriter([(io.BytesIO(), {})]).cached, "a")
+        self.assertRaises(loxun.XmlError, loxun.RecordingXmlWriter().cached, "a")
+
+    def testPerformance(self):
+        productCount = 20000
+        startTime = time.time()
+        xml = loxun.BytesXmlWriter()
+        xml.startTag("catalog")
+        for productId in range(productCount):
+            xml.startTag("product", {"id": productId})
+            self._writeManufacturer(xml)
+            xml.endTag()
+        xml.endTag()
+        xml.close()
+        writeTime = time.time() - startTime
+
+        startTime = time.time()
+        xml = loxun.BytesXmlWriter(fragmentCache=loxun.FragmentCache())
+        xml.startTag("catalog")
+        for productId in range(productCount):
+            xml.startTag("product", {"id": productId})
+            with xml.cached("acme") as miss:
+                if miss:
+                    self._writeManufacturer(xml)
+            xml.endTag()
+        xml.endTag()
+        xml.close()
+        cachedTime = time.time() - startTime
+        _assertNotSlower(
+            self, "writing %d products using a cache" % productCount, cachedTime, "writing them directly", writeTime)
+
+
+class ConverterTest(unittest.TestCase):
+    _ROWS = [
+        {"id": 1, "name": "Ann <&>", "tags": ["a", "b"], "active": True, "address": {"city": "Graz", "zip": None}},
+        {"id": 2, "first name": None, "2nd": 1.5, "tags": []},
+    ]
+
+    def setUp(self):
+        import tempfile
+        self._folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._folder)
+
+    def _path(self, name):
+        return os.path.join(self._folder, name)
+
+    def _writeJsonLines(self, name, rows):
+        import json
+        with io.open(self._path(name), "w", encoding="utf-8") as jsonFile:
+            for row in rows:
+                jsonFile.write(json.dumps(row) + "\n")
+            # Blank lines are ignored.
+            jsonFile.write("\n")
+
+    def _writeRowsUsingApi(self, xml, rowName, value):
+        if isinstance(value, dict):
+            xml.startTag(rowName)
+            for key, childValue in value.items():
+                self._writeRowsUsingApi(xml, loxun._xmlNameFor(key), childValue)
+            xml.endTag()
+        elif isinstance(value, list):
+            for item in value:
+                self._writeRowsUsingApi(xml, rowName, item)
+        elif value is None:
+            xml.tag(rowName)
+        else:
+            xml.startTag(rowName)
+            xml.text(loxun._rowText(value))
+            xml.endTag()
+
+    def testWriteRows(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        xml.startTag("rows")
+        self.assertEqual(loxun.writeRows(xml, ConverterTest._ROWS), 2)
+        xml.endTag()
+        self.assertEqual(xml.close(), (
+            b'<rows><row><id>1</id><name>Ann &lt;&amp;&gt;</name><tags>a</tags><tags>b</tags><active>true</active>'
+            b'<address><city>Graz</city><zip/></address></row><row><id>2</id><first_name/><_2nd>1.5</_2nd></row></rows>'))
+
+    def testWriteRowsWithAttributes(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, invalidChars="replace")
+        xml.startTag("rows")
+        loxun.writeRows(xml, ConverterTest._ROWS + [{"dirty": "a\x00b"}], "item", attributes=True)
+        xml.endTag()
+        self.assertEqual(xml.close(), (
+            b'<rows><item active="true" id="1" name="Ann &lt;&amp;&gt;"><tags>a</tags><tags>b</tags>'
+            b'<address city="Graz"/></item><item _2nd="1.5" id="2"/><item dirty="a\xef\xbf\xbdb"/></rows>'))
+
+    def testWriteRowsIsSameAsApi(self):
+        for settings in ({"newline": "\n"}, {"pretty": False}, {"indent": "\t", "encoding": "iso-8859-1"}):
+            xml = loxun.BytesXmlWriter(**settings)
+            xml.startTag("rows")
+            loxun.writeRows(xml, ConverterTest._ROWS)
+            xml.endTag()
+            expectedXml = loxun.BytesXmlWriter(**settings)
+            expectedXml.startTag("rows")
+            for row in ConverterTest._ROWS:
+                self._writeRowsUsingApi(expectedXml, "row", row)
+            expectedXml.endTag()
+            self.assertEqual(xml.close(), expectedXml.close())
+
+    def testWriteRowsToTree(self):
+        xml = loxun.TreeXmlWriter()
+        xml.startTag("rows")
+        loxun.writeRows(xml, ConverterTest._ROWS)
+        xml.endTag()
+        root = xml.close()
+        self.assertEqual(root[0].find("address/city").text, "Graz")
+
+    def testWriteRowsWithSameAttributeNameFails(self):
+        xml = loxun.BytesXmlWriter()
+        self.assertRaises(loxun.XmlError, loxun.writeRows, xml, [{"a b": 1, "a_b": 2}], "row", attributes=True)
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        loxun.writeRows(xml, [{"a b": 1, "a_b": 2, "c d": None, "c_d": 3}], "row")
+        self.assertEqual(xml.close(), b"<row><a_b>1</a_b><a_b>2</a_b><c_d/><c_d>3</c_d></row>")
+
+    def testWriteRowsWithReservedNames(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        loxun.writeRows(xml, [{"xmlns": "http://evil/", "xmlns:x": "http://evil/", "XmlData": 1, "a": 1}], attributes=True)
+        self.assertEqual(xml.close(), b'<row _XmlData="1" _xmlns="http://evil/" _xmlns_x="http://evil/" a="1"/>')
+        self.assertRaises(loxun.XmlError, loxun.writeRows, loxun.BytesXmlWriter(), [], "xmlRow")
+
+    def testWriteDeeplyNestedRows(self):
+        depth = 5 * sys.getrecursionlimit()
+        row = "deep"
+        for _ in range(depth):
+            row = {"a": row}
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False)
+        loxun.writeRows(xml, [row, row])
+        self.assertEqual(xml.close(), (b"<row>" + b"<a>" * depth + b"deep" + b"</a>" * depth + b"</row>") * 2)
+
+    def testWriteRowsWithBrokenRowNameFails(self):
+        xml = loxun.BytesXmlWriter()
+        self.assertRaises(loxun.XmlError, loxun.writeRows, xml, [], "bad name")
+
+    def testConvertJsonLines(self):
+        self._writeJsonLines("rows.jsonl", ConverterTest._ROWS)
+        outputPath = self._path("rows.xml")
+        self.assertEqual(loxun.main([self._path("rows.jsonl"), "-o", outputPath, "--compact", "--root", "data"]), 0)
+        with io.open(outputPath, "rb") as xmlFile:
+            xmlData = xmlFile.read()
+        self.assertTrue(xmlData.startswith(b'<?xml version="1.0" encoding="utf-8"?><data><row><id>1</id>'))
+        self.assertTrue(xmlData.endswith(b'<_2nd>1.5</_2nd></row></data>'))
+
+    def testConvertCsv(self):
+        with io.open(self._path("people.csv"), "w", encoding="iso-8859-1", newline="") as csvFile:
+            csvFile.write("id;name\r\n1;\u00c4nne\r\n2;\"Bob; Jr.\"\r\n")
+        outputPath = self._path("people.xml")
+        exitCode = loxun.main([
+            self._path("people.csv"), "-o", outputPath, "-c", "-a", "--row", "person",
+            "--csv-encoding", "iso-8859-1", "--csv-delimiter", ";"])
+        self.assertEqual(exitCode, 0)
+        with io.open(outputPath, "rb") as xmlFile:
+            self.assertEqual(xmlFile.read(), (
+                b'<?xml version="1.0" encoding="utf-8"?><rows><person id="1" name="\xc3\x84nne"/>'
+                b'<person id="2" name="Bob; Jr."/></rows>'))
+
+    def testConvertCompressed(self):
+        import bz2
+        import gzip
+        self._writeJsonLines("rows.jsonl", ConverterTest._ROWS)
+        self.assertEqual(loxun.main([self._path("rows.jsonl"), "-o", self._path("rows.xml")]), 0)
+        with io.open(self._path("rows.xml"), "rb") as xmlFile:
+            expectedXmlData = xmlFile.read()
+        with io.open(self._path("rows.jsonl"), "rb") as jsonFile:
+            with gzip.open(self._path("rows.jsonl.gz"), "wb") as gzipFile:
+                gzipFile.write(jsonFile.read())
+        self.assertEqual(loxun.main([self._path("rows.jsonl.gz"), "-o", self._path("rows.xml.bz2")]), 0)
+        with bz2.BZ2File(self._path("rows.xml.bz2"), "rb") as bz2File:
+            self.assertEqual(bz2File.read(), expectedXmlData)
+        self.assertEqual(loxun.main([self._path("rows.jsonl"), "-o", self._path("rows.data"), "-z", "gzip"]), 0)
+        with gzip.open(self._path("rows.data"), "rb") as gzipFile:
+            self.assertEqual(gzipFile.read(), expectedXmlData)
+
+    def testConvertBrokenJsonFails(self):
+        with io.open(self._path("broken.jsonl"), "w", encoding="utf-8") as jsonFile:
+            jsonFile.write('{"id": 1}\n{"id": \n')
+        originalStderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            exitCode = loxun.main([self._path("broken.jsonl"), "-o", self._path("broken.xml")])
+            errorMessage = sys.stderr.getvalue()
+        finally:
+            sys.stderr = originalStderr
+        self.assertEqual(exitCode, 1)
+        self.assertTrue("broken.jsonl: line 2: " in errorMessage, errorMessage)
+
+    def testConvertWithBrokenNameFails(self):
+        originalStderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.assertRaises(SystemExit, loxun.main, ["--root", "bad name"])
+        finally:
+            sys.stderr = originalStderr
+
+    def testConvertInParallel(self):
+        rows = [{"id": rowId, "name": "row %d" % rowId, "tags": ["x"] * (rowId % 3)} for rowId in range(100)]
+        self._writeJsonLines("rows.jsonl", rows)
+        with io.open(self._path("rows.jsonl"), "ab") as jsonFile:
+            # Carriage returns are white space in JSON but do not end a line.
+            jsonFile.write(b'{"a": 1,\r "b": 2}\n{"c": 3}\n')
+        for options in ([], ["--compact", "--attributes"]):
+            self.assertEqual(loxun.main([self._path("rows.jsonl"), "-o", self._path("serial.xml")] + options), 0)
+            exitCode = loxun.main(
+                [self._path("rows.jsonl"), "-o", self._path("parallel.xml"), "--jobs", "3", "--chunk-size", "100"] + options)
+            self.assertEqual(exitCode, 0)
+            with io.open(self._path("serial.xml"), "rb") as serialFile:
+                with io.open(self._path("parallel.xml"), "rb") as parallelFile:
+                    self.assertEqual(parallelFile.read(), serialFile.read())
+
+    def testLineAlignedRanges(self):
+        with io.open(self._path("lines.txt"), "wb") as linesFile:
+            linesFile.write(b"a\nbb\nccc\n\ndddd")
+        self.assertEqual(list(loxun._lineAlignedRanges(self._path("lines.txt"), 2)), [(0, 5), (5, 9), (9, 14)])
+        self.assertEqual(list(loxun._lineAlignedRanges(self._path("lines.txt"), 100)), [(0, 14)])
+
+    def testConvertBrokenJsonInParallelFails(self):
+        self._writeJsonLines("rows.jsonl", [{"id": rowId} for rowId in range(10)])
+        with io.open(self._path("rows.jsonl"), "a", encoding="utf-8") as jsonFile:
+            jsonFile.write('{"id": \n')
+        originalStderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            exitCode = loxun.main([self._path("rows.jsonl"), "-o", self._path("rows.xml"), "-j", "2", "--chunk-size", "40"])
+            errorMessage = sys.stderr.getvalue()
+        finally:
+            sys.stderr = originalStderr
+        self.assertEqual(exitCode, 1)
+        self.assertTrue(": byte " in errorMessage, errorMessage)
+
+    def testConvertCsvInParallelFails(self):
+        originalStderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.assertRaises(SystemExit, loxun.main, ["--jobs", "2", "some.csv"])
+            self.assertRaises(SystemExit, loxun.main, ["--jobs", "2"])
+            self.assertRaises(SystemExit, loxun.main, ["--jobs", "0", "some.jsonl"])
+        finally:
+            sys.stderr = originalStderr
+
+    def testDoctestExitCode(self):
+        originalTestmod = doctest.testmod
+        originalStdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            for failedCount, expectedExitCode in ((0, 0), (1, 1)):
+                doctest.testmod = lambda *arguments, **keywords: doctest.TestResults(failedCount, 3)
+                self.assertEqual(loxun.main(["--doctest"]), expectedExitCode)
+        finally:
+            doctest.testmod = originalTestmod
+            sys.stdout = originalStdout
+
+    def testConvertAsModule(self):
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.path.dirname(os.path.abspath(loxun.__file__))
+        process = subprocess.Popen(
+            [sys.executable, "-m", "loxun", "--compact"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+        xmlData, _ = process.communicate(b'{"id": 1}\n{"id": 2}\n')
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(xmlData, b'<?xml version="1.0" encoding="utf-8"?><rows><row><id>1</id></row><row><id>2</id></row></rows>')
+
+    def _writeJsonLinesUsingApi(self, jsonPath, xmlPath):
+        import json
+        with io.open(jsonPath, "rb") as jsonFile:
+            with io.open(xmlPath, "wb") as xmlFile:
+                xml = loxun.XmlWriter(xmlFile, errors="xmlcharrefreplace")
+                xml.startTag("rows")
+                for line in jsonFile:
+                    if line.strip():
+                        self._writeRowsUsingApi(xml, "row", json.loads(line.decode("utf-8")))
+                xml.endTag()
+                xml.close()
+
+    def testPerformance(self):
+        rowCount = 10000
+        self._writeJsonLines("rows.jsonl", [
+            {"id": rowId, "name": "customer %d" % rowId, "tags": ["x", "y"], "address": {"city": "Graz"}}
+            for rowId in range(rowCount)])
+        startTime = time.time()
+        self._writeJsonLinesUsingApi(self._path("rows.jsonl"), self._path("api.xml"))
+        apiTime = time.time() - startTime
+        startTime = time.time()
+        self.assertEqual(loxun.main([self._path("rows.jsonl"), "-o", self._path("rows.xml")]), 0)
+        converterTime = time.time() - startTime
+        with io.open(self._path("api.xml"), "rb") as apiFile:
+            with io.open(self._path("rows.xml"), "rb") as xmlFile:
+                self.assertEqual(xmlFile.read(), apiFile.read())
+        _assertNotSlower(
+            self, "converting %d rows" % rowCount, converterTime, "writing them using the API", apiTime)
+
+        # Whether several processes help depends too much on the machine to
+        # compare them, so only log the timing.
+        jobs = 2
+        startTime = time.time()
+        exitCode = loxun.main(
+            [self._path("rows.jsonl"), "-o", self._path("rows.xml"), "--jobs", str(jobs), "--chunk-size", "100000"])
+        parallelTime = time.time() - startTime
+        self.assertEqual(exitCode, 0)
+        _log.info(
+            "converting %d rows using %d processes took %.3fs, using one process took %.3fs",
+            rowCount, jobs, parallelTime, converterTime)
+
+
+@unittest.skipIf(sys.version_info < (3, 4), "tracemalloc requires Python 3.4+")
+class MemoryTest(unittest.TestCase):
+    # Bytes the peak may differ between runs, for example because of
+    # different lengths of numbers.
+    _SLACK = 1024
+
+    def _peakMemory(self, writeDocument, elementCount):
+        """
+        The peak number of bytes allocated while ``writeDocument(xml,
+        elementCount)`` streams to an output that discards everything.
+        """
+        import tracemalloc
+        xml = loxun.XmlWriter(_NullOutput(), hashName="sha256")
+        # Import modules and compile regular expressions before measuring.
+        writeDocument(xml, 1)
+        xml.reset(_NullOutput())
+        tracemalloc.start()
+        try:
+            baseMemory, _ = tracemalloc.get_traced_memory()
+            writeDocument(xml, elementCount)
+            _, peakMemory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peakMemory - baseMemory
+
+    def _writeDocument(self, xml, elementCount):
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:items")
+        for elementId in range(elementCount):
+            xml.startTag("item", {"id": elementId, "x:kind": "test"})
+            xml.text("some text\nwith newline")
+            xml.tag("empty")
+            xml.comment("comment")
+            xml.endTag()
+        xml.endTag()
+        xml.close()
+
+    def _writeDeferredDocument(self, xml, elementCount):
+        xml.startTag("items")
+        with xml.deferred("summary", spoolSize=16 * 1024) as summary:
+            for elementId in range(elementCount):
+                xml.tag("item", {"id": elementId})
+            summary.setAttribute("count", elementCount)
+        xml.endTag()
+        xml.close()
+
+    def testPeakMemoryIsConstant(self):
+        smallPeak = self._peakMemory(self._writeDocument, 1000)
+        largePeak = self._peakMemory(self._writeDocument, 10000)
+        _log.info("peak memory to write 1000 and 10000 elements: %d and %d bytes", smallPeak, largePeak)
+        self.assertTrue(largePeak <= smallPeak + MemoryTest._SLACK, "peak memory: %d > %d" % (largePeak, smallPeak))
+
+    def testPeakMemoryWithDeferredIsBounded(self):
+        smallPeak = self._peakMemory(self._writeDeferredDocument, 5000)
+        largePeak = self._peakMemory(self._writeDeferredDocument, 20000)
+        _log.info("peak memory to write 5000 and 20000 deferred elements: %d and %d bytes", smallPeak, largePeak)
+        self.assertTrue(largePeak <= smallPeak + MemoryTest._SLACK, "peak memory: %d > %d" % (largePeak, smallPeak))
+
+    def testMaxBufferedByteCount(self):
+        cache = loxun.FragmentCache()
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, fragmentCache=cache)
+        xml.startTag("items")
+        self.assertEqual((xml.bufferedByteCount, xml.maxBufferedByteCount), (0, 0))
+        with xml.deferred("outer"):
+            xml.tag("a")
+            self.assertEqual(xml.bufferedByteCount, 4)
+            with xml.cached("b") as miss:
+                self.assertTrue(miss)
+                xml.tag("b")
+                self.assertEqual(xml.bufferedByteCount, 8)
+            with xml.deferred("inner"):
+                xml.tag("c")
+            self.assertEqual(xml.bufferedByteCount, 27)
+        self.assertEqual((xml.bufferedByteCount, xml.maxBufferedByteCount), (0, 27))
+        with xml.cached("d"):
+            xml.tag("dd")
+        self.assertEqual(xml.maxBufferedByteCount, 27)
+        xml.endTag()
+        self.assertEqual(xml.close(), b'<items><outer><a/><b/><inner><c/></inner></outer><dd/></items>')
+        xml.reset()
+        self.assertEqual(xml.maxBufferedByteCount, 0)
+
+    def testTagsWithoutAttributesShareThem(self):
+        xml = loxun.BytesXmlWriter()
+        xml.startTag("a")
+        xml.startTag("b")
+        _, _, attributes = xml._startTagToWrite
+        self.assertTrue(attributes is loxun._NO_ATTRIBUTES)
+        xml.endTag()
+        xml.endTag()
+        self.assertEqual(loxun._NO_ATTRIBUTES, {})
+
+
+class ConcurrentTest(unittest.TestCase):
+    def _writeRecord(self, xml, threadId, recordId):
+        xml.startTag("x:record", {"thread": threadId, "id": recordId})
+        xml.text("some text")
+        for valueId in range(5):
+            xml.tag("value", {"id": valueId})
+        xml.endTag()
+
+    def _writeDocumentUsingThreads(self, xml, writeRecords, threadCount=4, recordCount=100):
+        import threading
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("records")
+        threads = [
+            threading.Thread(target=writeRecords, args=(xml, threadId, recordCount))
+            for threadId in range(threadCount)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        xml.endTag()
+
+    def _writeRecordsUsingFragments(self, xml, threadId, recordCount):
+        for recordId in range(recordCount):
+            with xml.fragment() as record:
+                self._writeRecord(record, threadId, recordId)
+
+    def testFragmentsFromThreads(self):
+        from xml.etree import ElementTree
+        import hashlib
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, concurrent=True, hashName="sha256")
+        self._writeDocumentUsingThreads(xml, self._writeRecordsUsingFragments)
+        xml.close()
+        root = ElementTree.fromstring(out.getvalue())
+        records = root.findall("{http://xxx/}record")
+        self.assertEqual(len(records), 400)
+        self.assertEqual(
+            sorted([(int(record.get("thread")), int(record.get("id"))) for record in records]),
+            [(threadId, recordId) for threadId in range(4) for recordId in range(100)])
+        self.assertEqual(set([len(record) for record in records]), set([5]))
+        self.assertEqual(xml.bytePosition, len(out.getvalue()))
+        self.assertEqual(xml.outputHash.hexdigest(), hashlib.sha256(out.getvalue()).hexdigest())
+
+    def testFragmentIsSameAsWriting(self):
+        for settings in ({"newline": "\n"}, {"pretty": False}, {"canonical": True}):
+            expectedXml = loxun.BytesXmlWriter(**settings)
+            expectedXml.addNamespace("x", "http://xxx/")
+            expectedXml.startTag("records")
+            self._writeRecord(expectedXml, 0, 0)
+            expectedXml.tag("empty")
+            expectedXml.endTag()
+            xml = loxun.BytesXmlWriter(**settings)
+            xml.addNamespace("x", "http://xxx/")
+            xml.startTag("records")
+            with xml.fragment() as record:
+                self._writeRecord(record, 0, 0)
+            with xml.fragment():
+                pass
+            with xml.fragment() as record:
+                record.tag("empty")
+            xml.endTag()
+            self.assertEqual(xml.close(), expectedXml.close())
+
+    def testEmptyFragmentKeepsEmptyElement(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, concurrent=True)
+        xml.startTag("a")
+        with xml.fragment():
+            pass
+        xml.endTag()
+        self.assertEqual(xml.close(), b"<a/>")
+
+    def testNestedFragments(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, concurrent=True)
+        xml.startTag("a")
+        with xml.fragment() as outer:
+            outer.tag("outer")
+            with xml.fragment() as inner:
+                inner.tag("inner")
+            outer.tag("outer")
+        with xml.fragment() as reused:
+            reused.tag("reused")
+        xml.endTag()
+        self.assertEqual(xml.close(), b"<a><inner/><outer/><outer/><reused/></a>")
+
+    def testBrokenFragmentFails(self):
+        xml = loxun.BytesXmlWriter(pretty=False, prolog=False, concurrent=True)
+        xml.startTag("a")
+        fragment = xml.fragment()
+        record = fragment.__enter__()
+        record.startTag("b")
+        self.assertRaises(loxun.XmlError, fragment.__exit__, None, None, None)
+        try:
+            with xml.fragment() as record:
+                record.tag("c")
+                raise ValueError("test")
+        except ValueError:
+            pass
+        fragment = xml.fragment()
+        record = fragment.__enter__()
+        record.tag("d")
+        xml.startTag("e")
+        self.assertRaises(loxun.XmlError, fragment.__exit__, None, None, None)
+        xml.endTag()
+        fragment = xml.fragment()
+        record = fragment.__enter__()
+        record.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, fragment.__exit__, None, None, None)
+        with xml.fragment() as record:
+            self.assertRaises(loxun.XmlError, record.cached, "f")
+        xml.addNamespace("x", "http://xxx/")
+        self.assertRaises(loxun.XmlError, xml.fragment)
+        xml.tag("x:g")
+        xml.endTag()
+        self.assertEqual(xml.close(), b'<a><e/><x:g xmlns:x="http://xxx/"/></a>')
+
+    def testUnsupportedWritersFail(self):
+        self.assertRaises(loxun.XmlError, loxun.TreeXmlWriter().fragment)
+        self.assertRaises(loxun.XmlError, loxun.TeeXmlWriter([(io.BytesIO(), {})]).fragment)
+        self.assertRaises(loxun.XmlError, loxun.RecordingXmlWriter().fragment)
+
+    def testPerformance(self):
+        import threading
+        lock = threading.Lock()
+
+        def writeRecordsUsingLock(xml, threadId, recordCount):
+            for recordId in range(recordCount):
+                with lock:
+                    self._writeRecord(xml, threadId, recordId)
+
+        recordCount = 2000
+        startTime = time.time()
+        self._writeDocumentUsingThreads(loxun.XmlWriter(_NullOutput()), writeRecordsUsingLock, recordCount=recordCount)
+        lockTime = time.time() - startTime
+        startTime = time.time()
+        self._writeDocumentUsingThreads(
+            loxun.XmlWriter(_NullOutput(), concurrent=True), self._writeRecordsUsingFragments, recordCount=recordCount)
+        fragmentTime = time.time() - startTime
+        # Without several CPUs, fragments cannot be faster, but the lock is
+        # held a lot shorter for about the same total time. This depends too
+        # much on the machine to compare, so only log the timing.
+        _log.info(
+            "writing %d records in 4 threads using fragments took %.3fs, using a lock took %.3fs",
+            4 * recordCount, fragmentTime, lockTime)
+
+
+class _CallLog(loxun.XmlSink):
+    """
+    Sink that prefers large chunks and remembers how it was called.
+    """
+    prefersLargeChunks = True
+
+    def __init__(self):
+        self.calls = []
+        self.data = b""
+
+    def write(self, data):
+        self.calls.append("write")
+        self.data += data
+
+    def writev(self, datas):
+        self.calls.append("writev")
+        self.data += b"".join(datas)
+
+    def flush(self):
+        self.calls.append("flush")
+
+
+class _SendallOutput(object):
+    """
+    Output that sends each fragment to a socket on its own.
+    """
+    def __init__(self, socket):
+        self.write = socket.sendall
+
+
+class SinkTest(unittest.TestCase):
+    def _writeDocument(self, xml, itemCount=3000):
+        xml.startTag("items")
+        for itemId in range(itemCount):
+            xml.startTag("item", {"id": itemId})
+            xml.text("\u20ac %d" % itemId)
+            xml.endTag()
+        xml.endTag()
+        xml.close()
+
+    def _expectedData(self, itemCount=3000, **settings):
+        xml = loxun.BytesXmlWriter(**settings)
+        self._writeDocument(xml, itemCount)
+        return xml.getvalue()
+
+    def testFileDescriptorSink(self):
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            sink = loxun.FileDescriptorSink(fd)
+            self.assertTrue(sink.supportsSeek)
+            xml = loxun.XmlWriter(sink, hashName="md5")
+            self._writeDocument(xml)
+            sink.close()
+            with io.open(path, "rb") as xmlFile:
+                data = xmlFile.read()
+        finally:
+            os.remove(path)
+        self.assertEqual(data, self._expectedData())
+        self.assertEqual(xml.bytePosition, len(data))
+
+    def testResetWritesChunks(self):
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            sink = loxun.FileDescriptorSink(fd)
+            xml = loxun.XmlWriter(sink, pretty=False, prolog=False)
+            xml.tag("a")
+            xml.reset(sink)
+            xml.tag("b")
+            xml.close()
+            sink.close()
+            with io.open(path, "rb") as xmlFile:
+                self.assertEqual(xmlFile.read(), b"<a/><b/>")
+        finally:
+            os.remove(path)
+
+    def testFromCheckpointWithFileDescriptorSink(self):
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            sink = loxun.FileDescriptorSink(fd)
+            xml = loxun.XmlWriter(sink, pretty=False)
+            xml.startTag("items")
+            xml.tag("item", {"id": 1})
+            checkpoint = xml.checkpoint()
+            # Written after the checkpoint but lost in a crash.
+            xml.tag("item", {"id": 2})
+            xml.flush()
+            sink.close()
+
+            sink = loxun.FileDescriptorSink(os.open(path, os.O_RDWR))
+            xml = loxun.XmlWriter.fromCheckpoint(sink, checkpoint, pretty=False)
+            xml.tag("item", {"id": 3})
+            xml.endTag()
+            xml.close()
+            sink.close()
+            with io.open(path, "rb") as xmlFile:
+                self.assertEqual(xmlFile.read(), (
+                    b'<?xml version="1.0" encoding="utf-8"?><items><item id="1"/><item id="3"/></items>'))
+        finally:
+            os.remove(path)
+
+    def testFileDescriptorSinkWithPipe(self):
+        readFd, writeFd = os.pipe()
+        sink = loxun.FileDescriptorSink(writeFd)
+        self.assertFalse(sink.supportsSeek)
+        xml = loxun.XmlWriter(sink, pretty=False)
+        xml.tag("a")
+        self.assertRaises(loxun.XmlError, xml.placeholder, "b", 3)
+        xml.close()
+        sink.close()
+        with io.open(readFd, "rb") as readFile:
+            self.assertEqual(readFile.read(), b'<?xml version="1.0" encoding="utf-8"?><a/>')
+
+    def testPlaceholderWithFileDescriptorSink(self):
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        try:
+            sink = loxun.FileDescriptorSink(fd)
+            xml = loxun.XmlWriter(sink, pretty=False, prolog=False)
+            xml.tag("first")
+            xml.startTag("items")
+            count = xml.placeholder("count", 5)
+            for itemId in range(3):
+                xml.tag("item")
+            xml.endTag()
+            xml.fill(count, 3)
+            xml.close()
+            sink.close()
+            with io.open(path, "rb") as xmlFile:
+                data = xmlFile.read()
+        finally:
+            os.remove(path)
+        self.assertEqual(data, b'<first/><items count="3"    ><item/><item/><item/></items>')
+
+    def testSocketSink(self):
+        import socket
+        import threading
+        server, client = socket.socketpair()
+        receivedDatas = []
+
+        def receive():
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                receivedDatas.append(data)
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        try:
+            sink = loxun.SocketSink(server)
+            self._writeDocument(loxun.XmlWriter(sink))
+        finally:
+            server.close()
+            receiver.join()
+            client.close()
+        self.assertEqual(b"".join(receivedDatas), self._expectedData())
+
+    def testBytearraySink(self):
+        buffer = bytearray(b"xx")
+        sink = loxun.BytearraySink(buffer)
+        self._writeDocument(loxun.XmlWriter(sink, encoding="iso-8859-15"))
+        self.assertTrue(sink.buffer is buffer)
+        self.assertEqual(sink.getvalue(), b"xx" + self._expectedData(encoding="iso-8859-15"))
+
+    def testTextSink(self):
+        sink = loxun.TextSink(io.StringIO())
+        xml = loxun.XmlWriter(sink)
+        self._writeDocument(xml)
+        text = sink.stream.getvalue()
+        self.assertEqual(text, self._expectedData().decode("utf-8"))
+        self.assertEqual(xml.bytePosition, len(text))
+
+    def testTextSinkWithLegacyEncoding(self):
+        sink = loxun.TextSink(io.StringIO())
+        xml = loxun.XmlWriter(sink, pretty=False, encoding="ascii", errors="xmlcharrefreplace")
+        xml.tag("a", {"price": "\u20ac 1"})
+        xml.close()
+        self.assertEqual(sink.stream.getvalue(), '<?xml version="1.0" encoding="ascii"?><a price="&#8364; 1"/>')
+        xml = loxun.XmlWriter(loxun.TextSink(io.StringIO()), encoding="ascii")
+        self.assertRaises(UnicodeEncodeError, xml.text, "\u20ac")
+
+    def testTextSinkWithByteFeaturesFails(self):
+        self.assertRaises(loxun.XmlError, loxun.XmlWriter, loxun.TextSink(io.StringIO()), hashName="md5")
+        xml = loxun.XmlWriter(loxun.TextSink(io.StringIO()), fragmentCache=loxun.FragmentCache())
+        xml.startTag("a")
+        self.assertRaises(loxun.XmlError, xml.placeholder, "b", 3)
+        self.assertRaises(loxun.XmlError, xml.deferred, "b")
+        self.assertRaises(loxun.XmlError, xml.cached, "b")
+        self.assertRaises(loxun.XmlError, xml.fragment)
+        self.assertRaises(loxun.XmlError, xml.checkpoint)
+
+    def testLargeChunks(self):
+        sink = _CallLog()
+        xml = loxun.XmlWriter(sink, pretty=False, prolog=False)
+        xml.startTag("a")
+        xml.tag("b")
+        self.assertEqual(sink.calls, [])
+        xml.flush()
+        self.assertEqual((sink.calls, sink.data), (["writev", "flush"], b"<a><b/>"))
+        xml.flush()
+        self.assertEqual(sink.calls, ["writev", "flush", "flush"])
+        xml.endTag()
+        xml.close()
+        self.assertEqual(sink.data, b"<a><b/></a>")
+
+        sink = _CallLog()
+        self._writeDocument(loxun.XmlWriter(sink))
+        self.assertEqual(sink.data, self._expectedData())
+        self.assertEqual(set(sink.calls), set(["writev"]))
+        self.assertTrue(len(sink.calls) < len(sink.data) // 32768, sink.calls)
+
+    def testTeeFlushesChunks(self):
+        sinks = [_CallLog(), _CallLog()]
+        xml = loxun.TeeXmlWriter([(sinks[0], {"pretty": False, "prolog": False}), (sinks[1], {"prolog": False, "newline": "\n"})])
+        xml.startTag("a")
+        xml.tag("b")
+        self.assertEqual([sink.data for sink in sinks], [b"", b""])
+        xml.flush()
+        self.assertEqual([sink.data for sink in sinks], [b"<a><b/>", b"<a>\n  <b />\n"])
+        self.assertEqual([sink.calls for sink in sinks], [["writev", "flush"], ["writev", "flush"]])
+
+    def testCheckpointWritesChunks(self):
+        sink = _CallLog()
+        xml = loxun.XmlWriter(sink, pretty=False, prolog=False)
+        xml.startTag("a")
+        xml.text("b")
+        checkpoint = xml.checkpoint()
+        self.assertEqual((sink.data, checkpoint.offset), (b"<a>b", 4))
+
+    def _socketWriteTime(self, createOutput, itemCount):
+        import socket
+        import threading
+        server, client = socket.socketpair()
+
+        def receive():
+            while client.recv(65536):
+                pass
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        try:
+            startTime = time.time()
+            self._writeDocument(loxun.XmlWriter(createOutput(server)), itemCount)
+            result = time.time() - startTime
+        finally:
+            server.close()
+            receiver.join()
+            client.close()
+        return result
+
+    def testPerformance(self):
+        itemCount = 20000
+        sendallTime = self._socketWriteTime(_SendallOutput, itemCount)
+        sinkTime = self._socketWriteTime(loxun.SocketSink, itemCount)
+        _assertNotSlower(
+            self, "writing %d items to a SocketSink" % itemCount, sinkTime,
+            "using sendall() for each fragment", sendallTime)
+
+
+class XmlProfilerTest(unittest.TestCase):
+    def _writeDocument(self, xml):
+        xml.addNamespace("x", "http://xxx/")
+        xml.startTag("x:a")
+        xml.text("hello")
+        xml.startTag("b")
+        xml.tag("c", {"id": "1"})
+        xml.endTags()
+
+    def testProfiler(self):
+        out = io.BytesIO()
+        xml = loxun.XmlWriter(out, pretty=False, prolog=False)
+        with loxun.XmlProfiler(xml) as profiler:
+            self._writeDocument(xml)
+        self.assertEqual(type(xml), loxun.XmlWriter)
+        methodStats = profiler.methodStats
+        self.assertEqual(sorted(methodStats), ["addNamespace", "endTags", "startTag", "tag", "text"])
+        self.assertEqual(methodStats["startTag"].count, 2)
+        # endTags() calls endTag() but only the outermost call counts.
+        self.assertEqual(methodStats["endTags"].count, 1)
+        self.assertEqual(sum([stats.byteCount for stats in methodStats.values()]), len(out.getvalue()))
+        self.assertEqual(sorted(profiler.tagStats), ["b", "c", "x:a"])
+        self.assertTrue(methodStats["text"].time >= 0.0)
+        self.assertTrue("endTags" in profiler.report())
+
+    def testProfilerWithChainXmlWriter(self):
+        xml = loxun.ChainXmlWriter(io.BytesIO())
+        with loxun.XmlProfiler(xml) as profiler:
+            self.assertTrue(xml.startTag("a").tag("b") is xml)
+            xml.endTag("a")
+        self.assertEqual(type(xml), loxun.ChainXmlWriter)
+        self.assertEqual(profiler.methodStats["startTag"].count, 1)
+        self.assertEqual(profiler.tagStats["a"].count, 2)
+
+    def testProfilerAccumulatesAndResets(self):
+        xml = loxun.XmlWriter(io.BytesIO())
+        profiler = loxun.XmlProfiler(xml)
+        for _ in range(2):
+            profiler.start()
+            xml.comment("x")
+            profiler.stop()
+        xml.comment("not profiled")
+        self.assertEqual(profiler.methodStats["comment"].count, 2)
+        self.assertRaises(loxun.XmlError, profiler.stop)
+        profiler.reset()
+        self.assertEqual(profiler.methodStats, {})
+        self.assertEqual(profiler.report(), "")
+
+    def testProfilerStopsOnError(self):
+        xml = loxun.XmlWriter(io.BytesIO())
+        try:
+            with loxun.XmlProfiler(xml) as profiler:
+                xml.endTag()
+            self.fail("endTag() must fail")
+        except loxun.XmlError:
+            pass
+        self.assertEqual(type(xml), loxun.XmlWriter)
+        self.assertEqual(profiler.methodStats["endTag"].count, 1)
+
+
+class _ExpatCheckingOutput(object):
+    """
+    Output that collects written data until `feed()` passes it on to an
+    incremental expat parser, so well-formedness is checked while streaming.
+    """
+    def __init__(self):
+        from xml.parsers import expat
+        self._parser = expat.ParserCreate(namespace_separator=" ")
+        self._parser.StartElementHandler = self._startElement
+        self._pending = []
+        self.elementCount = 0
+        self.byteCount = 0
+
+    def _startElement(self, name, attributes):
+        self.elementCount += 1
+
+    def write(self, data):
+        self._pending.append(data)
+
+    def feed(self, isFinal=False):
+        data = b"".join(self._pending)
+        self._pending = []
+        self.byteCount += len(data)
+        self._parser.Parse(data, isFinal)
+
+
+class FuzzTest(unittest.TestCase):
+    """
+    Drive writers with random sequences of operations and check that the
+    output always is well-formed XML. Operations with broken arguments must
+    raise `loxun.XmlError` and leave the writer usable.
+
+    The same seed is used for every run so failures can be reproduced. To
+    try other sequences, set the environment variable ``LOXUN_FUZZ_SEED``;
+    the seed used is logged.
+    """
+    _DEFAULT_SEED = 20260
+    _WRITER_SETTINGS = [
+        {},
+        {"pretty": False},
+        {"pretty": False, "encoding": "iso-8859-1", "errors": "xmlcharrefreplace"},
+        {"indent": "\t", "newline": "\r\n"},
+        {"canonical": True},
+    ]
+    _NAMESPACES = [("a", "http://a/"), ("b", "http://b/"), ("c", "http://a/"), ("", "http://default/")]
+    _TEXT_CHARACTERS = "abc xyz-?]>&<\"'\t\n\r\u00e4\u20ac\U0001f600"
+
+    def setUp(self):
+        self._seed = int(os.environ.get("LOXUN_FUZZ_SEED", self._DEFAULT_SEED))
+        _log.info("fuzzing with LOXUN_FUZZ_SEED=%d", self._seed)
+        self._random = random.Random(self._seed)
+        self._timer = getattr(time, "perf_counter", time.time)
+        # Map operation names to [count, seconds, bytes].
+        self._stats = {}
+
+    def _randomText(self, maxLength=20):
+        length = self._random.randint(0, maxLength)
+        if self._random.random() < 0.01:
+            length = self._random.randint(100000, 1000000)
+            # Large texts are mostly boring to keep random() out of the profile.
+            return _randomName() * (length // 10) + self._random.choice(["", "-", "]]", "?"])
+        return "".join([self._random.choice(FuzzTest._TEXT_CHARACTERS) for _ in range(length)])
+
+    def _randomQualifiedName(self):
+        prefix = self._random.choice(["", "", "a:", "b:", "c:", "undeclared:"])
+        return prefix + self._random.choice(["x", "y", "z", "long-name.%d" % self._random.randint(0, 9)])
+
+    def _randomAttributes(self):
+        result = {}
+        for _ in range(self._random.choice([0, 0, 1, 3])):
+            result[self._randomQualifiedName()] = self._randomText()
+        return result
+
+    def _randomOperation(self, xml, depth):
+        """
+        Pair of operation name and a function to call it on ``xml``.
+        """
+        choices = ["text", "comment", "cdata", "processingInstruction", "tag", "addNamespace"]
+        if depth < 50:
+            choices += ["startTag"] * 3
+        if depth > 1:
+            choices += ["endTag"] * 3
+        operationName = self._random.choice(choices)
+        if operationName == "startTag":
+            arguments = (self._randomQualifiedName(), self._randomAttributes())
+        elif operationName == "tag":
+            arguments = (self._randomQualifiedName(), self._randomAttributes())
+        elif operationName == "endTag":
+            arguments = ()
+        elif operationName == "comment":
+            arguments = (self._randomText(), self._random.random() < 0.5)
+        elif operationName == "processingInstruction":
+            arguments = (self._random.choice(["pi", "pi-2", "x.y"]), self._randomText())
+        elif operationName == "addNamespace":
+            arguments = self._random.choice(FuzzTest._NAMESPACES)
+        else:
+            arguments = (self._randomText(),)
+        return operationName, getattr(xml, operationName), arguments
+
+    def _call(self, output, operationName, function, arguments):
+        bytesBefore = output.byteCount
+        startTime = self._timer()
+        try:
+            function(*arguments)
+            failed = False
+        except loxun.XmlError:
+            failed = True
+        duration = self._timer() - startTime
+        # A failed operation still may have flushed a pending start tag.
+        output.feed()
+        if not failed:
+            stats = self._stats.setdefault(operationName, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] += output.byteCount - bytesBefore
+        return not failed
+
+    def _fuzzDocument(self, writerClass, settings):
+        output = _ExpatCheckingOutput()
+        xml = writerClass(output, **settings)
+        output.feed()
+        startedTagCount = 0
+        self._call(output, "comment", xml.comment, ("before root",))
+        self._call(output, "startTag", xml.startTag, ("root",))
+        depth = 1
+        for _ in range(self._random.randint(0, 500)):
+            operationName, function, arguments = self._randomOperation(xml, depth)
+            if self._call(output, operationName, function, arguments):
+                if operationName == "startTag":
+                    depth += 1
+                    startedTagCount += 1
+                elif operationName == "tag":
+                    startedTagCount += 1
+                elif operationName == "endTag":
+                    depth -= 1
+        # Use namespaces that might have been added but not used yet.
+        if self._call(output, "tag", xml.tag, ("last",)):
+            startedTagCount += 1
+        self._call(output, "endTags", xml.endTags, ())
+        xml.close()
+        output.feed(True)
+        self.assertEqual(output.elementCount, startedTagCount + 1)
+
+    def _logStats(self, writerClass):
+        for operationName, (count, duration, byteCount) in sorted(self._stats.items()):
+            _log.info(
+                "%s.%s: %d calls, %.0f calls/s, %.1f MB/s", writerClass.__name__, operationName, count,
+                count / max(duration, 1e-9), byteCount / max(duration, 1e-9) / 1e6)
+
+    def _fuzz(self, writerClass, documentCount=40):
+        for documentIndex in range(documentCount):
+            settings = FuzzTest._WRITER_SETTINGS[documentIndex % len(FuzzTest._WRITER_SETTINGS)]
+            self._fuzzDocument(writerClass, settings)
+        self._logStats(writerClass)
+
+    def testXmlWriter(self):
+        self._fuzz(loxun.XmlWriter)
+
+    def testChainXmlWriter(self):
+        self._fuzz(loxun.ChainXmlWriter)
+
+
+class ImportTimeTest(unittest.TestCase):
+    # Upper limit for the time to import loxun in microseconds. This is
+    # rather generous so the test does not break on slow machines, the main
+    # point is to detect expensive modules imported by loxun.
+    _MAX_IMPORT_TIME = 1000000
+
+    def _importTimes(self):
+        """
+        Dictionary of module names imported by ``import loxun`` and the
+        cumulative time in microseconds it took to import them.
+        """
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.path.dirname(os.path.abspath(loxun.__file__))
+        process = subprocess.Popen(
+            [sys.executable, "-X", "importtime", "-c", "import loxun"],
+            stderr=subprocess.PIPE, env=environment)
+        _, errorOutput = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        result = {}
+        for line in errorOutput.decode("utf-8").splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulativeTime, moduleName = [item.strip() for item in line.split("|")]
+                if cumulativeTime.isdigit():
+                    result[moduleName] = int(cumulativeTime)
+        return result
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7+")
+    def testImportTime(self):
+        importTimes = self._importTimes()
+        self.assertTrue("loxun" in importTimes)
+        expensiveModules = [name for name in importTimes if name.split(".")[0] in ("re", "xml", "urllib")]
+        self.assertEqual(expensiveModules, [])
+        self.assertTrue(importTimes["loxun"] < ImportTimeTest._MAX_IMPORT_TIME,
+            "importing loxun must take at most %d us but took %d us" % (ImportTimeTest._MAX_IMPORT_TIME, importTimes["loxun"]))
+
+
 def createTestSuite():
     """
     TestSuite including all unit tests and doctests found in the source code.
@@ -245,7 +2429,25 @@ def createTestSuite():
 
     # TODO: Automatically discover test cases.
     allTests = [
-        XmlWriterTest
+        XmlWriterTest,
+        ElementTreeTest,
+        TreeXmlWriterTest,
+        TransformTest,
+        CanonicalXmlTest,
+        ChecksumOutputTest,
+        InvalidCharsTest,
+        DeferredTest,
+        PlaceholderTest,
+        TeeXmlWriterTest,
+        RecordingTest,
+        CachedTest,
+        ConverterTest,
+        MemoryTest,
+        ConcurrentTest,
+        SinkTest,
+        XmlProfilerTest,
+        FuzzTest,
+        ImportTimeTest,
     ]
     for testCaseClass in allTests:
         result.addTest(loader.loadTestsFromTestCase(testCaseClass))